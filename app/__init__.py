@@ -3,15 +3,21 @@ from flask import Flask
 from flask_cors import CORS
 from .routes import bp as main_bp
 from .db import db, migrate
-import openai
+from .spotify import init_spotify_client
+from .cache import init_caches
+from .openai_client import init_openai_client
+from .history_writer import init_history_writer
+from .token_refresh import init_refresh_coordinator
+from .session_cache import init_session_cache
+from .batching import init_recommendation_batcher
+from .singleflight import init_single_flights
+from .metrics import init_metrics
+from .logging_setup import configure_logging
+from .db_pool import engine_options, init_pool_metrics
 from dotenv import load_dotenv
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import create_engine
 
 # Load environment variables from .env file
 load_dotenv()
-# db = SQLAlchemy()
-# migrate = Migrate()
 
 
 def create_app(test_config=None):
@@ -40,16 +46,183 @@ def create_app(test_config=None):
 
     # Set common configuration options
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # Maximum number of Spotify track searches run in parallel per recommendation
+    app.config.setdefault(
+        "SPOTIFY_SEARCH_CONCURRENCY", int(os.getenv("SPOTIFY_SEARCH_CONCURRENCY", 8))
+    )
+    # Maximum number of playlist track pages fetched in parallel
+    app.config.setdefault(
+        "SPOTIFY_PAGE_CONCURRENCY", int(os.getenv("SPOTIFY_PAGE_CONCURRENCY", 4))
+    )
+    # Connection pooling, timeouts (seconds) and retries for the Spotify HTTP client
+    app.config.setdefault(
+        "SPOTIFY_POOL_CONNECTIONS", int(os.getenv("SPOTIFY_POOL_CONNECTIONS", 4))
+    )
+    app.config.setdefault("SPOTIFY_POOL_MAXSIZE", int(os.getenv("SPOTIFY_POOL_MAXSIZE", 16)))
+    app.config.setdefault(
+        "SPOTIFY_CONNECT_TIMEOUT", float(os.getenv("SPOTIFY_CONNECT_TIMEOUT", 3.05))
+    )
+    app.config.setdefault("SPOTIFY_READ_TIMEOUT", float(os.getenv("SPOTIFY_READ_TIMEOUT", 10)))
+    app.config.setdefault("SPOTIFY_MAX_RETRIES", int(os.getenv("SPOTIFY_MAX_RETRIES", 2)))
+
+    # Connection pool size, timeouts (seconds) and retries for the OpenAI client
+    app.config.setdefault(
+        "OPENAI_MAX_CONNECTIONS", int(os.getenv("OPENAI_MAX_CONNECTIONS", 20))
+    )
+    app.config.setdefault(
+        "OPENAI_CONNECT_TIMEOUT", float(os.getenv("OPENAI_CONNECT_TIMEOUT", 5))
+    )
+    app.config.setdefault("OPENAI_READ_TIMEOUT", float(os.getenv("OPENAI_READ_TIMEOUT", 30)))
+    app.config.setdefault("OPENAI_MAX_RETRIES", int(os.getenv("OPENAI_MAX_RETRIES", 2)))
+    app.config.setdefault("OPENAI_MAX_TOKENS", int(os.getenv("OPENAI_MAX_TOKENS", 50)))
+    # Use the complete songs of a truncated completion when at least this many were recovered
+    app.config.setdefault(
+        "OPENAI_SALVAGE_ENABLED", os.getenv("OPENAI_SALVAGE_ENABLED", "true").lower() == "true"
+    )
+    app.config.setdefault(
+        "OPENAI_SALVAGE_MIN_SONGS", int(os.getenv("OPENAI_SALVAGE_MIN_SONGS", 2))
+    )
+    # Coalesce recommendation requests arriving within OPENAI_BATCH_WINDOW seconds
+    # into one completion of up to OPENAI_BATCH_MAX_SIZE descriptions
+    app.config.setdefault(
+        "OPENAI_BATCH_ENABLED", os.getenv("OPENAI_BATCH_ENABLED", "false").lower() == "true"
+    )
+    app.config.setdefault("OPENAI_BATCH_WINDOW", float(os.getenv("OPENAI_BATCH_WINDOW", 0.05)))
+    app.config.setdefault("OPENAI_BATCH_MAX_SIZE", int(os.getenv("OPENAI_BATCH_MAX_SIZE", 10)))
+    # Completion tokens per description of a batch (/recommend/batch and the
+    # batcher), with room to spare: a cut off item has to be salvaged or asked for again
+    app.config.setdefault("OPENAI_BATCH_ITEM_TOKENS", int(os.getenv("OPENAI_BATCH_ITEM_TOKENS", 120)))
+    # Descriptions a batch completion did not answer are asked for individually, this many at a time
+    app.config.setdefault(
+        "OPENAI_FALLBACK_CONCURRENCY", int(os.getenv("OPENAI_FALLBACK_CONCURRENCY", 4))
+    )
+
+    # Share identical recommendations and track searches that are in flight at
+    # the same time, across workers through Redis when SINGLE_FLIGHT_DISTRIBUTED
+    app.config.setdefault(
+        "SINGLE_FLIGHT_ENABLED", os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+    )
+    app.config.setdefault(
+        "SINGLE_FLIGHT_DISTRIBUTED", os.getenv("SINGLE_FLIGHT_DISTRIBUTED", "false").lower() == "true"
+    )
+    app.config.setdefault("SINGLE_FLIGHT_TIMEOUT", int(os.getenv("SINGLE_FLIGHT_TIMEOUT", 30)))
+
+    # Logs go through a background thread as JSON lines (LOG_FORMAT=text for
+    # plain lines) to stdout and LOG_FILE; upstream response logs below
+    # WARNING are sampled with LOG_UPSTREAM_SAMPLE_RATE
+    app.config.setdefault("LOG_LEVEL", os.getenv("LOG_LEVEL", "INFO").upper())
+    app.config.setdefault("LOG_FORMAT", os.getenv("LOG_FORMAT", "json").lower())
+    app.config.setdefault("LOG_FILE", os.getenv("LOG_FILE") or None)
+    app.config.setdefault("LOG_QUEUE_SIZE", int(os.getenv("LOG_QUEUE_SIZE", 10000)))
+    app.config.setdefault(
+        "LOG_UPSTREAM_SAMPLE_RATE", float(os.getenv("LOG_UPSTREAM_SAMPLE_RATE", 0.1))
+    )
+
+    # Directory shared by the gunicorn workers for their metrics snapshots, so
+    # /metrics reports all of them; unset reports only the serving worker
+    app.config.setdefault("METRICS_DIR", os.getenv("METRICS_DIR") or None)
+    app.config.setdefault(
+        "METRICS_SNAPSHOT_INTERVAL", float(os.getenv("METRICS_SNAPSHOT_INTERVAL", 1.0))
+    )
+
+    # Maximum number of descriptions accepted by /recommend/batch
+    app.config.setdefault("BATCH_MAX_DESCRIPTIONS", int(os.getenv("BATCH_MAX_DESCRIPTIONS", 10)))
+    # Upper bound for the "limit" parameter of /history
+    app.config.setdefault("HISTORY_MAX_PAGE_SIZE", int(os.getenv("HISTORY_MAX_PAGE_SIZE", 50)))
+    # Search history is written in batches off the request path, flushed every
+    # HISTORY_BATCH_SIZE rows or HISTORY_FLUSH_INTERVAL seconds
+    app.config.setdefault(
+        "HISTORY_WRITE_BEHIND", os.getenv("HISTORY_WRITE_BEHIND", "true").lower() == "true"
+    )
+    app.config.setdefault("HISTORY_BATCH_SIZE", int(os.getenv("HISTORY_BATCH_SIZE", 50)))
+    app.config.setdefault(
+        "HISTORY_FLUSH_INTERVAL", float(os.getenv("HISTORY_FLUSH_INTERVAL", 1.0))
+    )
+    app.config.setdefault("HISTORY_QUEUE_SIZE", int(os.getenv("HISTORY_QUEUE_SIZE", 10000)))
+
+    # Access tokens expiring within this many seconds are refreshed before use
+    app.config.setdefault("TOKEN_REFRESH_MARGIN", int(os.getenv("TOKEN_REFRESH_MARGIN", 300)))
+    # How long a token refresh may hold, and others wait for, the per-session refresh lock
+    app.config.setdefault(
+        "TOKEN_REFRESH_LOCK_TIMEOUT", int(os.getenv("TOKEN_REFRESH_LOCK_TIMEOUT", 10))
+    )
+
+    # Shared Redis (optional) and the "Song by Artist" -> track URI cache, TTLs in seconds
+    app.config.setdefault("REDIS_URL", os.getenv("REDIS_URL"))
+    # Connect and read timeout for every Redis call, a slow Redis is treated like a cache miss
+    app.config.setdefault("REDIS_SOCKET_TIMEOUT", float(os.getenv("REDIS_SOCKET_TIMEOUT", 0.25)))
+    app.config.setdefault(
+        "TRACK_CACHE_ENABLED", os.getenv("TRACK_CACHE_ENABLED", "true").lower() == "true"
+    )
+    app.config.setdefault("TRACK_CACHE_MAXSIZE", int(os.getenv("TRACK_CACHE_MAXSIZE", 10000)))
+    app.config.setdefault("TRACK_CACHE_TTL", int(os.getenv("TRACK_CACHE_TTL", 7 * 24 * 3600)))
+    app.config.setdefault(
+        "TRACK_CACHE_NEGATIVE_TTL", int(os.getenv("TRACK_CACHE_NEGATIVE_TTL", 3600))
+    )
+    # Normalized description -> OpenAI recommendation cache. With more than one
+    # variant, up to that many distinct answers are cached and one is picked at random.
+    app.config.setdefault(
+        "RECOMMENDATION_CACHE_ENABLED",
+        os.getenv("RECOMMENDATION_CACHE_ENABLED", "true").lower() == "true",
+    )
+    app.config.setdefault(
+        "RECOMMENDATION_CACHE_MAXSIZE", int(os.getenv("RECOMMENDATION_CACHE_MAXSIZE", 5000))
+    )
+    app.config.setdefault(
+        "RECOMMENDATION_CACHE_TTL", int(os.getenv("RECOMMENDATION_CACHE_TTL", 24 * 3600))
+    )
+    app.config.setdefault(
+        "RECOMMENDATION_CACHE_VARIANTS", int(os.getenv("RECOMMENDATION_CACHE_VARIANTS", 3))
+    )
+    # Simplified playlist track lists, keyed by playlist id and Spotify snapshot id
+    app.config.setdefault(
+        "PLAYLIST_CACHE_ENABLED", os.getenv("PLAYLIST_CACHE_ENABLED", "true").lower() == "true"
+    )
+    app.config.setdefault("PLAYLIST_CACHE_MAXSIZE", int(os.getenv("PLAYLIST_CACHE_MAXSIZE", 1000)))
+    app.config.setdefault("PLAYLIST_CACHE_TTL", int(os.getenv("PLAYLIST_CACHE_TTL", 24 * 3600)))
+    # session_id -> user info, per process. Writes invalidate the entry, with
+    # SESSION_CACHE_PUBSUB (and REDIS_URL) in every worker.
+    app.config.setdefault(
+        "SESSION_CACHE_ENABLED", os.getenv("SESSION_CACHE_ENABLED", "true").lower() == "true"
+    )
+    app.config.setdefault("SESSION_CACHE_MAXSIZE", int(os.getenv("SESSION_CACHE_MAXSIZE", 10000)))
+    app.config.setdefault("SESSION_CACHE_TTL", int(os.getenv("SESSION_CACHE_TTL", 60)))
+    app.config.setdefault(
+        "SESSION_CACHE_PUBSUB", os.getenv("SESSION_CACHE_PUBSUB", "false").lower() == "true"
+    )
+
+    # Database connection pool per worker: DB_POOL_SIZE connections kept open,
+    # up to DB_MAX_OVERFLOW more under load, DB_POOL_TIMEOUT seconds to wait
+    # for one. Connections are replaced after DB_POOL_RECYCLE seconds and
+    # checked before use so ones closed by Postgres are never handed out.
+    app.config.setdefault("DB_POOL_SIZE", int(os.getenv("DB_POOL_SIZE", 5)))
+    app.config.setdefault("DB_MAX_OVERFLOW", int(os.getenv("DB_MAX_OVERFLOW", 10)))
+    app.config.setdefault("DB_POOL_TIMEOUT", float(os.getenv("DB_POOL_TIMEOUT", 10)))
+    app.config.setdefault("DB_POOL_RECYCLE", int(os.getenv("DB_POOL_RECYCLE", 1800)))
+    app.config.setdefault(
+        "DB_POOL_PRE_PING", os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+    )
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config))
 
     # Initialize the database and migration
     db.init_app(app)
     migrate.init_app(app, db)
+    init_pool_metrics(app, db)
 
-    # Set OpenAI API key from environment variable or test config
-    # app.config['OPENAI_API_KEY'] = test_config.get('OPENAI_API_KEY', os.getenv('OPENAI_API_KEY')) if test_config else os.getenv('OPENAI_API_KEY')
-
-    # Set OpenAI API key from environment variable
-    # openai.api_key = os.getenv('OPENAI_API_KEY')
+    configure_logging(app)
+    init_metrics(app)
+    # Shared, keep-alive HTTP client for all Spotify calls
+    init_spotify_client(app)
+    init_caches(app)
+    # One OpenAI client (and connection pool) reused across requests, created on first use
+    init_openai_client(app)
+    init_recommendation_batcher(app)
+    # Need the Redis connection created by init_caches
+    init_single_flights(app)
+    init_session_cache(app)
+    init_history_writer(app)
+    # Single-flight token refresh, across workers when Redis is configured
+    init_refresh_coordinator(app)
 
     # Register blueprints
     app.register_blueprint(main_bp)
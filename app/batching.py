@@ -0,0 +1,93 @@
+import logging
+import threading
+from concurrent.futures import Future
+
+from .metrics import counters
+
+logger = logging.getLogger(__name__)
+
+
+class _Batch:
+    def __init__(self):
+        self.items = []
+        self.full = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Coalesces calls that arrive within a short window into one batch call.
+
+    The first caller of a window becomes its leader: it waits up to window
+    seconds (or until max_batch_size items have been submitted), then calls
+    batch_fn with all collected items on its own thread and hands every
+    waiter its result. There is no background thread, so the batcher is safe
+    to create before gunicorn forks.
+
+    batch_fn takes a list of items and returns a dictionary of item index to
+    result. Items it leaves out, items of a window nobody else joined, and
+    every item of a batch whose call raised get None, which tells the caller
+    to make its own, unbatched request.
+    """
+
+    def __init__(self, name, window=0.05, max_batch_size=10):
+        self.name = name
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._pending = None
+
+    def submit(self, item, batch_fn):
+        """
+        Add the item to the current batch and wait for its result.
+
+        :return: The item's result, or None if the caller should handle it on its own
+        """
+        future = Future()
+        with self._lock:
+            batch = self._pending
+            leader = batch is None
+            if leader:
+                batch = self._pending = _Batch()
+            batch.items.append((item, future))
+            if len(batch.items) >= self.max_batch_size:
+                self._pending = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._pending is batch:
+                    self._pending = None
+            self._run(batch, batch_fn)
+
+        return future.result()
+
+    def _run(self, batch, batch_fn):
+        items = [item for item, _ in batch.items]
+        results = {}
+        if len(items) > 1:
+            counters.increment(f"{self.name}_batches")
+            counters.increment(f"{self.name}_batched_items", len(items))
+            try:
+                results = batch_fn(items)
+            except Exception as e:
+                logger.warning("%s batch of %d failed: %s", self.name, len(items), str(e))
+                results = {}
+
+        for index, (_, future) in enumerate(batch.items):
+            future.set_result(results.get(index))
+
+
+def init_recommendation_batcher(app):
+    """
+    Create the batcher that coalesces concurrent recommendation requests, if enabled.
+    """
+    batcher = None
+    if app.config["OPENAI_BATCH_ENABLED"]:
+        batcher = MicroBatcher(
+            "openai_recommendation",
+            window=app.config["OPENAI_BATCH_WINDOW"],
+            max_batch_size=app.config["OPENAI_BATCH_MAX_SIZE"],
+        )
+    app.extensions["recommendation_batcher"] = batcher
+    return batcher
@@ -0,0 +1,221 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+from .metrics import counters
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    Thread-safe in-process cache with a per-entry TTL and LRU eviction once
+    maxsize entries are stored.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """
+        :return: A (found, value) tuple, value may legitimately be None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class TieredCache:
+    """
+    Two-tier cache: an in-process LRU in front of an optional shared Redis.
+
+    Values are stored as JSON in Redis so every gunicorn worker can reuse the
+    entries another worker fetched. None is a valid value and is used for
+    negative ("not found") entries, which get their own, usually shorter, TTL.
+    Redis failures are logged and treated as a miss so the cache never breaks
+    a request.
+    """
+
+    def __init__(self, namespace, maxsize, ttl, negative_ttl=None, redis_client=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.local = LRUCache(maxsize, ttl)
+        self.redis = redis_client
+
+    def _redis_key(self, key):
+        return f"moodmelody:{self.namespace}:{key}"
+
+    def _ttl_for(self, value):
+        return self.negative_ttl if value is None else self.ttl
+
+    def get(self, key):
+        """
+        :return: A (found, value) tuple, value is None for negative entries
+        """
+        found, value = self.local.get(key)
+        if found:
+            counters.increment(f"{self.namespace}_cache_local_hits")
+            return True, value
+
+        if self.redis is not None:
+            try:
+                raw_value = self.redis.get(self._redis_key(key))
+            except redis.RedisError as e:
+                logger.warning("Redis get failed for %s cache: %s", self.namespace, str(e))
+                raw_value = None
+            if raw_value is not None:
+                value = json.loads(raw_value)
+                self.local.set(key, value, ttl=self._ttl_for(value))
+                counters.increment(f"{self.namespace}_cache_redis_hits")
+                return True, value
+
+        counters.increment(f"{self.namespace}_cache_misses")
+        return False, None
+
+    def set(self, key, value):
+        ttl = self._ttl_for(value)
+        self.local.set(key, value, ttl=ttl)
+        if self.redis is not None:
+            try:
+                self.redis.set(self._redis_key(key), json.dumps(value), ex=max(int(ttl), 1))
+            except redis.RedisError as e:
+                logger.warning("Redis set failed for %s cache: %s", self.namespace, str(e))
+
+    def get_list(self, key, length):
+        """
+        Read a list kept with append().
+
+        Only lists that already hold length values are copied into the local
+        tier, a shorter one may still be growing in another worker.
+
+        :return: A (found, values) tuple
+        """
+        found, values = self.local.get(key)
+        if found:
+            counters.increment(f"{self.namespace}_cache_local_hits")
+            return True, values
+
+        if self.redis is not None:
+            try:
+                raw_values = self.redis.lrange(self._redis_key(key), 0, -1)
+            except redis.RedisError as e:
+                logger.warning("Redis lrange failed for %s cache: %s", self.namespace, str(e))
+                raw_values = []
+            if raw_values:
+                values = [json.loads(raw_value) for raw_value in raw_values]
+                if len(values) >= length:
+                    self.local.set(key, values)
+                counters.increment(f"{self.namespace}_cache_redis_hits")
+                return True, values
+
+        counters.increment(f"{self.namespace}_cache_misses")
+        return False, None
+
+    def append(self, key, value, maxlen):
+        """
+        Add value to the end of the list at key, keeping the last maxlen distinct values.
+
+        With Redis the list is changed in place in one transaction, so workers
+        appending at the same time do not overwrite each other's values.
+        """
+        if self.redis is None:
+            found, values = self.local.get(key)
+            values = [item for item in (values if found else []) if item != value]
+            values.append(value)
+            self.local.set(key, values[-maxlen:])
+            return
+
+        redis_key = self._redis_key(key)
+        raw_value = json.dumps(value, sort_keys=True)
+        try:
+            pipeline = self.redis.pipeline()
+            pipeline.lrem(redis_key, 0, raw_value)
+            pipeline.rpush(redis_key, raw_value)
+            pipeline.ltrim(redis_key, -maxlen, -1)
+            pipeline.expire(redis_key, max(int(self.ttl), 1))
+            pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning("Redis append failed for %s cache: %s", self.namespace, str(e))
+        # Read the merged list from Redis next time
+        self.local.delete(key)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.redis is not None:
+            try:
+                self.redis.delete(self._redis_key(key))
+            except redis.RedisError as e:
+                logger.warning("Redis delete failed for %s cache: %s", self.namespace, str(e))
+
+
+def init_caches(app):
+    """
+    Create the shared Redis connection (when REDIS_URL is set) and the app caches.
+    """
+    redis_url = app.config.get("REDIS_URL")
+    redis_client = None
+    if redis_url:
+        redis_client = redis.Redis.from_url(
+            redis_url,
+            socket_timeout=app.config["REDIS_SOCKET_TIMEOUT"],
+            socket_connect_timeout=app.config["REDIS_SOCKET_TIMEOUT"],
+        )
+    app.extensions["redis"] = redis_client
+
+    app.extensions["track_cache"] = TieredCache(
+        "track",
+        maxsize=app.config["TRACK_CACHE_MAXSIZE"],
+        ttl=app.config["TRACK_CACHE_TTL"],
+        negative_ttl=app.config["TRACK_CACHE_NEGATIVE_TTL"],
+        redis_client=redis_client,
+    )
+    # Variants are kept with append() as Redis lists instead of JSON strings
+    app.extensions["recommendation_cache"] = TieredCache(
+        "recommendation_variants",
+        maxsize=app.config["RECOMMENDATION_CACHE_MAXSIZE"],
+        ttl=app.config["RECOMMENDATION_CACHE_TTL"],
+        redis_client=redis_client,
+    )
+    app.extensions["playlist_cache"] = TieredCache(
+        "playlist_tracks",
+        maxsize=app.config["PLAYLIST_CACHE_MAXSIZE"],
+        ttl=app.config["PLAYLIST_CACHE_TTL"],
+        redis_client=redis_client,
+    )
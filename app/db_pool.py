@@ -0,0 +1,98 @@
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+from .metrics import counters, gauges, histograms
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool that records how long checkouts wait for a free connection.
+
+    SQLAlchemy has no pool event for the wait itself, every other pool metric
+    comes from the listeners installed by init_pool_metrics.
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            counters.increment("db_pool_timeouts")
+            raise
+        finally:
+            histograms.observe("db_pool_wait_seconds", time.perf_counter() - start)
+
+
+def engine_options(config):
+    """
+    Build SQLALCHEMY_ENGINE_OPTIONS from the DB_POOL_* settings.
+
+    Pool sizing only applies to real connection pools, in-memory SQLite
+    databases keep the single connection Flask-SQLAlchemy gives them.
+    """
+    options = {
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+    }
+    database_uri = config.get("SQLALCHEMY_DATABASE_URI")
+    if database_uri:
+        url = make_url(database_uri)
+        if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+            return options
+    options.update(
+        poolclass=InstrumentedQueuePool,
+        pool_size=config["DB_POOL_SIZE"],
+        max_overflow=config["DB_MAX_OVERFLOW"],
+        pool_timeout=config["DB_POOL_TIMEOUT"],
+    )
+    return options
+
+
+def _update_pool_gauges(pool, returning=0):
+    """
+    :param returning: Connections being checked in, the pool only counts them as returned after the event
+    """
+    if isinstance(pool, QueuePool):
+        checked_out = pool.checkedout() - returning
+        gauges.set("db_pool_checked_out", checked_out)
+        gauges.set("db_pool_overflow", max(checked_out - pool.size(), 0))
+
+
+def _instrument_engine(engine):
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        counters.increment("db_pool_connects")
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        counters.increment("db_pool_checkouts")
+        _update_pool_gauges(engine.pool)
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        _update_pool_gauges(engine.pool, returning=1)
+
+    @event.listens_for(engine, "invalidate")
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        counters.increment("db_pool_invalidations")
+
+    @event.listens_for(engine, "soft_invalidate")
+    def on_soft_invalidate(dbapi_connection, connection_record, exception):
+        counters.increment("db_pool_invalidations")
+
+
+def init_pool_metrics(app, db):
+    """
+    Count connections, checkouts and invalidations of the app's engine pools
+    and keep gauges of the connections checked out and in overflow.
+
+    The listeners stay with the pool when it is recreated, e.g. by
+    reset_after_fork.
+    """
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        _instrument_engine(engine)
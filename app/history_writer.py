@@ -0,0 +1,154 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from .db import db
+from .metrics import counters
+from .models.search_history import SearchHistory
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class HistoryWriter:
+    """
+    Write-behind buffer for search history rows.
+
+    Requests enqueue rows and return immediately; a background thread writes
+    them with one multi-row INSERT once batch_size rows are waiting or
+    flush_interval seconds have passed since the first of them arrived.
+    Pending rows are flushed when the process exits. Rows that do not fit in
+    the queue are dropped, rows whose INSERT fails are discarded; both are
+    logged and counted.
+
+    The thread is started lazily in the process that first enqueues, so an
+    app created before gunicorn forks its workers gets one thread per worker.
+    """
+
+    def __init__(self, app, batch_size=50, flush_interval=1.0, max_queue_size=10000):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def enqueue(self, spotify_user_id, search_query, spotify_link):
+        """
+        Queue a history row for writing.
+
+        :return: False if the queue is full and the row was dropped
+        """
+        self._ensure_started()
+        row = {
+            "spotify_user_id": spotify_user_id,
+            "search_query": search_query,
+            "spotify_link": spotify_link,
+            # Keep the time of the search, not the time of the flush
+            "timestamp": datetime.now(),
+        }
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            counters.increment("history_rows_dropped")
+            logger.warning("History queue full, dropped entry for user %s", spotify_user_id)
+            return False
+        counters.increment("history_rows_queued")
+        return True
+
+    def stop(self, timeout=5):
+        """
+        Flush all pending rows and stop the background thread.
+        """
+        with self._lock:
+            thread = self._thread if self._pid == os.getpid() else None
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+        else:
+            # No writer thread in this process, write whatever is queued here
+            self._write(self._drain())
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._thread.start()
+
+    def _drain(self):
+        rows = []
+        while True:
+            try:
+                row = self._queue.get_nowait()
+            except queue.Empty:
+                return rows
+            if row is not _STOP:
+                rows.append(row)
+
+    def _run(self):
+        while True:
+            row = self._queue.get()
+            if row is _STOP:
+                return
+            batch = [row]
+            deadline = time.monotonic() + self.flush_interval
+            stopping = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    row = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if row is _STOP:
+                    stopping = True
+                    break
+                batch.append(row)
+
+            if stopping:
+                batch.extend(self._drain())
+            self._write(batch)
+            if stopping:
+                return
+
+    def _write(self, rows):
+        if not rows:
+            return
+        with self.app.app_context():
+            try:
+                db.session.execute(insert(SearchHistory), rows)
+                db.session.commit()
+                counters.increment("history_rows_written", len(rows))
+            except Exception as e:
+                db.session.rollback()
+                counters.increment("history_rows_failed", len(rows))
+                logger.error("Failed to write %d history entries: %s", len(rows), str(e))
+            finally:
+                db.session.remove()
+
+
+def init_history_writer(app):
+    """
+    Create the app's history writer and flush it when the process exits.
+    """
+    history_writer = HistoryWriter(
+        app,
+        batch_size=app.config["HISTORY_BATCH_SIZE"],
+        flush_interval=app.config["HISTORY_FLUSH_INTERVAL"],
+        max_queue_size=app.config["HISTORY_QUEUE_SIZE"],
+    )
+    app.extensions["history_writer"] = history_writer
+    atexit.register(history_writer.stop)
+    return history_writer
@@ -0,0 +1,34 @@
+from .db import db
+from .openai_client import reset_openai_client
+from .spotify import init_spotify_client
+
+
+def reset_after_fork(app):
+    """
+    Give a forked worker its own connections instead of the ones it inherited.
+
+    An app created before gunicorn forks (preload_app) would otherwise share
+    pooled database, Spotify, OpenAI and Redis sockets between all workers.
+    The history writer, log listener, metrics snapshots and session cache
+    subscriber start their threads per process on their own.
+    """
+    with app.app_context():
+        # close=False leaves the parent's connections alone, the worker just stops using them
+        db.engine.dispose(close=False)
+    init_spotify_client(app)
+    reset_openai_client(app)
+    redis_client = app.extensions.get("redis")
+    if redis_client is not None:
+        redis_client.connection_pool.reset()
+
+
+def shutdown(app):
+    """
+    Flush what a worker still buffers before it exits.
+    """
+    app.extensions["history_writer"].stop()
+    app.extensions["session_cache"].stop()
+    app.extensions["metrics_snapshots"].write()
+    log_handler = app.extensions.get("log_handler")
+    if log_handler is not None:
+        log_handler.stop()
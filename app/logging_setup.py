@@ -0,0 +1,195 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, has_request_context, request
+
+from .metrics import counters
+
+# Logger for the status and bodies of upstream (Spotify, OpenAI) responses,
+# sampled because it logs on every call of the hot path
+UPSTREAM_LOGGER_NAME = "moodmelody.upstream"
+
+# Attributes every LogRecord has, anything else was passed with extra=
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, including the request id and any extra= fields.
+    """
+
+    def format(self, record):
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Tag records with the id of the request being handled on the logging thread.
+    """
+
+    def filter(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = g.get("request_id") if has_request_context() else None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only sample_rate of the records below min_level, records at or above it are always kept.
+    """
+
+    def __init__(self, sample_rate, min_level=logging.WARNING):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.min_level = min_level
+
+    def filter(self, record):
+        return record.levelno >= self.min_level or random.random() < self.sample_rate
+
+
+class StdoutHandler(logging.StreamHandler):
+    """
+    Writes to whatever sys.stdout is when the record is written, like print does.
+    """
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+class AsyncQueueHandler(QueueHandler):
+    """
+    Hands records to a bounded queue drained by a QueueListener thread, so the
+    request thread never waits for the console or a log file.
+
+    The listener is (re)started lazily by the process that logs, so an app
+    created before gunicorn forks gets one listener thread per worker. When
+    the queue is full records are dropped and counted instead of blocking.
+    """
+
+    def __init__(self, handlers, max_queue_size=10000):
+        super().__init__(queue.Queue(maxsize=max_queue_size))
+        self.handlers = handlers
+        self._listener = None
+        self._pid = None
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self.lock:
+            if self._pid == os.getpid():
+                return
+            self._listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Merge the arguments and render the traceback now, the record is formatted on another thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            counters.increment("log_records_dropped")
+
+    def stop(self):
+        """
+        Write the queued records and stop the listener thread.
+        """
+        with self.lock:
+            listener = self._listener if self._pid == os.getpid() else None
+            self._listener = None
+            self._pid = None
+        if listener is not None:
+            listener.stop()
+
+
+def configure_logging(app):
+    """
+    Route all logging through one asynchronous queue handler on the root logger.
+
+    Records are written as JSON lines (or plain text with LOG_FORMAT=text) to
+    stdout and, if LOG_FILE is set, to that file. Records of the upstream
+    logger below WARNING are sampled with LOG_UPSTREAM_SAMPLE_RATE. Every
+    request gets an id, taken from its X-Request-ID header when present,
+    that is added to its records and echoed in the response.
+    """
+    if app.config["LOG_FORMAT"] == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            "%(asctime)s - %(levelname)s - %(request_id)s - %(name)s - %(message)s", "%Y-%m-%d %H:%M:%S"
+        )
+
+    handlers = [StdoutHandler()]
+    if app.config["LOG_FILE"]:
+        handlers.append(logging.FileHandler(app.config["LOG_FILE"]))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = AsyncQueueHandler(handlers, max_queue_size=app.config["LOG_QUEUE_SIZE"])
+    queue_handler.addFilter(RequestIdFilter())
+
+    root_logger = logging.getLogger()
+    # Replace the handler of an earlier create_app in this process
+    for handler in list(root_logger.handlers):
+        if isinstance(handler, AsyncQueueHandler):
+            root_logger.removeHandler(handler)
+            handler.stop()
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(app.config["LOG_LEVEL"])
+    atexit.register(queue_handler.stop)
+
+    upstream_logger = logging.getLogger(UPSTREAM_LOGGER_NAME)
+    for log_filter in list(upstream_logger.filters):
+        if isinstance(log_filter, SamplingFilter):
+            upstream_logger.removeFilter(log_filter)
+    upstream_logger.addFilter(SamplingFilter(app.config["LOG_UPSTREAM_SAMPLE_RATE"]))
+
+    @app.before_request
+    def assign_request_id():
+        g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+
+    @app.after_request
+    def add_request_id_header(response):
+        if g.get("request_id"):
+            response.headers["X-Request-ID"] = g.request_id
+        return response
+
+    app.extensions["log_handler"] = queue_handler
+    return queue_handler
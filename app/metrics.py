@@ -0,0 +1,405 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "moodmelody"
+
+# Snapshot file holding the counters and histograms of exited workers
+RETIRED_SNAPSHOT = "retired.json"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _metric_key(name, labels):
+    if not labels:
+        return name
+    return name, tuple(sorted((str(label), str(value)) for label, value in labels.items()))
+
+
+def _split_key(key):
+    if isinstance(key, str):
+        return key, {}
+    name, labels = key
+    return name, dict(labels)
+
+
+class Counters:
+    """
+    Thread-safe named counters for the current worker process.
+
+    Counters can carry labels (e.g. the status code of an upstream response),
+    each label combination is counted separately.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def increment(self, name, amount=1, labels=None):
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, name, labels=None):
+        with self._lock:
+            return self._values.get(_metric_key(name, labels), 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Gauges:
+    """
+    Thread-safe named values of the current worker process that go up and down.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def set(self, name, value, labels=None):
+        with self._lock:
+            self._values[_metric_key(name, labels)] = value
+
+    def get(self, name, labels=None):
+        with self._lock:
+            return self._values.get(_metric_key(name, labels), 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histograms:
+    """
+    Thread-safe latency histograms for the current worker process, with
+    cumulative buckets in the Prometheus style.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, name, value, labels=None):
+        key = _metric_key(name, labels)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def get(self, name, labels=None):
+        """
+        :return: A dictionary with the cumulative "buckets" counts, "sum" and "count", or None
+        """
+        with self._lock:
+            histogram = self._values.get(_metric_key(name, labels))
+            if histogram is None:
+                return None
+            return {"buckets": list(histogram["buckets"]), "sum": histogram["sum"], "count": histogram["count"]}
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                key: {"buckets": list(histogram["buckets"]), "sum": histogram["sum"], "count": histogram["count"]}
+                for key, histogram in self._values.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+counters = Counters()
+gauges = Gauges()
+histograms = Histograms()
+
+
+@contextmanager
+def timed(stage):
+    """
+    Time a stage of the request.
+
+    The duration is recorded in the stage_duration_seconds histogram and, when
+    running on the request's own thread, added to its Server-Timing header.
+    Repeated stages of one request are summed up.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        histograms.observe("stage_duration_seconds", duration, labels={"stage": stage})
+        if has_request_context():
+            timings = g.setdefault("server_timing", {})
+            total, count = timings.get(stage, (0.0, 0))
+            timings[stage] = (total + duration, count + 1)
+
+
+def server_timing_header():
+    """
+    :return: The Server-Timing header value for the stages timed in this request, or None
+    """
+    timings = g.get("server_timing")
+    if not timings:
+        return None
+    entries = []
+    for stage, (total, count) in timings.items():
+        entry = f"{stage};dur={total * 1000:.1f}"
+        if count > 1:
+            entry += f';desc="{count} calls"'
+        entries.append(entry)
+    return ", ".join(entries)
+
+
+def _serialize(counter_values, gauge_values, histogram_values):
+    return {
+        "counters": [[*_split_key(key), value] for key, value in counter_values.items()],
+        "gauges": [[*_split_key(key), value] for key, value in gauge_values.items()],
+        "histograms": [[*_split_key(key), histogram] for key, histogram in histogram_values.items()],
+    }
+
+
+def _load_snapshot(path):
+    try:
+        with open(path) as snapshot_file:
+            return json.load(snapshot_file)
+    except (OSError, ValueError) as e:
+        logger.warning("Skipping unreadable metrics snapshot %s: %s", path, str(e))
+        return None
+
+
+def _write_snapshot(path, snapshot):
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.replace(temporary_path, path)
+
+
+def _sum_snapshots(snapshots):
+    """
+    :return: A (counters, gauges, histograms) tuple of dictionaries summed over the snapshots
+    """
+    counter_totals = {}
+    gauge_totals = {}
+    histogram_totals = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            key = _metric_key(name, labels)
+            counter_totals[key] = counter_totals.get(key, 0) + value
+        for name, labels, value in snapshot.get("gauges", []):
+            key = _metric_key(name, labels)
+            gauge_totals[key] = gauge_totals.get(key, 0) + value
+        for name, labels, histogram in snapshot["histograms"]:
+            key = _metric_key(name, labels)
+            total = histogram_totals.get(key)
+            if total is None:
+                histogram_totals[key] = {
+                    "buckets": list(histogram["buckets"]), "sum": histogram["sum"], "count": histogram["count"]
+                }
+                continue
+            total["buckets"] = [a + b for a, b in zip(total["buckets"], histogram["buckets"])]
+            total["sum"] += histogram["sum"]
+            total["count"] += histogram["count"]
+    return counter_totals, gauge_totals, histogram_totals
+
+
+class MetricsSnapshots:
+    """
+    Shares the metrics of every gunicorn worker through a directory.
+
+    Each worker writes its counters, gauges and histograms to
+    <directory>/<pid>-<id>.json at most once per interval (and when it
+    exits); the /metrics endpoint adds up the files of all workers. When a
+    worker has exited, retire_worker_snapshots folds its counters and
+    histograms into retired.json so totals never go backwards, and drops its
+    gauges. Without a directory only the serving worker's own metrics are
+    reported.
+    """
+
+    def __init__(self, directory=None, interval=1.0):
+        self.directory = directory
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._last_write = 0.0
+        self._pid = None
+        self._filename = None
+
+    def _own_path(self):
+        # Unique per process, a later worker reusing the pid must not be mistaken for a retired one
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._filename = f"{self._pid}-{uuid.uuid4().hex[:8]}.json"
+        return os.path.join(self.directory, self._filename)
+
+    def maybe_write(self):
+        if self.directory is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_write < self.interval:
+                return
+            self._last_write = now
+        self.write()
+
+    def write(self):
+        if self.directory is None:
+            return
+        path = self._own_path()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            _write_snapshot(path, _serialize(counters.snapshot(), gauges.snapshot(), histograms.snapshot()))
+        except OSError as e:
+            logger.warning("Failed to write metrics snapshot %s: %s", path, str(e))
+
+    def collect(self):
+        """
+        :return: A (counters, gauges, histograms) tuple of dictionaries summed over all workers
+        """
+        snapshots = [_serialize(counters.snapshot(), gauges.snapshot(), histograms.snapshot())]
+        if self.directory is not None:
+            skipped = {os.path.basename(self._own_path()), RETIRED_SNAPSHOT}
+            retired_path = os.path.join(self.directory, RETIRED_SNAPSHOT)
+            # Read before the worker files, so a file folded meanwhile is not counted twice
+            if os.path.exists(retired_path):
+                retired = _load_snapshot(retired_path)
+                if retired is not None:
+                    snapshots.append(retired)
+                    skipped.update(retired["folded"])
+            for path in glob.glob(os.path.join(self.directory, "*.json")):
+                if os.path.basename(path) in skipped:
+                    continue
+                snapshot = _load_snapshot(path)
+                if snapshot is not None:
+                    snapshots.append(snapshot)
+        return _sum_snapshots(snapshots)
+
+
+def retire_worker_snapshots(directory, pid):
+    """
+    Fold the snapshot of an exited worker into retired.json.
+
+    Its counters and histograms keep counting in the totals, its gauges are
+    dropped because what they measured (e.g. pooled connections) is gone.
+    Called by the gunicorn master, which handles one exit at a time, so
+    retired.json has a single writer.
+    """
+    paths = glob.glob(os.path.join(directory, f"{pid}-*.json"))
+    if not paths:
+        return
+    retired_path = os.path.join(directory, RETIRED_SNAPSHOT)
+    retired = _load_snapshot(retired_path) if os.path.exists(retired_path) else None
+    if retired is None:
+        retired = {"counters": [], "histograms": [], "folded": []}
+
+    snapshots = [retired]
+    folded = []
+    for path in paths:
+        snapshot = _load_snapshot(path)
+        if snapshot is not None:
+            snapshots.append(snapshot)
+            folded.append(os.path.basename(path))
+    counter_values, _, histogram_values = _sum_snapshots(snapshots)
+
+    # Names are only needed until their files are removed below
+    remaining = set(os.listdir(directory))
+    retired = _serialize(counter_values, {}, histogram_values)
+    retired["folded"] = [name for name in snapshots[0]["folded"] if name in remaining] + folded
+    try:
+        _write_snapshot(retired_path, retired)
+        for path in paths:
+            os.remove(path)
+    except OSError as e:
+        logger.warning("Failed to retire metrics snapshot of worker %s: %s", pid, str(e))
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=None):
+    items = sorted(labels.items())
+    if extra:
+        items += list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{label}="{_escape_label_value(value)}"' for label, value in items) + "}"
+
+
+def render_prometheus(counter_values, histogram_values, gauge_values=None, buckets=DEFAULT_BUCKETS):
+    """
+    Render counters, gauges and histograms in the Prometheus text exposition format.
+    """
+    lines = []
+    by_name = {}
+    for key, value in counter_values.items():
+        name, labels = _split_key(key)
+        by_name.setdefault(name, []).append((labels, value))
+    for name in sorted(by_name):
+        metric = f"{METRIC_PREFIX}_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        for labels, value in by_name[name]:
+            lines.append(f"{metric}{_format_labels(labels)} {value}")
+
+    by_name = {}
+    for key, value in (gauge_values or {}).items():
+        name, labels = _split_key(key)
+        by_name.setdefault(name, []).append((labels, value))
+    for name in sorted(by_name):
+        metric = f"{METRIC_PREFIX}_{name}"
+        lines.append(f"# TYPE {metric} gauge")
+        for labels, value in by_name[name]:
+            lines.append(f"{metric}{_format_labels(labels)} {value}")
+
+    by_name = {}
+    for key, histogram in histogram_values.items():
+        name, labels = _split_key(key)
+        by_name.setdefault(name, []).append((labels, histogram))
+    for name in sorted(by_name):
+        metric = f"{METRIC_PREFIX}_{name}"
+        lines.append(f"# TYPE {metric} histogram")
+        for labels, histogram in by_name[name]:
+            for bound, count in zip(buckets, histogram["buckets"]):
+                lines.append(f"{metric}_bucket{_format_labels(labels, [('le', repr(float(bound)))])} {count}")
+            lines.append(f"{metric}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {histogram['count']}")
+
+    return "\n".join(lines) + "\n"
+
+
+def init_metrics(app):
+    """
+    Set up the cross-worker metrics snapshots and write this worker's one on exit.
+    """
+    metrics_snapshots = MetricsSnapshots(
+        directory=app.config["METRICS_DIR"], interval=app.config["METRICS_SNAPSHOT_INTERVAL"]
+    )
+    app.extensions["metrics_snapshots"] = metrics_snapshots
+    if metrics_snapshots.directory is not None:
+        atexit.register(metrics_snapshots.write)
+    return metrics_snapshots
@@ -10,6 +10,16 @@ class SearchHistory(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.now)
     spotify_link = db.Column(db.String(255))
 
+    # Serves /history: filter by user, newest first, id breaks timestamp ties for the page cursor
+    __table_args__ = (
+        db.Index(
+            "ix_search_history_spotify_user_id_timestamp_id",
+            spotify_user_id,
+            timestamp.desc(),
+            id.desc(),
+        ),
+    )
+
     # Relationship to User
     # user = db.relationship('User', back_populates='search_histories')
 
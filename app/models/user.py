@@ -9,12 +9,15 @@ class User(db.Model):
     access_token = db.Column(db.String(), nullable=False)
     refresh_token = db.Column(db.String(), nullable=False)
     spotify_user_id = db.Column(db.String(255))
+    # When the access token expires, None for sessions stored before expiry tracking
+    expires_at = db.Column(db.DateTime)
 
     # Relationship to SearchHistory
     # search_histories = db.relationship('SearchHistory', back_populates='user')
 
-    def __init__(self, session_id, access_token, refresh_token, spotify_user_id):
+    def __init__(self, session_id, access_token, refresh_token, spotify_user_id, expires_at=None):
         self.session_id = session_id
         self.access_token = access_token
         self.refresh_token = refresh_token
         self.spotify_user_id = spotify_user_id
+        self.expires_at = expires_at
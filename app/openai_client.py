@@ -0,0 +1,70 @@
+import threading
+
+from .metrics import counters
+
+_create_lock = threading.Lock()
+
+
+def count_openai_response(response):
+    # Called for every attempt, including the ones the client retries
+    counters.increment("upstream_responses", labels={"upstream": "openai", "status": response.status_code})
+
+
+def create_openai_client(config):
+    """
+    Create an OpenAI client from the app configuration.
+
+    The client owns one httpx connection pool, so connections to the OpenAI
+    API are kept alive and reused between recommendations.
+    """
+    # Imported here because openai and httpx make up most of the app's import time
+    import httpx
+    from openai import OpenAI, DefaultHttpxClient
+
+    max_connections = config["OPENAI_MAX_CONNECTIONS"]
+    return OpenAI(
+        api_key=config["OPENAI_API_KEY"],
+        timeout=httpx.Timeout(
+            config["OPENAI_READ_TIMEOUT"], connect=config["OPENAI_CONNECT_TIMEOUT"]
+        ),
+        max_retries=config["OPENAI_MAX_RETRIES"],
+        http_client=DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=max_connections, max_keepalive_connections=max_connections
+            ),
+            event_hooks={"response": [count_openai_response]},
+        ),
+    )
+
+
+def init_openai_client(app):
+    """
+    Register the OpenAI client shared by all requests of the app.
+
+    The client is created by the first get_openai_client call, so processes
+    that never talk to OpenAI (migrations, the CLI, worker boot) skip it.
+    """
+    app.extensions["openai_client"] = None
+
+
+def get_openai_client(app):
+    """
+    :return: The app's OpenAI client, created on first use
+    """
+    openai_client = app.extensions["openai_client"]
+    if openai_client is None:
+        with _create_lock:
+            openai_client = app.extensions["openai_client"]
+            if openai_client is None:
+                openai_client = app.extensions["openai_client"] = create_openai_client(app.config)
+    return openai_client
+
+
+def reset_openai_client(app):
+    """
+    Forget the app's OpenAI client so the next get_openai_client creates a new one.
+
+    Used after a fork, the connections of the parent's client must not be shared.
+    """
+    with _create_lock:
+        app.extensions["openai_client"] = None
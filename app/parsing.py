@@ -0,0 +1,186 @@
+PLAYLIST_NAME_KEY = "playlist name"
+SONGS_KEY = "songs"
+
+ESCAPES = {
+    "n": "\n",
+    "t": "\t",
+    "r": "\r",
+    "b": "\b",
+    "f": "\f",
+    "/": "/",
+    "\\": "\\",
+    '"': '"',
+    "'": "'",
+}
+
+
+class RecommendationStreamParser:
+    """
+    Incremental parser for the recommendation dictionary streamed by OpenAI.
+
+    Completion chunks are passed to feed() as they arrive. The playlist name
+    and every entry of the songs array are returned as soon as their closing
+    quote has been seen, without waiting for the rest of the completion.
+    Both JSON (double quoted) and the Python dict style with single quotes
+    that the model usually returns are accepted, and anything before the
+    first "{" (e.g. a markdown fence) is ignored.
+
+    Only the structure used by the recommendation prompt is understood: a
+    top-level dictionary with a "Playlist name" string and a "Songs" array
+    of strings. Keys are matched case-insensitively.
+    """
+
+    def __init__(self):
+        self.playlist_name = None
+        self.songs = []
+        self.complete = False
+
+        self._stack = []
+        self._quote = None
+        self._escape = None
+        self._buffer = []
+        self._expect_key = False
+        self._key = None
+
+    def feed(self, chunk):
+        """
+        Consume the next piece of the completion.
+
+        :return: A list of ("playlist_name", name) and ("song", song) events completed by this chunk
+        """
+        events = []
+        for char in chunk:
+            if self.complete:
+                break
+            if self._quote is not None:
+                self._consume_string_char(char, events)
+            elif not self._stack:
+                if char == "{":
+                    self._stack.append("{")
+                    self._expect_key = True
+            elif char in "'\"":
+                self._quote = char
+                self._buffer = []
+            elif char in "{[":
+                self._stack.append(char)
+            elif char in "}]":
+                self._stack.pop()
+                if not self._stack:
+                    self.complete = True
+            elif char == ":" and len(self._stack) == 1:
+                self._expect_key = False
+            elif char == "," and len(self._stack) == 1:
+                self._expect_key = True
+                self._key = None
+        return events
+
+    def result(self):
+        """
+        The recommendation parsed so far, in the same shape format_openai_response returns.
+        """
+        return {"Playlist name": self.playlist_name, "Songs": list(self.songs)}
+
+    def _consume_string_char(self, char, events):
+        if self._escape is not None:
+            self._consume_escape_char(char)
+        elif char == "\\":
+            self._escape = ""
+        elif char == self._quote:
+            self._quote = None
+            self._finish_string("".join(self._buffer), events)
+        else:
+            self._buffer.append(char)
+
+    def _consume_escape_char(self, char):
+        if self._escape == "" and char != "u":
+            self._buffer.append(ESCAPES.get(char, char))
+            self._escape = None
+            return
+
+        # \uXXXX escape, collect the four hex digits
+        self._escape += char
+        if len(self._escape) == 5:
+            try:
+                self._buffer.append(chr(int(self._escape[1:], 16)))
+            except ValueError:
+                self._buffer.append(self._escape)
+            self._escape = None
+
+    def _finish_string(self, value, events):
+        depth = len(self._stack)
+        if depth == 1 and self._expect_key:
+            self._key = value.strip().lower()
+        elif depth == 1 and self._key == PLAYLIST_NAME_KEY:
+            self.playlist_name = value
+            events.append(("playlist_name", value))
+        elif depth == 2 and self._stack[-1] == "[" and self._key == SONGS_KEY:
+            self.songs.append(value)
+            events.append(("song", value))
+
+
+class SalvagedRecommendation(dict):
+    """
+    A recommendation recovered from an incomplete completion.
+
+    Served like any other recommendation, but never cached: it is missing
+    whatever the completion was cut off before.
+    """
+
+
+def salvage_recommendation(response_string):
+    """
+    Recover every fully formed field from a truncated or malformed completion.
+
+    :return: A SalvagedRecommendation with "Playlist name" (None if it was not recovered) and the complete "Songs"
+    """
+    parser = RecommendationStreamParser()
+    parser.feed(response_string)
+    return SalvagedRecommendation(parser.result())
+
+
+def split_batch_response(response_string):
+    """
+    Split a batch completion, a dictionary of recommendation dictionaries, into its items.
+
+    The completion may be truncated; the item it was cut off in is returned
+    as well so its complete songs can still be salvaged.
+
+    :return: A list of (key, item_text, complete) tuples in the order of the completion
+    """
+    items = []
+    depth = 0
+    quote = None
+    escaped = False
+    buffer = []
+    key = None
+    start = None
+    for position, char in enumerate(response_string):
+        if quote is not None:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+                if depth == 1:
+                    key = "".join(buffer).strip()
+            elif depth == 1:
+                buffer.append(char)
+        elif char in "'\"":
+            if depth >= 1:
+                quote = char
+                buffer = []
+        elif char in "{[":
+            depth += 1
+            if depth == 2 and char == "{":
+                start = position
+        elif char in "}]":
+            depth -= 1
+            if depth == 1 and start is not None:
+                items.append((key, response_string[start:position + 1], True))
+                start = None
+            elif depth == 0:
+                break
+    if start is not None:
+        items.append((key, response_string[start:], False))
+    return items
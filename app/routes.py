@@ -1,6 +1,5 @@
-from flask import Blueprint, request, jsonify, redirect, session, url_for, make_response, current_app
+from flask import Blueprint, request, jsonify, redirect, url_for, make_response, current_app, Response, stream_with_context, g, has_request_context
 import os
-from openai import OpenAI
 from flask_cors import CORS
 import requests
 import base64
@@ -12,9 +11,18 @@ import logging
 import ast
 import re
 import json
-from datetime import datetime
-import sys
+from datetime import datetime, timedelta
+import copy
+import random
+import string
+import time
 from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .metrics import counters, histograms, render_prometheus, server_timing_header, timed
+from sqlalchemy import insert, tuple_
+from .parsing import RecommendationStreamParser, SalvagedRecommendation, salvage_recommendation, split_batch_response
+from .logging_setup import UPSTREAM_LOGGER_NAME
+from . import openai_client
 
 
 
@@ -24,35 +32,55 @@ REACT_APP_URL = os.getenv("REACT_APP_URL")
 # Retries attempts for OpenAI to respond with correctly formatted response if we fail to parse it.
 MAX_RETRIES = 2
 
-# Set up logging
-# Create a directory for logs if it doesn't exist
-log_directory = "logging"
-if not os.path.exists(log_directory):
-    os.makedirs(log_directory)
-
-# Configure logging
-log_filename = datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + '.log'
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[
-        logging.FileHandler(os.path.join(log_directory, log_filename)),
-        logging.StreamHandler(sys.stdout)  # If you also want to output to the console
-    ]
-)
+OPENAI_MODEL = "gpt-4o-mini"
+
+# Spotify's maximum page size for playlist tracks, and the only fields we use from them
+PLAYLIST_TRACKS_PAGE_SIZE = 100
+PLAYLIST_TRACKS_FIELDS = "total,items(track(id,name,artists(name),album(name),duration_ms,preview_url))"
+# The playlist object embeds the first PLAYLIST_TRACKS_PAGE_SIZE tracks next to its snapshot id
+PLAYLIST_FIRST_PAGE_FIELDS = f"snapshot_id,tracks({PLAYLIST_TRACKS_FIELDS})"
 
-logger = logging.getLogger()
+# Logging is configured by create_app
+logger = logging.getLogger(__name__)
+upstream_logger = logging.getLogger(UPSTREAM_LOGGER_NAME)
 
 bp = Blueprint("main", __name__)
 CORS(bp)  # Enable CORS for the blueprint
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+def get_openai_client():
+    return openai_client.get_openai_client(current_app)
 
 
-def get_openai_client():
-    return OpenAI(api_key=current_app.config["OPENAI_API_KEY"])
+def get_spotify_client():
+    return current_app.extensions["spotify_client"]
+
+
+def get_track_cache():
+    return current_app.extensions["track_cache"]
+
+
+def get_recommendation_cache():
+    return current_app.extensions["recommendation_cache"]
+
+
+def get_playlist_cache():
+    return current_app.extensions["playlist_cache"]
+
+
+def get_session_cache():
+    return current_app.extensions["session_cache"]
+
+
+def get_recommendation_batcher():
+    return current_app.extensions.get("recommendation_batcher")
+
+
+def get_recommendation_flight():
+    return current_app.extensions.get("recommendation_flight")
+
+
+def get_track_flight():
+    return current_app.extensions.get("track_flight")
 
 
 # Spotify credentials (replace with your client ID and client secret)
@@ -64,32 +92,176 @@ SPOTIFY_ACCESS_TOKEN = os.getenv("SPOTIFY_ACCESS_TOKEN")
 # Helper functions
 
 def get_session_id():
-    print("I'm in session id")
     session_id = str(uuid.uuid4())
     return session_id
 
 
+def token_expires_at(token_info):
+    """
+    Compute when an access token expires from the "expires_in" seconds of Spotify's token response.
+    """
+    expires_in = token_info.get("expires_in")
+    if expires_in is None:
+        return None
+    return datetime.now() + timedelta(seconds=int(expires_in))
+
+
 def store_tokens_in_db(session_id, token_info, spotify_user_id):
     access_token = token_info["access_token"]
     refresh_token = token_info["refresh_token"]
     user = User(
-        session_id=session_id, access_token=access_token, refresh_token=refresh_token, spotify_user_id=spotify_user_id
+        session_id=session_id,
+        access_token=access_token,
+        refresh_token=refresh_token,
+        spotify_user_id=spotify_user_id,
+        expires_at=token_expires_at(token_info),
     )
     db.session.add(user)
     db.session.commit()
-    print(f"Successfully stored session ID {session_id} and token info")
+    invalidate_session_user(session_id)
+    logger.info("Stored tokens for session %s", session_id)
 
 
 def retrieve_user_info_from_db(session_id):
-    user = User.query.filter_by(session_id=session_id).first()
+    with timed("db_lookup"):
+        user = User.query.filter_by(session_id=session_id).first()
     if user:
         return {
             "access_token": user.access_token,
             "refresh_token": user.refresh_token,
             "spotify_user_id": user.spotify_user_id,
+            "expires_at": user.expires_at,
         }
     return None
 
+
+def load_session_user(session_id):
+    """
+    retrieve_user_info_from_db behind the process-level session cache.
+
+    Unknown sessions are not cached, a login must be seen right away.
+    """
+    if not current_app.config["SESSION_CACHE_ENABLED"]:
+        return retrieve_user_info_from_db(session_id)
+    session_cache = get_session_cache()
+    found, user_info = session_cache.get(session_id)
+    if found:
+        return user_info
+    generation = session_cache.generation
+    user_info = retrieve_user_info_from_db(session_id)
+    if user_info is not None:
+        session_cache.set(session_id, user_info, generation)
+    return user_info
+
+
+def invalidate_session_user(session_id):
+    """
+    Forget the cached info of a session whose row was just written.
+    """
+    if has_request_context():
+        g.get("user_contexts", {}).pop(session_id, None)
+    get_session_cache().invalidate(session_id)
+
+
+def get_user_context(session_id):
+    """
+    The session's info, looked up once per request and kept on flask.g.
+
+    The route and the helpers it calls share the same dictionary, so a token
+    refreshed by get_valid_access_token is seen by all of them.
+
+    :return: The session's info in the retrieve_user_info_from_db format, or None
+    """
+    if not has_request_context():
+        return load_session_user(session_id)
+    user_contexts = g.setdefault("user_contexts", {})
+    if session_id not in user_contexts:
+        user_contexts[session_id] = load_session_user(session_id)
+    return user_contexts[session_id]
+
+
+def token_expires_soon(expires_at):
+    """
+    Whether the token is due for a refresh.
+
+    Sessions stored before expiry times were recorded have none; they are
+    refreshed once, which stores the expiry of the new token.
+    """
+    if expires_at is None:
+        return True
+    margin = timedelta(seconds=current_app.config["TOKEN_REFRESH_MARGIN"])
+    return expires_at - margin <= datetime.now()
+
+
+def refresh_session_tokens(session_id):
+    """
+    Refresh the session's access token, with at most one refresh per session in flight.
+
+    Concurrent callers for the same session wait for the refresh coordinator
+    lock. The session row is then re-read, and a token already refreshed by
+    the previous lock holder is reused instead of refreshing again. Without
+    Redis the row is locked with SELECT ... FOR UPDATE to serialize workers.
+
+    :return: The session's info in the retrieve_user_info_from_db format
+    """
+    coordinator = current_app.extensions["refresh_coordinator"]
+    with coordinator.lock(session_id) as distributed:
+        query = User.query.filter_by(session_id=session_id).populate_existing()
+        if not distributed:
+            query = query.with_for_update()
+        user = query.first()
+        if not user:
+            db.session.rollback()
+            raise ValueError("User not found.")
+
+        if token_expires_soon(user.expires_at):
+            logger.info("Access token for session %s expires soon, refreshing", session_id)
+            try:
+                new_token_info = request_token_refresh(user.refresh_token)
+            except Exception:
+                db.session.rollback()
+                raise
+            user.access_token = new_token_info["access_token"]
+            # Spotify may rotate the refresh token, the old one stops working then
+            if new_token_info.get("refresh_token"):
+                user.refresh_token = new_token_info["refresh_token"]
+            user.expires_at = token_expires_at(new_token_info)
+            counters.increment("spotify_token_refreshes")
+        else:
+            counters.increment("spotify_token_refreshes_reused")
+
+        user_info = {
+            "access_token": user.access_token,
+            "refresh_token": user.refresh_token,
+            "spotify_user_id": user.spotify_user_id,
+            "expires_at": user.expires_at,
+        }
+        # Commit inside the lock so waiters see the new token
+        db.session.commit()
+        get_session_cache().invalidate(session_id)
+        return user_info
+
+
+def get_valid_access_token(session_id, token_info):
+    """
+    Return an access token for the session that is not about to expire.
+
+    Tokens expiring within TOKEN_REFRESH_MARGIN seconds are refreshed before
+    they are used, so Spotify calls don't have to fail with a 401 first. If the
+    refresh fails the stored token is returned and the error is logged.
+
+    :param token_info: The session's info from retrieve_user_info_from_db
+    """
+    if not token_expires_soon(token_info.get("expires_at")):
+        return token_info["access_token"]
+
+    try:
+        token_info.update(refresh_session_tokens(session_id))
+    except Exception as e:
+        logger.error("Proactive token refresh failed: %s", str(e))
+
+    return token_info["access_token"]
+
 def save_search_history(spotify_user_id, search_query, spotify_link):
     """
     Save a search history entry to the database.
@@ -103,8 +275,83 @@ def save_search_history(spotify_user_id, search_query, spotify_link):
         search_query=search_query,
         spotify_link=spotify_link
     )
-    db.session.add(search_history_entry)
-    db.session.commit()
+    with timed("history_commit"):
+        db.session.add(search_history_entry)
+        db.session.commit()
+
+def save_search_history_batch(entries):
+    """
+    Save several search history entries in one transaction.
+
+    :param entries: A list of (spotify_user_id, search_query, spotify_link) tuples
+    """
+    if not entries:
+        return
+    with timed("history_commit"):
+        db.session.execute(
+            insert(SearchHistory),
+            [
+                {
+                    "spotify_user_id": spotify_user_id,
+                    "search_query": search_query,
+                    "spotify_link": spotify_link,
+                    "timestamp": datetime.now(),
+                }
+                for spotify_user_id, search_query, spotify_link in entries
+            ],
+        )
+        db.session.commit()
+
+
+def encode_history_cursor(timestamp, entry_id):
+    """
+    Encode the position of the last history row of a page as an opaque cursor.
+    """
+    raw_cursor = json.dumps([timestamp.isoformat(), entry_id])
+    return base64.urlsafe_b64encode(raw_cursor.encode()).decode().rstrip("=")
+
+
+def decode_history_cursor(cursor):
+    """
+    Decode a cursor created by encode_history_cursor.
+
+    :return: A (timestamp, id) tuple
+    :raises ValueError: If the cursor is malformed
+    """
+    try:
+        padded_cursor = cursor + "=" * (-len(cursor) % 4)
+        timestamp, entry_id = json.loads(base64.urlsafe_b64decode(padded_cursor.encode()))
+        return datetime.fromisoformat(timestamp), int(entry_id)
+    except Exception as e:
+        raise ValueError("Invalid history cursor.") from e
+
+
+def history_page_query(spotify_user_id, cursor, limit):
+    """
+    Query a page of the user's history, newest first.
+
+    Keyset pagination: a cursor continues strictly after the (timestamp, id)
+    of the last row of the previous page. The row comparison and the order
+    match the (spotify_user_id, timestamp DESC, id DESC) index, so every page
+    is an index range scan without a sort, however deep it is.
+
+    :param cursor: A (timestamp, id) tuple from decode_history_cursor, or None for the first page
+    """
+    query = SearchHistory.query.filter_by(spotify_user_id=spotify_user_id)
+    if cursor:
+        query = query.filter(tuple_(SearchHistory.timestamp, SearchHistory.id) < tuple_(*cursor))
+    return query.order_by(SearchHistory.timestamp.desc(), SearchHistory.id.desc()).limit(limit)
+
+
+def record_search_history(spotify_user_id, search_query, spotify_link):
+    """
+    Record a search history entry without blocking the request when write-behind is enabled.
+    """
+    if current_app.config["HISTORY_WRITE_BEHIND"]:
+        current_app.extensions["history_writer"].enqueue(spotify_user_id, search_query, spotify_link)
+    else:
+        save_search_history(spotify_user_id, search_query, spotify_link)
+
 
 def format_openai_response(response_string):
     """
@@ -121,7 +368,7 @@ def format_openai_response(response_string):
         match = re.search(r'\{.*\}', response_string, re.DOTALL)
         if match:
             json_string = match.group(0)
-            print("JSON String:", json_string)
+            logger.debug("Extracted JSON string: %s", json_string)
 
             # Count occurrences of opening and closing braces and brackets
             open_braces = json_string.count('{')
@@ -129,15 +376,14 @@ def format_openai_response(response_string):
             open_brackets = json_string.count('[')
             close_brackets = json_string.count(']')
 
-            print("Closing Braces:", close_braces)
-            print("Closing Brackets:", close_brackets)
+            logger.debug("Closing braces: %d, closing brackets: %d", close_braces, close_brackets)
 
             # Add missing closing braces and brackets
             if open_braces > close_braces:
                 json_string += '}' * (open_braces - close_braces)
             if open_brackets > close_brackets:
                 json_string += ']' * (open_brackets - close_brackets)
-            print("JSON String with Closing Braces:", json_string)
+            logger.debug("JSON string with closing braces: %s", json_string)
 
             try:
                 return json.loads(json_string)
@@ -153,41 +399,168 @@ def format_openai_response(response_string):
         logger.error("Error details: %s", str(e))
         raise ValueError("Could not parse the OpenAI response.")
     
+def recommendation_cache_key(user_text):
+    """
+    Normalize a mood description for the recommendation cache.
+
+    Case, punctuation and runs of whitespace are folded, so "Happy!" and
+    "  happy " share an entry.
+    """
+    folded = user_text.lower().translate(str.maketrans(string.punctuation, " " * len(string.punctuation)))
+    return " ".join(folded.split())
+
+
+def get_cached_recommendation(user_text):
+    """
+    Return a cached recommendation for the description, or None if OpenAI should be asked.
+
+    Up to RECOMMENDATION_CACHE_VARIANTS distinct answers are collected per
+    description; once that many are cached a random one is returned so repeat
+    users still get some variety.
+    """
+    if not current_app.config["RECOMMENDATION_CACHE_ENABLED"]:
+        return None
+
+    max_variants = max(current_app.config["RECOMMENDATION_CACHE_VARIANTS"], 1)
+    found, variants = get_recommendation_cache().get_list(recommendation_cache_key(user_text), max_variants)
+    if found and len(variants) >= max_variants:
+        return copy.deepcopy(random.choice(variants))
+    return None
+
+
+def remember_recommendation(user_text, recommendation_dict):
+    """
+    Add a successfully parsed recommendation to the cached variants for the description.
+
+    An answer identical to a cached variant replaces it instead of being counted twice.
+    """
+    if not current_app.config["RECOMMENDATION_CACHE_ENABLED"]:
+        return
+
+    max_variants = max(current_app.config["RECOMMENDATION_CACHE_VARIANTS"], 1)
+    get_recommendation_cache().append(
+        recommendation_cache_key(user_text), copy.deepcopy(recommendation_dict), max_variants
+    )
+
+
 def openai_recommendation(user_text):
+    """
+    Recommend a playlist for the description, served from the recommendation cache when possible.
+    """
+    cached_recommendation = get_cached_recommendation(user_text)
+    if cached_recommendation is not None:
+        return cached_recommendation
+
+    recommendation_flight = get_recommendation_flight()
+    if recommendation_flight is None:
+        return fetch_openai_recommendation(user_text)
+
+    # Identical descriptions in flight at the same time share one OpenAI call
+    recommendation_dict = recommendation_flight.do(
+        recommendation_cache_key(user_text), lambda: fetch_openai_recommendation(user_text)
+    )
+    if isinstance(recommendation_dict, dict):
+        return copy.deepcopy(recommendation_dict)
+    return recommendation_dict
+
+
+def fetch_openai_recommendation(user_text):
+    """
+    Ask OpenAI for a recommendation and cache it if it was parsed in full.
+    """
+    recommendation_dict = None
+    batcher = get_recommendation_batcher()
+    if batcher is not None:
+        # Share one completion with the requests arriving at the same time
+        recommendation_dict = batcher.submit(user_text, request_openai_batch_recommendations)
+    if recommendation_dict is None:
+        recommendation_dict = request_openai_recommendation(user_text)
+
+    # Only cache fully parsed recommendations, never error responses or salvaged ones
+    if is_cacheable_recommendation(recommendation_dict):
+        remember_recommendation(user_text, recommendation_dict)
+
+    return recommendation_dict
+
+
+def is_cacheable_recommendation(recommendation_dict):
+    """
+    Whether the recommendation is a complete answer that later requests may be served from.
+    """
+    return (
+        isinstance(recommendation_dict, dict)
+        and "Songs" in recommendation_dict
+        and not isinstance(recommendation_dict, SalvagedRecommendation)
+    )
+
+
+def default_playlist_name(user_text):
+    """
+    Playlist name used when the model's answer did not include one.
+    """
+    return f"MM {user_text}"[:100]
+
+
+def build_recommendation_messages(user_text):
+    # Create the input message for OpenAI
+    input_message = f"Please recommend 3 songs based on the description: {user_text}. Provide the recommendation strictly in the format of a dictionary with keys 'Playlist name' and 'Songs'. The value for 'playlist name' should be a short name based on the user description prefixed with 'MM', and the 'songs' should be an array of 3 song titles and artists in the format ['Song1 by Artist1', 'Song2 by Artist2', 'Song3 by Artist3']. No formatting is needed, don't forget the closing bracket for the array."
+    return [
+        {"role": "system", "content": "You are a music recommendation assistant."},
+        {"role": "user", "content": input_message},
+    ]
+
+
+def request_openai_recommendation(user_text):
+    client = get_openai_client()
     retries = 0
     while retries <= MAX_RETRIES:
         try: 
             logger.info(f"Attempt {retries + 1}: Asking OpenAI to recommend some songs")
 
-            # Create the input message for OpenAI
-            input_message = f"Please recommend 3 songs based on the description: {user_text}. Provide the recommendation strictly in the format of a dictionary with keys 'Playlist name' and 'Songs'. The value for 'playlist name' should be a short name based on the user description prefixed with 'MM', and the 'songs' should be an array of 3 song titles and artists in the format ['Song1 by Artist1', 'Song2 by Artist2', 'Song3 by Artist3']. No formatting is needed, don't forget the closing bracket for the array."
-
-            client = get_openai_client()
-
             # Send request to OpenAI API
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a music recommendation assistant."},
-                    {"role": "user", "content": input_message},
-                ],
-                max_tokens=50,
-            )
+            with timed("openai"):
+                response = client.chat.completions.create(
+                    model=OPENAI_MODEL,
+                    messages=build_recommendation_messages(user_text),
+                    max_tokens=current_app.config["OPENAI_MAX_TOKENS"],
+                )
 
             # Extract song recommendation from response
             song_recommendation = response.choices[0].message.content.strip()
 
             # Format and parse the response
-            recommendation_dict = format_openai_response(song_recommendation)
-
-            print("OpenAI Response:", recommendation_dict)
-
-            return recommendation_dict
+            try:
+                recommendation_dict = format_openai_response(song_recommendation)
+            except ValueError:
+                recommendation_dict = None
+
+            upstream_logger.info("OpenAI response: %s", recommendation_dict)
+
+            if isinstance(recommendation_dict, dict) and "Songs" in recommendation_dict:
+                counters.increment("openai_recommendation_parsed")
+                return recommendation_dict
+
+            # Keep whatever complete songs a truncated completion contains instead of asking again
+            salvaged_dict = salvage_recommendation(song_recommendation)
+            if (
+                current_app.config["OPENAI_SALVAGE_ENABLED"]
+                and len(salvaged_dict["Songs"]) >= current_app.config["OPENAI_SALVAGE_MIN_SONGS"]
+            ):
+                if salvaged_dict["Playlist name"] is None:
+                    salvaged_dict["Playlist name"] = default_playlist_name(user_text)
+                logger.warning("Salvaged %d songs from an incomplete OpenAI response", len(salvaged_dict["Songs"]))
+                counters.increment("openai_recommendation_salvaged")
+                return salvaged_dict
+
+            raise ValueError("Could not parse the OpenAI response.")
 
         except ValueError as e:
             logger.warning(f"Attempt {retries + 1} failed: ValueError: %s", str(e))
             retries += 1
-            if retries > MAX_RETRIES:
+            if retries <= MAX_RETRIES:
+                counters.increment("openai_recommendation_retries")
+            else:
+                counters.increment("openai_recommendation_failures")
                 logger.error("Max retries reached. Unable to parse the recommendation.")
                 return jsonify({"error": "Unable to parse the recommendation after multiple attempts. Please try again later."}), 500
 
@@ -200,14 +573,203 @@ def openai_recommendation(user_text):
     return jsonify({"error": "Unable to generate a recommendation. Please try again later."}), 500
 
 
+def build_batch_recommendation_messages(descriptions):
+    numbered_descriptions = "\n".join(
+        f"{number}. {description}" for number, description in enumerate(descriptions, start=1)
+    )
+    input_message = f"Please recommend 3 songs for each of the following numbered descriptions:\n{numbered_descriptions}\nProvide the recommendations strictly as one dictionary whose keys are the description numbers as strings and whose values are dictionaries with keys 'Playlist name' and 'Songs'. The value for 'playlist name' should be a short name based on that description prefixed with 'MM', and the 'songs' should be an array of 3 song titles and artists in the format ['Song1 by Artist1', 'Song2 by Artist2', 'Song3 by Artist3']. No formatting is needed."
+    return [
+        {"role": "system", "content": "You are a music recommendation assistant."},
+        {"role": "user", "content": input_message},
+    ]
+
+
+def request_openai_batch_recommendations(descriptions):
+    """
+    Ask OpenAI for recommendations for several descriptions in a single completion.
+
+    Every item is parsed on its own, so a completion cut off in its last item
+    still answers the items before it. The complete songs of the cut off item
+    are salvaged like in request_openai_recommendation.
+
+    :return: A dictionary of description index to recommendation dictionary,
+        descriptions missing from or malformed in the answer are left out
+    """
+    if not descriptions:
+        return {}
+
+    logger.info("Asking OpenAI to recommend songs for %d descriptions", len(descriptions))
+    with timed("openai_batch"):
+        response = get_openai_client().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=build_batch_recommendation_messages(descriptions),
+            max_tokens=current_app.config["OPENAI_BATCH_ITEM_TOKENS"] * len(descriptions) + 20,
+        )
+    items = split_batch_response(response.choices[0].message.content.strip())
+    if not items:
+        raise ValueError("Could not parse the OpenAI batch response.")
+
+    recommendations = {}
+    for key, item_text, complete in items:
+        if not (key or "").isdigit() or not 1 <= int(key) <= len(descriptions):
+            continue
+        index = int(key) - 1
+        recommendation_dict = None
+        if complete:
+            try:
+                recommendation_dict = format_openai_response(item_text)
+            except ValueError:
+                pass
+        if (
+            isinstance(recommendation_dict, dict)
+            and isinstance(recommendation_dict.get("Songs"), list)
+            and recommendation_dict.get("Playlist name")
+        ):
+            recommendations[index] = recommendation_dict
+            continue
+
+        salvaged_dict = salvage_recommendation(item_text)
+        if (
+            current_app.config["OPENAI_SALVAGE_ENABLED"]
+            and len(salvaged_dict["Songs"]) >= current_app.config["OPENAI_SALVAGE_MIN_SONGS"]
+        ):
+            if salvaged_dict["Playlist name"] is None:
+                salvaged_dict["Playlist name"] = default_playlist_name(descriptions[index])
+            counters.increment("openai_batch_items_salvaged")
+            recommendations[index] = salvaged_dict
+    return recommendations
+
+
+def batch_openai_recommendations(descriptions):
+    """
+    Recommend playlists for several descriptions with as few OpenAI calls as possible.
+
+    Cached descriptions are answered from the recommendation cache, the rest
+    are asked for in one completion. Descriptions the batch answer did not
+    cover fall back to individual openai_recommendation calls, up to
+    OPENAI_FALLBACK_CONCURRENCY at a time. Items salvaged
+    from a cut off batch are used but not cached.
+
+    :return: A list with a recommendation dictionary, or None if none could be made, per description
+    """
+    recommendations = [get_cached_recommendation(description) for description in descriptions]
+    missing = [index for index, recommendation in enumerate(recommendations) if recommendation is None]
+
+    try:
+        batch = request_openai_batch_recommendations([descriptions[index] for index in missing])
+    except Exception as e:
+        logger.warning("Batch recommendation failed, asking individually: %s", str(e))
+        batch = {}
+
+    fallbacks = []
+    for position, index in enumerate(missing):
+        recommendation_dict = batch.get(position)
+        if recommendation_dict is None:
+            fallbacks.append(index)
+            continue
+        if is_cacheable_recommendation(recommendation_dict):
+            remember_recommendation(descriptions[index], recommendation_dict)
+        recommendations[index] = recommendation_dict
+
+    app = current_app._get_current_object()
+
+    def fallback_recommendation(index):
+        with app.app_context():
+            return index, openai_recommendation(descriptions[index])
+
+    if fallbacks:
+        max_workers = min(current_app.config["OPENAI_FALLBACK_CONCURRENCY"], len(fallbacks))
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            for index, recommendation_dict in executor.map(fallback_recommendation, fallbacks):
+                if isinstance(recommendation_dict, dict) and "Songs" in recommendation_dict:
+                    recommendations[index] = recommendation_dict
+
+    return recommendations
+
+
+def stream_openai_recommendation(user_text, parser):
+    """
+    Stream a completion from OpenAI through the parser.
+
+    :return: A generator of the parser's ("playlist_name", name) and ("song", song) events
+    """
+    client = get_openai_client()
+    logger.info("Asking OpenAI to stream a recommendation")
+    # Only the wait for the response headers, the rest overlaps with the Spotify searches
+    with timed("openai_stream_start"):
+        stream = client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=build_recommendation_messages(user_text),
+            max_tokens=current_app.config["OPENAI_MAX_TOKENS"],
+            stream=True,
+        )
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        content = chunk.choices[0].delta.content
+        if content:
+            yield from parser.feed(content)
+        if parser.complete:
+            break
+
+
+def iter_recommendation_events(user_text):
+    """
+    Yield ("playlist_name", name) and ("song", song) events for the description as early as possible.
+
+    Cached recommendations are replayed immediately. Otherwise the completion
+    is streamed and every field is yielded as soon as it is parsed. A stream
+    that ended early is kept like a salvaged response (see
+    request_openai_recommendation) but not cached. With fewer songs than that,
+    the regular retrying request is used and its songs not streamed yet follow.
+    """
+    recommendation_dict = get_cached_recommendation(user_text)
+    name_sent = False
+    songs_sent = set()
+
+    if recommendation_dict is None:
+        parser = RecommendationStreamParser()
+        try:
+            for event in stream_openai_recommendation(user_text, parser):
+                yield event
+        except Exception as e:
+            logger.warning("Streaming recommendation failed: %s", str(e))
+
+        if parser.songs and parser.complete:
+            if parser.playlist_name is not None:
+                remember_recommendation(user_text, parser.result())
+            return
+
+        if (
+            current_app.config["OPENAI_SALVAGE_ENABLED"]
+            and len(parser.songs) >= current_app.config["OPENAI_SALVAGE_MIN_SONGS"]
+        ):
+            logger.warning("Keeping %d songs from an incomplete OpenAI stream", len(parser.songs))
+            counters.increment("openai_recommendation_salvaged")
+            return
+
+        recommendation_dict = openai_recommendation(user_text)
+        if not isinstance(recommendation_dict, dict) or "Songs" not in recommendation_dict:
+            raise ValueError("Unable to generate a recommendation.")
+        name_sent = parser.playlist_name is not None
+        songs_sent = set(parser.songs)
+
+    if not name_sent:
+        yield "playlist_name", recommendation_dict["Playlist name"]
+    for song in recommendation_dict["Songs"]:
+        if song not in songs_sent:
+            yield "song", song
+
+
 def get_spotify_user_id(access_token):
     try:
         user_profile_url = "https://api.spotify.com/v1/me"
         headers = {"Authorization": f"Bearer {access_token}"}
-        response = requests.get(user_profile_url, headers=headers)
+        with timed("spotify_user"):
+            response = get_spotify_client().get(user_profile_url, headers=headers)
         
-        logger.info("User profile request response status: %s", response.status_code)
-        logger.info("User profile request response text: %s", response.text)
+        upstream_logger.info("User profile request response status: %s", response.status_code)
+        upstream_logger.debug("User profile request response text: %s", response.text)
 
         if response.status_code == 401:
             logger.warning("Access token expired, attempting to refresh...")
@@ -236,8 +798,16 @@ def get_spotify_user_id(access_token):
         logger.error("JSONDecodeError in get_spotify_user_id: %s", str(e))
         raise ValueError("Invalid JSON received from Spotify.")
 
-# The refresh_spotify_token function remains unchanged
 def refresh_spotify_token(refresh_token):
+    return request_token_refresh(refresh_token)["access_token"]
+
+
+def request_token_refresh(refresh_token):
+    """
+    Exchange a refresh token for a new access token.
+
+    :return: Spotify's token response, including "access_token", "expires_in" and possibly a rotated "refresh_token"
+    """
     try:
         token_url = "https://accounts.spotify.com/api/token"
         auth_str = f"{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}"
@@ -253,78 +823,329 @@ def refresh_spotify_token(refresh_token):
             "refresh_token": refresh_token,
         }
 
-        response = requests.post(token_url, headers=headers, data=data)
+        with timed("token_refresh"):
+            response = get_spotify_client().post(token_url, headers=headers, data=data)
         
         if response.status_code != 200:
             logger.error("Failed to refresh token: %s", response.text)
             raise ValueError("Failed to refresh access token from Spotify.")
 
         new_token_info = response.json()
-        return new_token_info["access_token"]
+        if "access_token" not in new_token_info:
+            raise ValueError("Failed to refresh access token from Spotify.")
+        return new_token_info
 
     except Exception as e:
         logger.error("Error refreshing Spotify token: %s", str(e))
         raise
 
 
-def spotify_playlist(recommendation_dict, session_id):
-    # Uncomment the following line to use a hardcoded token for testing
-    # access_token = SPOTIFY_ACCESS_TOKEN
+def search_spotify_track(spotify_client, recommendation, headers):
+    """
+    Search Spotify for a single "Song by Artist" string.
 
-    token_info = retrieve_user_info_from_db(session_id)
-    if not token_info:
-        return redirect(url_for("login", session_id=session_id))
+    :param spotify_client: The app's SpotifyClient, passed in because this runs on worker threads
+    :param recommendation: The song string returned by OpenAI
+    :param headers: Spotify request headers including the bearer token
+    :return: The URI of the best matching track, or None if nothing was found
+    :raises ValueError: If Spotify answered with an error, which says nothing about the song
+    """
+    search_url = "https://api.spotify.com/v1/search"
+    # Passed as params so songs with "&", "#" or "+" in them are encoded
+    params = {"q": recommendation, "type": "track", "limit": 1}
+    with timed("spotify_search"):
+        search_response = spotify_client.get(search_url, headers=headers, params=params)
+    counters.increment("spotify_search_requests")
+    if search_response.status_code != 200:
+        raise ValueError(f"Spotify search failed with status {search_response.status_code}.")
+    search_results = search_response.json()
+
+    if "tracks" in search_results and search_results["tracks"]["items"]:
+        return search_results["tracks"]["items"][0]["uri"]
+    return None
 
-    # Uncomment the following line to use the token from the database
-    access_token = token_info["access_token"]
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
 
-    track_uris = []
-    search_url = "https://api.spotify.com/v1/search"
+def track_cache_key(recommendation):
+    """
+    Normalize a "Song by Artist" string so trivially different spellings share a cache entry.
+    """
+    return " ".join(recommendation.lower().split())
 
-    for recommendation in recommendation_dict["Songs"]:
-        query = f"q={recommendation}&type=track&limit=1"
-        search_response = requests.get(f"{search_url}?{query}", headers=headers)
-        search_results = search_response.json()
 
-        if "tracks" in search_results and search_results["tracks"]["items"]:
-            track_uri = search_results["tracks"]["items"][0]["uri"]
-            track_uris.append(track_uri)
+def search_spotify_track_once(spotify_client, track_flight, recommendation, headers):
+    """
+    Search for the song, sharing the search with identical ones already in flight.
+
+    :param track_flight: The app's track single-flight group, or None when disabled
+    """
+    if track_flight is None:
+        return search_spotify_track(spotify_client, recommendation, headers)
+    return track_flight.do(
+        track_cache_key(recommendation),
+        lambda: search_spotify_track(spotify_client, recommendation, headers),
+    )
+
+
+def resolve_track_uri(spotify_client, track_cache, recommendation, headers, track_flight=None):
+    """
+    Resolve one song to a track URI through the track cache, safe to call from worker threads.
+
+    :param track_cache: The app's track cache, or None when caching is disabled
+    :param track_flight: The app's track single-flight group, or None when disabled
+    :raises ValueError: If the search failed, nothing is cached then
+    """
+    key = track_cache_key(recommendation)
+    if track_cache is not None:
+        found, track_uri = track_cache.get(key)
+        if found:
+            return track_uri
+
+    track_uri = search_spotify_track_once(spotify_client, track_flight, recommendation, headers)
+    if track_cache is not None:
+        track_cache.set(key, track_uri)
+    return track_uri
+
+
+def iter_resolved_tracks(recommendations, headers):
+    """
+    Resolve recommended songs to Spotify track URIs, yielding each one as soon as it is known.
+
+    Songs already in the track cache (including cached "not found" results)
+    are yielded first without a search. The remaining distinct songs are
+    searched concurrently, capped by SPOTIFY_SEARCH_CONCURRENCY, and yielded
+    in completion order. A failed search yields None as well but is not
+    cached, so the song is searched again by the next request.
+
+    :return: A generator of (index, recommendation, track_uri) tuples, track_uri is None when not found
+    """
+    if not recommendations:
+        return
+
+    track_cache = get_track_cache() if current_app.config["TRACK_CACHE_ENABLED"] else None
+
+    # Group repeated songs so each distinct song is searched only once
+    indexes_by_key = {}
+    for index, recommendation in enumerate(recommendations):
+        indexes_by_key.setdefault(track_cache_key(recommendation), []).append(index)
+
+    pending = []
+    for key, indexes in indexes_by_key.items():
+        if track_cache is not None:
+            found, track_uri = track_cache.get(key)
+            if found:
+                for index in indexes:
+                    yield index, recommendations[index], track_uri
+                continue
+        pending.append(key)
+
+    if not pending:
+        return
+
+    spotify_client = get_spotify_client()
+    track_flight = get_track_flight()
+    max_workers = min(current_app.config["SPOTIFY_SEARCH_CONCURRENCY"], len(pending))
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        # Search with the first original spelling of each pending song
+        futures = {
+            executor.submit(
+                search_spotify_track_once,
+                spotify_client,
+                track_flight,
+                recommendations[indexes_by_key[key][0]],
+                headers,
+            ): key
+            for key in pending
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                track_uri = future.result()
+            except ValueError as e:
+                logger.warning("Could not resolve %r: %s", key, str(e))
+                counters.increment("spotify_search_errors")
+                track_uri = None
+            else:
+                if track_cache is not None:
+                    track_cache.set(key, track_uri)
+            for index in indexes_by_key[key]:
+                yield index, recommendations[index], track_uri
+
+
+def resolve_track_uris(recommendations, headers):
+    """
+    Resolve all recommended songs to Spotify track URIs concurrently.
+
+    The returned URIs keep the order of the recommendations; songs that could
+    not be found are skipped.
+    """
+    track_uris = [None] * len(recommendations)
+    for index, _, track_uri in iter_resolved_tracks(recommendations, headers):
+        track_uris[index] = track_uri
+    return [track_uri for track_uri in track_uris if track_uri]
 
-    if not track_uris:
-        return {"error": "No tracks found."}
 
-    user_id = get_spotify_user_id(access_token)
+def create_spotify_playlist(access_token, headers, playlist_name, track_uris, user_id=None):
+    """
+    Create a private playlist for the user and add the tracks to it.
+
+    :param user_id: The Spotify user ID if already known, otherwise it is looked up with the token
+    :return: A (user_id, spotify_link) tuple, or an error dictionary if the playlist could not be created
+    """
+    if user_id is None:
+        user_id = get_spotify_user_id(access_token)
     playlist_url = f"https://api.spotify.com/v1/users/{user_id}/playlists"
-    playlist_name = recommendation_dict["Playlist name"]
     playlist_body = {
         "name": playlist_name,
         "description": "A playlist created by Mood Melody",
         "public": False,
     }
-    playlist_response = requests.post(playlist_url, json=playlist_body, headers=headers)
-
-    # Print the response from Spotify's API for debugging
-    print("Playlist Response:", playlist_response.json())
+    with timed("playlist_create"):
+        playlist_response = get_spotify_client().post(playlist_url, json=playlist_body, headers=headers)
 
     playlist_data = playlist_response.json()
+    upstream_logger.debug("Playlist response: %s", playlist_data)
     if "id" not in playlist_data:
         return {"error": "Failed to create playlist."}
 
-    playlist_id = playlist_response.json()["id"]
+    playlist_id = playlist_data["id"]
 
     add_tracks_url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
     add_tracks_body = {"uris": track_uris}
-    requests.post(add_tracks_url, json=add_tracks_body, headers=headers)
+    with timed("track_add"):
+        get_spotify_client().post(add_tracks_url, json=add_tracks_body, headers=headers)
 
     spotify_link_result = f"https://open.spotify.com/playlist/{playlist_id}"
 
     return user_id, spotify_link_result
 
 
+def spotify_playlist(recommendation_dict, session_id):
+    # Uncomment the following line to use a hardcoded token for testing
+    # access_token = SPOTIFY_ACCESS_TOKEN
+
+    token_info = get_user_context(session_id)
+    if not token_info:
+        return redirect(url_for("login", session_id=session_id))
+
+    # Uncomment the following line to use the token from the database
+    access_token = get_valid_access_token(session_id, token_info)
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+    }
+
+    # Wall time of all searches, the individual ones run on worker threads
+    with timed("track_resolution"):
+        track_uris = resolve_track_uris(recommendation_dict["Songs"], headers)
+
+    if not track_uris:
+        return {"error": "No tracks found."}
+
+    return create_spotify_playlist(
+        access_token,
+        headers,
+        recommendation_dict["Playlist name"],
+        track_uris,
+        user_id=token_info.get("spotify_user_id"),
+    )
+
+
+def fetch_playlist_tracks_page(spotify_client, playlist_id, headers, offset):
+    """
+    Fetch one page of a playlist's tracks, limited to the fields simplify_playlist_items uses.
+    """
+    playlist_tracks_url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
+    params = {
+        "offset": offset,
+        "limit": PLAYLIST_TRACKS_PAGE_SIZE,
+        "fields": PLAYLIST_TRACKS_FIELDS,
+    }
+    with timed("playlist_tracks_page"):
+        return spotify_client.get(playlist_tracks_url, headers=headers, params=params)
+
+
+def fetch_playlist_first_page(spotify_client, playlist_id, headers):
+    """
+    Fetch a playlist's snapshot id together with the first page of its tracks in one request.
+    """
+    playlist_url = f"https://api.spotify.com/v1/playlists/{playlist_id}"
+    with timed("playlist_first_page"):
+        return spotify_client.get(playlist_url, headers=headers, params={"fields": PLAYLIST_FIRST_PAGE_FIELDS})
+
+
+def simplify_playlist_items(tracks_data):
+    # Local files and removed tracks come back with an empty track
+    return [
+        {
+            "id": item["track"]["id"],
+            "name": item["track"]["name"],
+            "artist": item["track"]["artists"][0]["name"],
+            "album": item["track"]["album"]["name"],
+            "duration_ms": item["track"]["duration_ms"],
+            "preview_url": item["track"]["preview_url"]
+        }
+        for item in tracks_data["items"]
+        if item.get("track")
+    ]
+
+
+def set_playlist_cache_headers(response, etag):
+    """
+    Let the client keep the track list and revalidate it with If-None-Match.
+    """
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+
+
+def sse_event(event, data):
+    """
+    Format a Server-Sent Event with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    # g outlives the request when an app context was already pushed, as in tests
+    g.server_timing = {}
+    g.user_contexts = {}
+
+
+@bp.after_app_request
+def add_server_timing(response):
+    """
+    Report the timed stages in a Server-Timing header and record the request duration.
+
+    Streamed responses only report the stages that ran before their body started.
+    """
+    request_start = g.get("request_start")
+    if request_start is not None:
+        duration = time.perf_counter() - request_start
+        histograms.observe(
+            "request_duration_seconds",
+            duration,
+            labels={"endpoint": request.endpoint or "unknown", "status": response.status_code},
+        )
+        header = server_timing_header()
+        total = f"total;dur={duration * 1000:.1f}"
+        response.headers["Server-Timing"] = f"{header}, {total}" if header else total
+    current_app.extensions["metrics_snapshots"].maybe_write()
+    return response
+
+
+@bp.route("/metrics")
+def metrics():
+    """
+    Counters and latency histograms of all workers in the Prometheus text format.
+    """
+    counter_values, gauge_values, histogram_values = current_app.extensions["metrics_snapshots"].collect()
+    return Response(
+        render_prometheus(counter_values, histogram_values, gauge_values),
+        mimetype="text/plain; version=0.0.4",
+    )
+
+
 @bp.route("/")
 def welcome():
     return "Welcome to the Mood Melody Backend!"
@@ -340,13 +1161,16 @@ def check_openai():
 
 @bp.route("/recommend", methods=["POST"])
 def recommend():
-    print("call received")
+    # Clients that ask for an event stream get the streaming variant
+    if request.accept_mimetypes.best == "text/event-stream":
+        return recommend_stream()
+
     session_id = request.args.get("session_id")
     if not session_id:
         session_id = request.cookies.get("session_id")
     if not session_id:
         # return get_session_id()
-        print("there's no session id in the beginning of recommend")
+        logger.info("No session ID in /recommend request")
         return jsonify(
             {
                 "authorized": False,
@@ -355,8 +1179,7 @@ def recommend():
             }
         )
 
-    token_info = retrieve_user_info_from_db(session_id)
-    print("Token Info from recommend:", token_info)
+    token_info = get_user_context(session_id)
     if not token_info:
         return jsonify(
             {
@@ -370,21 +1193,21 @@ def recommend():
 
     data = request.json
     user_text = data["description"]
-    print("User Text:", user_text)
+    logger.info("Recommendation requested for: %s", user_text)
 
     # Get song recommendations and playlist name from OpenAI
     recommendation_dict = openai_recommendation(user_text)
 
     # Create Spotify playlist and get user ID
     user_id, spotify_link = spotify_playlist(recommendation_dict, session_id)
-    print("Spotify Link:", spotify_link)
+    logger.info("Created playlist %s", spotify_link)
 
     # Extract playlist ID from spotify_link
     playlist_id = spotify_link.split('/')[-1]
 
     # Save the search history using the helper function
     if spotify_link and not isinstance(spotify_link, dict):  # Ensure spotify_link is not an error dictionary
-        save_search_history(user_id, user_text, spotify_link)
+        record_search_history(user_id, user_text, spotify_link)
 
     return jsonify(
         {
@@ -397,6 +1220,246 @@ def recommend():
     )
 
 
+@bp.route("/recommend/stream", methods=["POST"])
+def recommend_stream():
+    """
+    Streaming variant of /recommend using Server-Sent Events.
+
+    The completion is streamed from OpenAI and parsed incrementally. Emits a
+    "playlist_name" event as soon as the name is parsed, a "song" event for
+    every song as soon as it is resolved to a Spotify URI, and a final "done"
+    event with the playlist link. Failures end the stream with an "error"
+    event.
+    """
+    session_id = request.args.get("session_id")
+    if not session_id:
+        session_id = request.cookies.get("session_id")
+    if not session_id:
+        return jsonify(
+            {
+                "authorized": False,
+                "message": "No session ID found, please log in to Spotify.",
+                "auth_url": url_for("main.login", _external=True),
+            }
+        )
+
+    token_info = get_user_context(session_id)
+    if not token_info:
+        return jsonify(
+            {
+                "authorized": False,
+                "message": "User not authorized, please log in to Spotify.",
+                "auth_url": url_for(
+                    "main.login", session_id=session_id, _external=True
+                ),
+            }
+        )
+
+    user_text = request.json["description"]
+
+    def generate():
+        try:
+            access_token = get_valid_access_token(session_id, token_info)
+            headers = {
+                "Authorization": f"Bearer {access_token}",
+                "Content-Type": "application/json",
+            }
+            spotify_client = get_spotify_client()
+            track_cache = get_track_cache() if current_app.config["TRACK_CACHE_ENABLED"] else None
+            track_flight = get_track_flight()
+            max_workers = max(current_app.config["SPOTIFY_SEARCH_CONCURRENCY"], 1)
+
+            playlist_name = None
+            songs = []
+            track_uris = []
+            futures = {}
+
+            def song_event(future):
+                index = futures.pop(future)
+                try:
+                    track_uris[index] = future.result()
+                except ValueError as e:
+                    # Skipped like a song that was not found, but not cached
+                    logger.warning("Could not resolve %r: %s", songs[index], str(e))
+                    counters.increment("spotify_search_errors")
+                return sse_event("song", {"index": index, "song": songs[index], "uri": track_uris[index]})
+
+            # Songs are searched on Spotify while the model is still generating the rest
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for event, value in iter_recommendation_events(user_text):
+                    if event == "playlist_name":
+                        playlist_name = value
+                        yield sse_event("playlist_name", {"playlist_name": playlist_name})
+                    else:
+                        futures[executor.submit(
+                            resolve_track_uri, spotify_client, track_cache, value, headers, track_flight
+                        )] = len(songs)
+                        songs.append(value)
+                        track_uris.append(None)
+
+                    for future in [future for future in futures if future.done()]:
+                        yield song_event(future)
+
+                for future in as_completed(list(futures)):
+                    yield song_event(future)
+
+            if playlist_name is None:
+                playlist_name = default_playlist_name(user_text)
+                yield sse_event("playlist_name", {"playlist_name": playlist_name})
+
+            track_uris = [track_uri for track_uri in track_uris if track_uri]
+            if not track_uris:
+                yield sse_event("error", {"error": "No tracks found."})
+                return
+
+            result = create_spotify_playlist(
+                access_token, headers, playlist_name, track_uris, user_id=token_info.get("spotify_user_id")
+            )
+            if isinstance(result, dict):
+                yield sse_event("error", result)
+                return
+
+            user_id, spotify_link = result
+            record_search_history(user_id, user_text, spotify_link)
+
+            yield sse_event(
+                "done",
+                {
+                    "authorized": True,
+                    "recommendation": songs,
+                    "spotify_link": spotify_link,
+                    "playlist_id": spotify_link.split("/")[-1],
+                    "user_id": user_id,
+                },
+            )
+
+        except Exception as e:
+            logger.error("Error in recommend_stream: %s", str(e))
+            yield sse_event("error", {"error": "An unexpected error occurred. Please try again later."})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@bp.route("/recommend/batch", methods=["POST"])
+def recommend_batch():
+    """
+    Create playlists for several descriptions in one request.
+
+    Recommendations come from one OpenAI completion where possible. Songs
+    shared between playlists are searched once, playlists are created
+    concurrently, and all history rows are written in one transaction. Each
+    description gets its own result or error.
+    """
+    session_id = request.args.get("session_id")
+    if not session_id:
+        session_id = request.cookies.get("session_id")
+    if not session_id:
+        return jsonify(
+            {
+                "authorized": False,
+                "message": "No session ID found, please log in to Spotify.",
+                "auth_url": url_for("main.login", _external=True),
+            }
+        )
+
+    token_info = get_user_context(session_id)
+    if not token_info:
+        return jsonify(
+            {
+                "authorized": False,
+                "message": "User not authorized, please log in to Spotify.",
+                "auth_url": url_for(
+                    "main.login", session_id=session_id, _external=True
+                ),
+            }
+        )
+
+    descriptions = (request.json or {}).get("descriptions")
+    if not isinstance(descriptions, list) or not descriptions or not all(
+        isinstance(description, str) and description.strip() for description in descriptions
+    ):
+        return jsonify({"error": "Please provide a non-empty list of descriptions."}), 400
+    if len(descriptions) > current_app.config["BATCH_MAX_DESCRIPTIONS"]:
+        return jsonify(
+            {"error": f"At most {current_app.config['BATCH_MAX_DESCRIPTIONS']} descriptions per batch."}
+        ), 400
+
+    recommendations = batch_openai_recommendations(descriptions)
+
+    access_token = get_valid_access_token(session_id, token_info)
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+    }
+
+    # One de-duplicated search pass for the songs of every playlist
+    all_songs = [
+        song for recommendation_dict in recommendations if recommendation_dict
+        for song in recommendation_dict["Songs"]
+    ]
+    track_uris_by_song = {}
+    for _, song, track_uri in iter_resolved_tracks(all_songs, headers):
+        track_uris_by_song[song] = track_uri
+
+    results = [{"description": description} for description in descriptions]
+    playlists_to_create = []
+    for index, recommendation_dict in enumerate(recommendations):
+        if recommendation_dict is None:
+            results[index]["error"] = "Unable to generate a recommendation. Please try again later."
+            continue
+        results[index]["recommendation"] = recommendation_dict["Songs"]
+        track_uris = [
+            track_uris_by_song[song] for song in recommendation_dict["Songs"] if track_uris_by_song.get(song)
+        ]
+        if not track_uris:
+            results[index]["error"] = "No tracks found."
+            continue
+        playlists_to_create.append((index, recommendation_dict["Playlist name"], track_uris))
+
+    user_id = token_info.get("spotify_user_id")
+    if playlists_to_create and not user_id:
+        try:
+            user_id = get_spotify_user_id(access_token)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    app = current_app._get_current_object()
+
+    def create_playlist(playlist):
+        index, playlist_name, track_uris = playlist
+        with app.app_context():
+            try:
+                return index, create_spotify_playlist(access_token, headers, playlist_name, track_uris, user_id=user_id)
+            except Exception as e:
+                logger.error("Failed to create batch playlist: %s", str(e))
+                return index, {"error": "Failed to create playlist."}
+
+    history_entries = []
+    if playlists_to_create:
+        max_workers = min(current_app.config["SPOTIFY_SEARCH_CONCURRENCY"], len(playlists_to_create))
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            for index, result in executor.map(create_playlist, playlists_to_create):
+                if isinstance(result, dict):
+                    results[index]["error"] = result["error"]
+                    continue
+                _, spotify_link = result
+                results[index]["spotify_link"] = spotify_link
+                results[index]["playlist_id"] = spotify_link.split("/")[-1]
+                history_entries.append((user_id, descriptions[index], spotify_link))
+
+    try:
+        save_search_history_batch(history_entries)
+    except Exception as e:
+        db.session.rollback()
+        logger.error("Failed to save batch search history: %s", str(e))
+
+    return jsonify({"authorized": True, "user_id": user_id, "results": results})
+
+
 @bp.route("/auth/login", methods=["GET"])
 def login():
     scope = [
@@ -437,10 +1500,10 @@ def callback():
             "redirect_uri": SPOTIFY_REDIRECT_URI,
         }
 
-        response = requests.post(token_url, headers=headers, data=data)
+        with timed("token_exchange"):
+            response = get_spotify_client().post(token_url, headers=headers, data=data)
         
-        logger.info("Token request response status: %s", response.status_code)
-        logger.info("Token request response text: %s", response.text)
+        upstream_logger.info("Token request response status: %s", response.status_code)
 
         if response.status_code != 200:
             logger.error("Failed to get token: %s", response.text)
@@ -457,6 +1520,7 @@ def callback():
         token_info = {
             "access_token": response_data["access_token"],
             "refresh_token": response_data["refresh_token"],
+            "expires_in": response_data.get("expires_in"),
         }
 
         # Get the Spotify user ID
@@ -468,8 +1532,9 @@ def callback():
             except ValueError as e:
                 if str(e) == "Access token expired" and attempt < max_retries - 1:
                     # Try refreshing the token
-                    new_access_token = refresh_spotify_token(token_info["refresh_token"])
-                    token_info["access_token"] = new_access_token
+                    new_token_info = request_token_refresh(token_info["refresh_token"])
+                    token_info["access_token"] = new_token_info["access_token"]
+                    token_info["expires_in"] = new_token_info.get("expires_in")
                 else:
                     raise
         else:
@@ -482,7 +1547,6 @@ def callback():
 
         store_tokens_in_db(session_id, token_info, spotify_user_id)
 
-        logger.info("Access Token: %s", token_info["access_token"])
         logger.info("Authorization successful! You can now use Spotify API.")
 
         react_app_url = f"{REACT_APP_URL}/home?session_id={session_id}"
@@ -524,7 +1588,7 @@ def get_history():
             return jsonify({"error": "No session ID found."}), 401
 
         try:
-            user_info = retrieve_user_info_from_db(session_id)
+            user_info = get_user_context(session_id)
         except Exception as e:
             logger.error(f"Error retrieving user info: {str(e)}")
             return jsonify({"error": "An error occurred while retrieving user information."}), 500
@@ -532,19 +1596,33 @@ def get_history():
         if not user_info:
             return jsonify({"error": "User not authorized."}), 401
 
-        user_id = user_info["spotify_user_id"]
-        history = (
-            SearchHistory.query.filter_by(spotify_user_id=user_id)
-            .order_by(SearchHistory.timestamp.desc())
-            .limit(10)  # Fetch the latest 10 records
-            .all()
-        )
+        # Without paging parameters the latest 10 entries are returned as a plain list
+        paginated = "limit" in request.args or "cursor" in request.args
+        try:
+            limit = int(request.args.get("limit", 10))
+            cursor = decode_history_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+        except (ValueError, TypeError):
+            return jsonify({"error": "Invalid limit or cursor."}), 400
+        limit = max(1, min(limit, current_app.config["HISTORY_MAX_PAGE_SIZE"]))
 
-        return jsonify([{
+        # One extra row tells whether there is a next page
+        history = history_page_query(user_info["spotify_user_id"], cursor, limit + 1).all()
+
+        items = [{
             "description": entry.search_query,
             "spotifyLink": entry.spotify_link,
             "timestamp": entry.timestamp.isoformat()
-        } for entry in history])
+        } for entry in history[:limit]]
+
+        if not paginated:
+            return jsonify(items)
+
+        next_cursor = None
+        if len(history) > limit:
+            last_entry = history[limit - 1]
+            next_cursor = encode_history_cursor(last_entry.timestamp, last_entry.id)
+
+        return jsonify({"items": items, "next_cursor": next_cursor})
 
     except Exception as e:
         logger.error(f"Error in get_history: {str(e)}")
@@ -557,36 +1635,96 @@ def get_playlist_tracks(playlist_id):
     if not session_id:
         return jsonify({"error": "No session ID found."}), 401
 
-    token_info = retrieve_user_info_from_db(session_id)
+    token_info = get_user_context(session_id)
     if not token_info:
         return jsonify({"error": "User not authorized."}), 401
 
-    access_token = token_info["access_token"]
+    access_token = get_valid_access_token(session_id, token_info)
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
     }
 
-    playlist_tracks_url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
-    response = requests.get(playlist_tracks_url, headers=headers)
+    spotify_client = get_spotify_client()
 
+    # The snapshot id changes whenever the playlist does, it versions both the
+    # ETag sent to the client and our cache of the track list
+    response = fetch_playlist_first_page(spotify_client, playlist_id, headers)
     if response.status_code != 200:
         return jsonify({"error": "Failed to fetch playlist tracks."}), response.status_code
-
-    tracks_data = response.json()
-    simplified_tracks = [
-        {
-            "id": item["track"]["id"],
-            "name": item["track"]["name"],
-            "artist": item["track"]["artists"][0]["name"],
-            "album": item["track"]["album"]["name"],
-            "duration_ms": item["track"]["duration_ms"],
-            "preview_url": item["track"]["preview_url"]
-        }
-        for item in tracks_data["items"]
-    ]
-
-    return jsonify({"items": simplified_tracks})
+    playlist_data = response.json()
+    snapshot_id = playlist_data.get("snapshot_id")
+
+    playlist_cache = None
+    if snapshot_id:
+        etag = f"{playlist_id}:{snapshot_id}"
+        if request.if_none_match.contains(etag):
+            counters.increment("playlist_tracks_not_modified")
+            response = make_response("", 304)
+            response.set_etag(etag)
+            return response
+
+        if current_app.config["PLAYLIST_CACHE_ENABLED"]:
+            playlist_cache = get_playlist_cache()
+            found, cached_tracks = playlist_cache.get(etag)
+            if found:
+                response = jsonify({"items": cached_tracks})
+                set_playlist_cache_headers(response, etag)
+                return response
+
+    tracks_data = playlist_data.get("tracks") or {"items": []}
+    first_page = simplify_playlist_items(tracks_data)
+    # All remaining pages are requested at once as soon as the total is known
+    offsets = range(PLAYLIST_TRACKS_PAGE_SIZE, tracks_data.get("total", 0), PLAYLIST_TRACKS_PAGE_SIZE)
+    max_workers = max(min(current_app.config["SPOTIFY_PAGE_CONCURRENCY"], len(offsets)), 1)
+
+    def generate():
+        # Stream the JSON document page by page instead of building it in memory
+        tracks = list(first_page)
+        yield '{"items": ['
+        separator = ""
+        for track in first_page:
+            yield separator + json.dumps(track)
+            separator = ", "
+
+        error = None
+        if offsets:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                pages = executor.map(
+                    lambda offset: fetch_playlist_tracks_page(spotify_client, playlist_id, headers, offset),
+                    offsets,
+                )
+                try:
+                    for page_response in pages:
+                        if page_response.status_code != 200:
+                            logger.error("Failed to fetch playlist tracks page: %s", page_response.text)
+                            error = "Failed to fetch all playlist tracks."
+                            break
+                        for track in simplify_playlist_items(page_response.json()):
+                            tracks.append(track)
+                            yield separator + json.dumps(track)
+                            separator = ", "
+                except Exception as e:
+                    # The status line is already sent, report the failure in the body
+                    logger.error("Error fetching playlist tracks page: %s", str(e))
+                    error = "Failed to fetch all playlist tracks."
+
+        if error:
+            yield f'], "error": {json.dumps(error)}}}'
+            return
+
+        if playlist_cache is not None:
+            playlist_cache.set(etag, tracks)
+        yield "]}"
+
+    response = Response(stream_with_context(generate()), mimetype="application/json")
+    if snapshot_id and not offsets:
+        set_playlist_cache_headers(response, etag)
+    else:
+        # The headers go out before the remaining pages are fetched, so the body
+        # may end up partial. The next request gets the ETag from the cache.
+        response.headers["Cache-Control"] = "no-store"
+    return response
 
 
 @bp.route("/get_access_token", methods=["GET"])
@@ -595,8 +1733,8 @@ def get_access_token():
     if not session_id:
         return jsonify({"error": "No session ID found."}), 401
 
-    token_info = retrieve_user_info_from_db(session_id)
+    token_info = get_user_context(session_id)
     if not token_info:
         return jsonify({"error": "User not authorized."}), 401
 
-    return jsonify({"access_token": token_info["access_token"]})
\ No newline at end of file
+    return jsonify({"access_token": get_valid_access_token(session_id, token_info)})
\ No newline at end of file
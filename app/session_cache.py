@@ -0,0 +1,140 @@
+import logging
+import os
+import threading
+
+import redis
+
+from .cache import LRUCache
+from .metrics import counters
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "moodmelody:session-invalidations"
+
+
+class SessionCache:
+    """
+    Per-process cache of session_id -> user info in front of the users table.
+
+    Entries live for at most ttl seconds and are dropped by invalidate()
+    whenever the session's row is written. With a Redis client the
+    invalidation is also published, and every worker's subscriber thread
+    drops its own copy, so peers do not serve the old tokens for a whole TTL.
+    Only invalidations go through Redis, the tokens stay in the process.
+    """
+
+    def __init__(self, maxsize, ttl, redis_client=None, channel=INVALIDATION_CHANNEL):
+        self.local = LRUCache(maxsize, ttl)
+        self.redis = redis_client
+        self.channel = channel
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._subscriber = None
+        self._stopping = threading.Event()
+        self._pid = None
+
+    @property
+    def generation(self):
+        """
+        Changes with every invalidation, pass it to set() to detect a row read before a write.
+        """
+        return self._generation
+
+    def get(self, session_id):
+        """
+        :return: A (found, user_info) tuple, user_info is a copy the caller may change
+        """
+        self._ensure_subscriber()
+        found, user_info = self.local.get(session_id)
+        if found:
+            counters.increment("session_cache_hits")
+            return True, dict(user_info)
+        counters.increment("session_cache_misses")
+        return False, None
+
+    def set(self, session_id, user_info, generation):
+        """
+        Cache user_info unless the session was invalidated since generation was read.
+        """
+        with self._lock:
+            if generation != self._generation:
+                return
+            self.local.set(session_id, dict(user_info))
+
+    def _drop(self, session_id):
+        with self._lock:
+            self._generation += 1
+            self.local.delete(session_id)
+
+    def invalidate(self, session_id):
+        self._drop(session_id)
+        counters.increment("session_cache_invalidations")
+        if self.redis is not None:
+            try:
+                self.redis.publish(self.channel, session_id)
+            except redis.RedisError as e:
+                logger.warning("Failed to publish session invalidation: %s", str(e))
+
+    def _ensure_subscriber(self):
+        # Started by the process that serves requests, so every forked worker gets its own
+        if self.redis is None or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stopping.clear()
+            self._subscriber = threading.Thread(
+                target=self._listen, name="session-cache-invalidations", daemon=True
+            )
+            self._subscriber.start()
+            self._pid = os.getpid()
+
+    def _listen(self):
+        while not self._stopping.is_set():
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                while not self._stopping.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        session_id = message["data"]
+                        if isinstance(session_id, bytes):
+                            session_id = session_id.decode()
+                        self._drop(session_id)
+            except redis.RedisError as e:
+                logger.warning("Session invalidation subscriber disconnected: %s", str(e))
+                # Invalidations published meanwhile are lost, forget everything instead
+                with self._lock:
+                    self._generation += 1
+                    self.local.clear()
+                self._stopping.wait(1.0)
+            finally:
+                try:
+                    pubsub.close()
+                except redis.RedisError:
+                    pass
+
+    def stop(self):
+        """
+        Stop this process's subscriber thread.
+        """
+        with self._lock:
+            subscriber = self._subscriber if self._pid == os.getpid() else None
+            self._subscriber = None
+            self._pid = None
+        self._stopping.set()
+        if subscriber is not None:
+            subscriber.join(timeout=2)
+
+
+def init_session_cache(app):
+    """
+    Create the session cache, publishing invalidations through Redis when
+    SESSION_CACHE_PUBSUB is on and REDIS_URL is set.
+    """
+    redis_client = app.extensions["redis"] if app.config["SESSION_CACHE_PUBSUB"] else None
+    app.extensions["session_cache"] = SessionCache(
+        maxsize=app.config["SESSION_CACHE_MAXSIZE"],
+        ttl=app.config["SESSION_CACHE_TTL"],
+        redis_client=redis_client,
+    )
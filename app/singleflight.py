@@ -0,0 +1,130 @@
+import json
+import logging
+import threading
+from concurrent.futures import Future
+
+import redis
+
+from .metrics import counters
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Runs concurrent calls for the same key once and shares the result.
+
+    Threads of the same worker that ask for a key already in flight wait for
+    the running call instead of starting their own. When a Redis client is
+    given, workers also serialize on a Redis lock per key: the holder
+    publishes its result for lock_timeout seconds, and a worker that had to
+    wait for the lock reuses that result instead of repeating the work.
+    Only JSON serializable results are shared across workers; Redis failures
+    are logged and the call simply runs locally.
+    """
+
+    def __init__(self, name, redis_client=None, lock_timeout=30):
+        self.name = name
+        self.redis = redis_client
+        self.lock_timeout = lock_timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """
+        Call fn() unless a call for the same key is already running, then wait for that one.
+
+        :return: The result of fn(), shared by every concurrent caller with the key
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+
+        if not leader:
+            counters.increment(f"{self.name}_singleflight_shared")
+            return call.result()
+
+        try:
+            result = self._call(key, fn)
+        except BaseException as e:
+            with self._lock:
+                del self._calls[key]
+            call.set_exception(e)
+            raise
+        with self._lock:
+            del self._calls[key]
+        call.set_result(result)
+        return result
+
+    def _redis_key(self, key):
+        return f"moodmelody:singleflight:{self.name}:{key}"
+
+    def _call(self, key, fn):
+        if self.redis is None:
+            return fn()
+
+        redis_lock = None
+        try:
+            redis_lock = self.redis.lock(
+                self._redis_key(key) + ":lock",
+                timeout=self.lock_timeout,
+                blocking_timeout=self.lock_timeout,
+            )
+            if not redis_lock.acquire(blocking=False):
+                # Another worker is doing the same work, wait for it and reuse its result
+                if not redis_lock.acquire():
+                    redis_lock = None
+                else:
+                    raw_result = self.redis.get(self._redis_key(key))
+                    if raw_result is not None:
+                        counters.increment(f"{self.name}_singleflight_shared")
+                        self._release(redis_lock)
+                        return json.loads(raw_result)["value"]
+        except redis.RedisError as e:
+            logger.warning("Redis single-flight lock unavailable for %s: %s", self.name, str(e))
+            redis_lock = None
+
+        try:
+            result = fn()
+            if redis_lock is not None:
+                self._publish(key, result)
+            return result
+        finally:
+            if redis_lock is not None:
+                self._release(redis_lock)
+
+    def _release(self, redis_lock):
+        try:
+            redis_lock.release()
+        except redis.RedisError as e:
+            # The lock expires on its own after lock_timeout
+            logger.warning("Failed to release single-flight lock for %s: %s", self.name, str(e))
+
+    def _publish(self, key, result):
+        try:
+            raw_result = json.dumps({"value": result})
+        except TypeError:
+            return
+        try:
+            self.redis.set(self._redis_key(key), raw_result, ex=max(int(self.lock_timeout), 1))
+        except redis.RedisError as e:
+            logger.warning("Redis single-flight publish failed for %s: %s", self.name, str(e))
+
+
+def init_single_flights(app):
+    """
+    Create the single-flight groups for recommendations and track searches, if enabled.
+    """
+    recommendation_flight = track_flight = None
+    if app.config["SINGLE_FLIGHT_ENABLED"]:
+        redis_client = app.extensions.get("redis") if app.config["SINGLE_FLIGHT_DISTRIBUTED"] else None
+        recommendation_flight = SingleFlight(
+            "recommendation", redis_client=redis_client, lock_timeout=app.config["SINGLE_FLIGHT_TIMEOUT"]
+        )
+        track_flight = SingleFlight(
+            "track", redis_client=redis_client, lock_timeout=app.config["SINGLE_FLIGHT_TIMEOUT"]
+        )
+    app.extensions["recommendation_flight"] = recommendation_flight
+    app.extensions["track_flight"] = track_flight
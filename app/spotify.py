@@ -0,0 +1,82 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .metrics import counters
+
+
+def count_spotify_response(response, *args, **kwargs):
+    counters.increment("upstream_responses", labels={"upstream": "spotify", "status": response.status_code})
+
+
+class SpotifyClient:
+    """
+    Thin wrapper around a pooled requests.Session used for every Spotify call.
+
+    Connections to api.spotify.com and accounts.spotify.com are kept alive and
+    reused between requests, every call gets a default (connect, read) timeout,
+    and transient failures are retried at the transport level.
+    """
+
+    def __init__(
+        self,
+        pool_connections=4,
+        pool_maxsize=16,
+        connect_timeout=3.05,
+        read_timeout=10,
+        max_retries=2,
+        backoff_factor=0.3,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+
+        # Connection errors are retried for every method, but status based
+        # retries are limited to GET so a playlist is never created twice.
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        # pool_maxsize caps the open connections per host, pool_block makes
+        # extra threads wait for a free connection instead of opening more.
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=retry,
+            pool_block=True,
+        )
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.hooks["response"].append(count_spotify_response)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def init_spotify_client(app):
+    """
+    Create the Spotify client for the app from its configuration.
+    """
+    app.extensions["spotify_client"] = SpotifyClient(
+        pool_connections=app.config["SPOTIFY_POOL_CONNECTIONS"],
+        pool_maxsize=app.config["SPOTIFY_POOL_MAXSIZE"],
+        connect_timeout=app.config["SPOTIFY_CONNECT_TIMEOUT"],
+        read_timeout=app.config["SPOTIFY_READ_TIMEOUT"],
+        max_retries=app.config["SPOTIFY_MAX_RETRIES"],
+    )
+    return app.extensions["spotify_client"]
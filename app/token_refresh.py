@@ -0,0 +1,86 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshCoordinator:
+    """
+    Makes sure only one access token refresh per session is in flight.
+
+    Threads of the same worker wait on a per-session lock. Across workers and
+    nodes a Redis lock is used when Redis is configured; lock() reports
+    whether it got one so the caller can fall back to a row lock on the
+    users table otherwise. Whoever gets the lock second should re-read the
+    session and reuse the token the first holder stored.
+    """
+
+    def __init__(self, redis_client=None, lock_timeout=10, wait_timeout=10):
+        self.redis = redis_client
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self._locks_lock = threading.Lock()
+        self._locks = {}
+
+    def _local_lock(self, session_id):
+        with self._locks_lock:
+            lock = self._locks.get(session_id)
+            if lock is None:
+                lock = self._locks[session_id] = [threading.Lock(), 0]
+            lock[1] += 1
+            return lock
+
+    def _release_local_lock(self, session_id, lock):
+        with self._locks_lock:
+            lock[1] -= 1
+            if lock[1] == 0:
+                del self._locks[session_id]
+
+    @contextmanager
+    def lock(self, session_id):
+        """
+        Hold the refresh lock for the session.
+
+        :return: A context manager yielding True if a cross-process (Redis) lock is held
+        """
+        local_lock = self._local_lock(session_id)
+        try:
+            with local_lock[0]:
+                redis_lock = None
+                if self.redis is not None:
+                    try:
+                        redis_lock = self.redis.lock(
+                            f"moodmelody:token-refresh:{session_id}",
+                            timeout=self.lock_timeout,
+                            blocking_timeout=self.wait_timeout,
+                        )
+                        if not redis_lock.acquire():
+                            logger.warning("Timed out waiting for the token refresh lock of session %s", session_id)
+                            redis_lock = None
+                    except redis.RedisError as e:
+                        logger.warning("Redis token refresh lock unavailable: %s", str(e))
+                        redis_lock = None
+
+                try:
+                    yield redis_lock is not None
+                finally:
+                    if redis_lock is not None:
+                        try:
+                            redis_lock.release()
+                        except redis.RedisError as e:
+                            # The lock expires on its own after lock_timeout
+                            logger.warning("Failed to release token refresh lock: %s", str(e))
+        finally:
+            self._release_local_lock(session_id, local_lock)
+
+
+def init_refresh_coordinator(app):
+    app.extensions["refresh_coordinator"] = RefreshCoordinator(
+        redis_client=app.extensions.get("redis"),
+        lock_timeout=app.config["TOKEN_REFRESH_LOCK_TIMEOUT"],
+        wait_timeout=app.config["TOKEN_REFRESH_LOCK_TIMEOUT"],
+    )
+    return app.extensions["refresh_coordinator"]
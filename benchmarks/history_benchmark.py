@@ -0,0 +1,146 @@
+"""
+Seed a large search_history table and time the first and a deep page of
+/history with and without the composite (spotify_user_id, timestamp DESC,
+id DESC) index.
+
+Usage:
+    python benchmarks/history_benchmark.py [--rows 200000] [--users 2000] [--requests 200]
+
+A temporary SQLite database is used unless SQLALCHEMY_BENCH_DATABASE_URI is
+set, e.g. to a scratch Postgres database (its tables are dropped afterwards).
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The app refuses to start without these, the benchmark never calls OpenAI
+os.environ.setdefault("FLASK_SECRET_KEY", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from sqlalchemy import insert, text  # noqa: E402
+
+from app import create_app  # noqa: E402
+from app.db import db  # noqa: E402
+from app.models import SearchHistory, User  # noqa: E402
+from app.routes import encode_history_cursor, history_page_query  # noqa: E402
+
+HISTORY_INDEX = "ix_search_history_spotify_user_id_timestamp_id"
+BENCH_SESSION_ID = "bench_session"
+BENCH_USER_ID = "bench_user_0"
+
+
+def seed(rows, users):
+    db.session.add(
+        User(
+            session_id=BENCH_SESSION_ID,
+            access_token="bench_access",
+            refresh_token="bench_refresh",
+            spotify_user_id=BENCH_USER_ID,
+        )
+    )
+    now = datetime.now()
+    batch = []
+    for i in range(rows):
+        batch.append(
+            {
+                "spotify_user_id": f"bench_user_{i % users}",
+                "search_query": f"benchmark query {i}",
+                "timestamp": now - timedelta(seconds=i),
+                "spotify_link": f"https://open.spotify.com/playlist/bench{i}",
+            }
+        )
+        if len(batch) == 10000:
+            db.session.execute(insert(SearchHistory), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(SearchHistory), batch)
+    db.session.commit()
+
+
+def deep_cursor():
+    """
+    The cursor of the page before the bench user's last one.
+    """
+    entries = history_page_query(BENCH_USER_ID, None, 1000).all()
+    last_entry = entries[-11]
+    return last_entry.timestamp, last_entry.id
+
+
+def query_plan(cursor):
+    # The query /history runs, limit + 1 rows
+    query = history_page_query(BENCH_USER_ID, cursor, 11)
+    sql = str(query.statement.compile(db.engine, compile_kwargs={"literal_binds": True}))
+    explain = "EXPLAIN QUERY PLAN " if db.engine.dialect.name == "sqlite" else "EXPLAIN "
+    rows = db.session.execute(text(explain + sql)).fetchall()
+    return "\n".join("    " + " ".join(str(column) for column in row) for row in rows)
+
+
+def time_history(test_client, requests, cursor):
+    url = f"/history?session_id={BENCH_SESSION_ID}"
+    if cursor:
+        url += f"&limit=10&cursor={encode_history_cursor(*cursor)}"
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = test_client.get(url)
+        timings.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200, response.get_data(as_text=True)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    database_dir = tempfile.mkdtemp()
+    database_uri = os.getenv(
+        "SQLALCHEMY_BENCH_DATABASE_URI", f"sqlite:///{os.path.join(database_dir, 'bench.db')}"
+    )
+    app = create_app(
+        {
+            "TESTING": True,
+            "OPENAI_API_KEY": os.environ["OPENAI_API_KEY"],
+            "SQLALCHEMY_DATABASE_URI": database_uri,
+        }
+    )
+
+    with app.app_context():
+        db.create_all()
+        try:
+            print(f"Seeding {args.rows} history rows for {args.users} users ...")
+            seed(args.rows, args.users)
+            index = next(i for i in SearchHistory.__table__.indexes if i.name == HISTORY_INDEX)
+            test_client = app.test_client()
+            pages = [("first page", None), ("deep page", deep_cursor())]
+            db.session.remove()
+
+            index.drop(bind=db.engine)
+            db.session.remove()
+            for label, cursor in pages:
+                print(f"Without index, {label} plan:\n" + query_plan(cursor))
+                median, p95 = time_history(test_client, args.requests, cursor)
+                print(f"  /history median {median:.2f} ms, p95 {p95:.2f} ms")
+
+            index.create(bind=db.engine)
+            db.session.remove()
+            for label, cursor in pages:
+                print(f"With index, {label} plan:\n" + query_plan(cursor))
+                median, p95 = time_history(test_client, args.requests, cursor)
+                print(f"  /history median {median:.2f} ms, p95 {p95:.2f} ms")
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Measure how long a fresh process needs to import the app, create it and
+answer its first request.
+
+Usage:
+    python benchmarks/startup_benchmark.py [--runs 20]
+
+Every run is a new Python process so nothing is already imported or cached
+in memory. The app is created with its production configuration (an
+in-memory SQLite database unless SQLALCHEMY_DATABASE_URI is set) and the
+first request is a GET / through the Flask test client.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RUN_SCRIPT = """
+import json
+import time
+
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app = app.create_app()
+created = time.perf_counter()
+response = flask_app.test_client().get("/")
+assert response.status_code == 200
+first_request = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "create_app": created - imported,
+    "first_request": first_request - start,
+}))
+"""
+
+
+def run_once():
+    env = dict(os.environ)
+    # The app refuses to start without these, the benchmark never calls OpenAI
+    env.setdefault("FLASK_SECRET_KEY", "benchmark")
+    env.setdefault("OPENAI_API_KEY", "benchmark")
+    env.setdefault("LOG_LEVEL", "WARNING")
+    env.setdefault("SQLALCHEMY_DATABASE_URI", "sqlite://")
+    output = subprocess.run(
+        [sys.executable, "-c", RUN_SCRIPT], cwd=REPO_ROOT, env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    # Warm the OS file cache and the bytecode cache first
+    run_once()
+    results = [run_once() for _ in range(args.runs)]
+
+    print(f"{'Phase':<28}{'Median':>10}{'p95':>10}")
+    for phase, label in (
+        ("import", "import app"),
+        ("create_app", "create_app()"),
+        ("first_request", "start to first response"),
+    ):
+        timings = sorted(result[phase] * 1000 for result in results)
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        print(f"{label:<28}{statistics.median(timings):>8.1f}ms{p95:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Gunicorn configuration for the Mood Melody backend.
+
+    gunicorn -c gunicorn.conf.py "app:create_app()"
+
+A recommendation spends almost all of its time waiting for OpenAI and
+Spotify, so every worker serves several requests at once: with threads
+(gthread, the default) or with greenlets (GUNICORN_WORKER_CLASS=gevent,
+requires `pip install gevent`). All settings can be overridden from the
+environment, see env_sample.md.
+"""
+import glob
+import multiprocessing
+import os
+import tempfile
+
+
+def env_bool(name, default):
+    return os.getenv(name, str(default)).lower() == "true"
+
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+# Heroku sets WEB_CONCURRENCY from the dyno size
+workers = int(os.getenv("WEB_CONCURRENCY", max(multiprocessing.cpu_count(), 2)))
+# Concurrent requests per gthread worker
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+# Concurrent requests per gevent worker
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", 100))
+
+# Import the app once in the master and fork it, post_fork gives every
+# worker its own connections. gevent patches the standard library only in
+# the worker, after a preloaded app would already have created its locks
+# and sockets, so preloading is off by default there.
+preload_app = env_bool("GUNICORN_PRELOAD", worker_class != "gevent")
+
+# An OpenAI call may take OPENAI_READ_TIMEOUT (30s) plus retries, followed
+# by the Spotify calls; the timeout must not kill a worker in the middle of that.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 90))
+# Time for in-flight recommendations to finish on restarts and deploys,
+# Heroku sends SIGKILL 30 seconds after SIGTERM
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 25))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+# Recycle workers now and then so slow leaks do not accumulate
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 200))
+
+# Let /metrics add up every worker, unless a directory was configured already.
+# Snapshots of exited workers are folded into one file by child_exit.
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), "moodmelody-metrics"))
+
+
+def on_starting(server):
+    # Snapshots of a previous master's workers would be added to the new totals
+    for path in glob.glob(os.path.join(os.environ["METRICS_DIR"], "*.json")):
+        os.remove(path)
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from app.lifecycle import reset_after_fork
+
+        reset_after_fork(server.app.wsgi())
+
+
+def child_exit(server, worker):
+    # Runs in the master, also for workers that were killed
+    from app.metrics import retire_worker_snapshots
+
+    retire_worker_snapshots(os.environ["METRICS_DIR"], worker.pid)
+
+
+def worker_exit(server, worker):
+    flask_app = getattr(worker, "wsgi", None)
+    if flask_app is not None:
+        from app.lifecycle import shutdown
+
+        shutdown(flask_app)
@@ -0,0 +1,33 @@
+"""Add composite index for search history lookups
+
+Revision ID: 4f2d8c1e7a90
+Revises: eae2d2c27f49
+Create Date: 2026-10-18 10:12:31.418204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f2d8c1e7a90'
+down_revision = 'eae2d2c27f49'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # /history filters on spotify_user_id and orders by timestamp DESC, so the
+    # index serves both and the latest rows are read without a sort.
+    # users.session_id already has an index through its unique constraint.
+    with op.batch_alter_table('search_history', schema=None) as batch_op:
+        batch_op.create_index(
+            'ix_search_history_spotify_user_id_timestamp',
+            [sa.column('spotify_user_id'), sa.column('timestamp').desc()],
+            unique=False,
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('search_history', schema=None) as batch_op:
+        batch_op.drop_index('ix_search_history_spotify_user_id_timestamp')
@@ -0,0 +1,38 @@
+"""Add id to the search history lookup index
+
+Revision ID: c3d9a6f1b284
+Revises: b7e31a5c9d42
+Create Date: 2026-10-18 15:45:12.530871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3d9a6f1b284'
+down_revision = 'b7e31a5c9d42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # /history pages with a (timestamp, id) cursor and orders by both, with
+    # id in the index deep pages are a range scan without a sort as well.
+    with op.batch_alter_table('search_history', schema=None) as batch_op:
+        batch_op.create_index(
+            'ix_search_history_spotify_user_id_timestamp_id',
+            [sa.column('spotify_user_id'), sa.column('timestamp').desc(), sa.column('id').desc()],
+            unique=False,
+        )
+        batch_op.drop_index('ix_search_history_spotify_user_id_timestamp')
+
+
+def downgrade():
+    with op.batch_alter_table('search_history', schema=None) as batch_op:
+        batch_op.create_index(
+            'ix_search_history_spotify_user_id_timestamp',
+            [sa.column('spotify_user_id'), sa.column('timestamp').desc()],
+            unique=False,
+        )
+        batch_op.drop_index('ix_search_history_spotify_user_id_timestamp_id')
@@ -3,8 +3,8 @@ import os
 from dotenv import load_dotenv
 import pytest
 from app import create_app
-import requests
 from unittest.mock import patch
+from flask import has_app_context
 from app import db
 
 # Load environment variables from .env file
@@ -15,10 +15,19 @@ load_dotenv()
 def client():
     test_config = {
         "TESTING": True,
-        "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY"),
+        # Tests never reach OpenAI, but building the client needs a key
+        "OPENAI_API_KEY": "test-key",
         "SQLALCHEMY_DATABASE_URI": os.getenv(
             "SQLALCHEMY_TEST_DATABASE_URI", "sqlite:///:memory:"
         ),  # Default to in-memory SQLite if not set
+        # Caches outlive a single test, tests that need them enable them explicitly
+        "TRACK_CACHE_ENABLED": False,
+        "RECOMMENDATION_CACHE_ENABLED": False,
+        "PLAYLIST_CACHE_ENABLED": False,
+        "SESSION_CACHE_ENABLED": False,
+        # Write history synchronously so tests can assert on it right away
+        "HISTORY_WRITE_BEHIND": False,
+        "REDIS_URL": None,
     }
     app = create_app(test_config)
 
@@ -34,8 +43,10 @@ def client():
 @pytest.fixture(autouse=True)
 def cleanup():
     yield
-    db.session.rollback()
-    db.session.remove()
+    # Tests of plain helpers run without the app context
+    if has_app_context():
+        db.session.rollback()
+        db.session.remove()
 
 
 @pytest.fixture
@@ -69,9 +80,28 @@ def mock_openai(monkeypatch):
                 "total_tokens": 175,
             }
 
+    class MockChoiceDelta:
+        def __init__(self, content):
+            self.content = content
+
+    class MockChunkChoice:
+        def __init__(self, content):
+            self.index = 0
+            self.delta = MockChoiceDelta(content)
+
+    class MockChatCompletionChunk:
+        def __init__(self, content):
+            self.choices = [MockChunkChoice(content)]
+
     class MockCompletions:
         def create(self, *args, **kwargs):
             message_content = "{ 'Playlist name': 'MMCat Tunes', 'Songs': ['The Cat Came Back by Fred Penner', 'Stray Cat Strut by Stray Cats', 'Everybody Wants to Be a Cat by Phil Harris'] }"
+            if kwargs.get("stream"):
+                # Stream the completion in small pieces like the API does
+                return iter(
+                    MockChatCompletionChunk(message_content[i:i + 7])
+                    for i in range(0, len(message_content), 7)
+                )
             choices = [MockChoice(message_content)]
             return MockChatCompletion(choices)
 
@@ -93,24 +123,31 @@ def mock_spotify_user_id():
     return "mock_user_id"
 
 @pytest.fixture
-def mock_spotify(monkeypatch, mock_spotify_user_id):
+def spotify_client(client):
+    # The app's pooled Spotify client, patch its get/post to fake Spotify responses
+    return client.application.extensions["spotify_client"]
+
+@pytest.fixture
+def mock_spotify(monkeypatch, mock_spotify_user_id, spotify_client):
     # Mock get_spotify_user_id
     def mock_get_spotify_user_id(access_token):
         return mock_spotify_user_id
 
     monkeypatch.setattr("app.routes.get_spotify_user_id", mock_get_spotify_user_id)
 
-    # Mock requests.get
-    def mock_requests_get(url, headers):
+    # Mock the Spotify client GET
+    def mock_requests_get(url, headers, params=None):
         class MockResponse:
+            status_code = 200
+
             def json(self):
                 return {"tracks": {"items": [{"uri": "spotify:track:mock_uri"}]}}
 
         return MockResponse()
 
-    monkeypatch.setattr(requests, "get", mock_requests_get)
+    monkeypatch.setattr(spotify_client, "get", mock_requests_get)
 
-    # Mock requests.post
+    # Mock the Spotify client POST
     def mock_requests_post(url, json, headers):
         class MockResponse:
             def json(self):
@@ -120,4 +157,4 @@ def mock_spotify(monkeypatch, mock_spotify_user_id):
 
         return MockResponse()
 
-    monkeypatch.setattr(requests, "post", mock_requests_post)
+    monkeypatch.setattr(spotify_client, "post", mock_requests_post)
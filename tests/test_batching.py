@@ -0,0 +1,81 @@
+import json
+import threading
+from unittest.mock import MagicMock, patch
+from app.batching import MicroBatcher
+from app.metrics import counters
+from app.routes import openai_recommendation
+
+
+def submit_concurrently(batcher, items, batch_fn):
+    results = {}
+
+    def submit(item):
+        results[item] = batcher.submit(item, batch_fn)
+
+    threads = [threading.Thread(target=submit, args=(item,)) for item in items]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_items_share_one_batch_call():
+    batcher = MicroBatcher("test", window=0.5, max_batch_size=3)
+    calls = []
+
+    def batch_fn(items):
+        calls.append(list(items))
+        return {index: item.upper() for index, item in enumerate(items)}
+
+    results = submit_concurrently(batcher, ["a", "b", "c"], batch_fn)
+
+    assert results == {"a": "A", "b": "B", "c": "C"}
+    # max_batch_size was reached, so the batch did not wait for the whole window
+    assert len(calls) == 1
+    assert sorted(calls[0]) == ["a", "b", "c"]
+
+
+def test_lone_item_and_failed_batch_fall_back_to_caller():
+    batcher = MicroBatcher("test", window=0.01)
+    batch_fn = MagicMock()
+
+    assert batcher.submit("a", batch_fn) is None
+    batch_fn.assert_not_called()
+
+    def failing_batch_fn(items):
+        raise RuntimeError("rate limited")
+
+    batcher = MicroBatcher("test", window=0.5, max_batch_size=2)
+    assert submit_concurrently(batcher, ["a", "b"], failing_batch_fn) == {"a": None, "b": None}
+
+
+def test_openai_recommendation_coalesces_concurrent_requests(client):
+    app = client.application
+    batch_content = json.dumps({
+        "1": {"Playlist name": "MMOne", "Songs": ["Song1 by Artist1"]},
+        "2": {"Playlist name": "MMTwo", "Songs": ["Song2 by Artist2"]},
+    })
+    openai_client = MagicMock()
+    openai_client.chat.completions.create.return_value.choices[0].message.content = batch_content
+    app.extensions["recommendation_batcher"] = MicroBatcher("openai_recommendation", window=0.5, max_batch_size=2)
+    counters.reset()
+    results = {}
+
+    def recommend(description):
+        with app.app_context():
+            results[description] = openai_recommendation(description)
+
+    try:
+        with patch("app.routes.get_openai_client", return_value=openai_client):
+            threads = [threading.Thread(target=recommend, args=(description,)) for description in ["one", "two"]]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        app.extensions["recommendation_batcher"] = None
+
+    assert openai_client.chat.completions.create.call_count == 1
+    assert counters.get("openai_recommendation_batched_items") == 2
+    assert {result["Playlist name"] for result in results.values()} == {"MMOne", "MMTwo"}
@@ -0,0 +1,112 @@
+import json
+from unittest.mock import MagicMock, patch
+import redis
+from app.cache import LRUCache, TieredCache, init_caches
+from app.metrics import counters
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("a") == (True, 1)
+    assert cache.get("b") == (False, None)
+    assert cache.get("c") == (True, 3)
+
+
+def test_lru_cache_expires_entries():
+    cache = LRUCache(maxsize=10, ttl=60)
+    with patch("app.cache.time.monotonic", return_value=100):
+        cache.set("a", 1)
+        cache.set("missing", None, ttl=5)
+    with patch("app.cache.time.monotonic", return_value=110):
+        assert cache.get("a") == (True, 1)
+        assert cache.get("missing") == (False, None)
+
+
+def test_tiered_cache_stores_negative_entries():
+    cache = TieredCache("test", maxsize=10, ttl=60, negative_ttl=5)
+    cache.set("nothing", None)
+
+    assert cache.get("nothing") == (True, None)
+    assert cache.get("unknown") == (False, None)
+
+
+def test_tiered_cache_shares_entries_through_redis():
+    redis_client = MagicMock()
+    redis_client.get.return_value = json.dumps("spotify:track:shared")
+    cache = TieredCache("test", maxsize=10, ttl=60, negative_ttl=5, redis_client=redis_client)
+    redis_hits = counters.get("test_cache_redis_hits")
+    local_hits = counters.get("test_cache_local_hits")
+
+    assert cache.get("song") == (True, "spotify:track:shared")
+    assert cache.get("song") == (True, "spotify:track:shared")
+    # The second lookup is answered by the in-process tier
+    redis_client.get.assert_called_once_with("moodmelody:test:song")
+    assert counters.get("test_cache_redis_hits") == redis_hits + 1
+    assert counters.get("test_cache_local_hits") == local_hits + 1
+
+    cache.set("missing", None)
+    redis_client.set.assert_called_with("moodmelody:test:missing", "null", ex=5)
+
+
+def test_tiered_cache_survives_redis_errors():
+    redis_client = MagicMock()
+    redis_client.get.side_effect = redis.ConnectionError("down")
+    redis_client.set.side_effect = redis.ConnectionError("down")
+    cache = TieredCache("test", maxsize=10, ttl=60, redis_client=redis_client)
+
+    assert cache.get("song") == (False, None)
+    cache.set("song", "spotify:track:uri")
+    assert cache.get("song") == (True, "spotify:track:uri")
+
+
+def test_tiered_cache_append_keeps_last_distinct_values():
+    cache = TieredCache("test", maxsize=10, ttl=60)
+    for value in ["a", "b", "a", "c"]:
+        cache.append("variants", value, maxlen=2)
+
+    assert cache.get_list("variants", 2) == (True, ["a", "c"])
+
+
+def test_tiered_cache_append_changes_redis_list_in_place():
+    redis_client = MagicMock()
+    pipeline = redis_client.pipeline.return_value
+    cache = TieredCache("test", maxsize=10, ttl=60, redis_client=redis_client)
+
+    cache.append("variants", {"Songs": ["b", "a"]}, maxlen=3)
+
+    raw_value = json.dumps({"Songs": ["b", "a"]})
+    pipeline.lrem.assert_called_once_with("moodmelody:test:variants", 0, raw_value)
+    pipeline.rpush.assert_called_once_with("moodmelody:test:variants", raw_value)
+    pipeline.ltrim.assert_called_once_with("moodmelody:test:variants", -3, -1)
+    pipeline.execute.assert_called_once()
+
+
+def test_tiered_cache_keeps_only_complete_lists_locally():
+    redis_client = MagicMock()
+    redis_client.lrange.return_value = [json.dumps("a")]
+    cache = TieredCache("test", maxsize=10, ttl=60, redis_client=redis_client)
+
+    # Another worker may still be adding to a short list, so it is read from Redis every time
+    assert cache.get_list("variants", 2) == (True, ["a"])
+    assert cache.local.get("variants") == (False, None)
+
+    redis_client.lrange.return_value = [json.dumps("a"), json.dumps("b")]
+    assert cache.get_list("variants", 2) == (True, ["a", "b"])
+    assert cache.local.get("variants") == (True, ["a", "b"])
+
+
+def test_redis_client_has_socket_timeouts(client):
+    app = client.application
+    config = {"REDIS_URL": "redis://localhost:6379/0", "REDIS_SOCKET_TIMEOUT": 0.1}
+    extensions = dict(app.extensions)
+    with patch.dict(app.config, config), patch.object(app, "extensions", extensions):
+        init_caches(app)
+
+    connection_kwargs = extensions["redis"].connection_pool.connection_kwargs
+    assert connection_kwargs["socket_timeout"] == 0.1
+    assert connection_kwargs["socket_connect_timeout"] == 0.1
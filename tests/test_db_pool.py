@@ -0,0 +1,66 @@
+import os
+import pytest
+from sqlalchemy import exc, text
+from app import create_app
+from app.db import db
+from app.db_pool import InstrumentedQueuePool, engine_options
+from app.metrics import counters, gauges, histograms
+
+POOL_CONFIG = {
+    "DB_POOL_SIZE": 3,
+    "DB_MAX_OVERFLOW": 2,
+    "DB_POOL_TIMEOUT": 5,
+    "DB_POOL_RECYCLE": 600,
+    "DB_POOL_PRE_PING": True,
+}
+
+
+def test_engine_options_for_postgres():
+    options = engine_options(dict(POOL_CONFIG, SQLALCHEMY_DATABASE_URI="postgresql://user@localhost/moodmelody"))
+
+    assert options == {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": 3,
+        "max_overflow": 2,
+        "pool_timeout": 5,
+        "pool_recycle": 600,
+        "pool_pre_ping": True,
+    }
+
+
+def test_engine_options_for_in_memory_sqlite():
+    options = engine_options(dict(POOL_CONFIG, SQLALCHEMY_DATABASE_URI="sqlite://"))
+    assert options == {"pool_recycle": 600, "pool_pre_ping": True}
+
+
+def test_pool_metrics(tmp_path):
+    app = create_app({
+        "TESTING": True,
+        "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "test"),
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'pool.db'}",
+        "DB_POOL_SIZE": 1,
+        "DB_MAX_OVERFLOW": 0,
+        "DB_POOL_TIMEOUT": 0.1,
+        "REDIS_URL": None,
+    })
+    counters.reset()
+    histograms.reset()
+
+    with app.app_context():
+        assert isinstance(db.engine.pool, InstrumentedQueuePool)
+        connection = db.engine.connect()
+        connection.execute(text("SELECT 1"))
+        assert gauges.get("db_pool_checked_out") == 1
+
+        # The only connection is checked out, the next checkout times out
+        with pytest.raises(exc.TimeoutError):
+            db.engine.connect()
+
+        connection.close()
+        assert gauges.get("db_pool_checked_out") == 0
+        db.engine.dispose()
+
+    assert counters.get("db_pool_connects") == 1
+    assert counters.get("db_pool_checkouts") == 1
+    assert counters.get("db_pool_timeouts") == 1
+    assert histograms.get("db_pool_wait_seconds")["count"] == 2
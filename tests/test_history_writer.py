@@ -0,0 +1,46 @@
+from unittest.mock import patch
+from app import db
+from app.history_writer import HistoryWriter
+from app.metrics import counters
+from app.models import SearchHistory
+from app.routes import record_search_history
+
+
+def test_history_writer_flushes_in_batches(client):
+    history_writer = HistoryWriter(client.application, batch_size=3, flush_interval=60)
+
+    with patch.object(db.session, "execute", wraps=db.session.execute) as mock_execute:
+        for i in range(7):
+            assert history_writer.enqueue("writer_user", f"query {i}", f"link {i}")
+        history_writer.stop()
+
+    rows = SearchHistory.query.filter_by(spotify_user_id="writer_user").all()
+    assert sorted(row.search_query for row in rows) == [f"query {i}" for i in range(7)]
+    # Two full batches and the remainder flushed on stop
+    assert mock_execute.call_count == 3
+
+    db.session.query(SearchHistory).delete()
+    db.session.commit()
+
+
+def test_history_writer_reports_dropped_and_failed_rows(client):
+    history_writer = HistoryWriter(client.application, max_queue_size=1)
+    dropped = counters.get("history_rows_dropped")
+    failed = counters.get("history_rows_failed")
+
+    # Keep the writer thread from consuming so the queue fills up
+    with patch.object(history_writer, "_ensure_started"):
+        assert history_writer.enqueue("writer_user", "query", "link")
+        assert not history_writer.enqueue("writer_user", "query", "link")
+    assert counters.get("history_rows_dropped") == dropped + 1
+
+    with patch.object(db.session, "execute", side_effect=Exception("database down")):
+        history_writer.stop()
+    assert counters.get("history_rows_failed") == failed + 1
+
+
+def test_recommend_history_goes_through_writer(client):
+    with patch.dict(client.application.config, {"HISTORY_WRITE_BEHIND": True}):
+        with patch.object(client.application.extensions["history_writer"], "enqueue") as mock_enqueue:
+            record_search_history("writer_user", "query", "link")
+    mock_enqueue.assert_called_once_with("writer_user", "query", "link")
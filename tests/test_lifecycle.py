@@ -0,0 +1,42 @@
+import os
+from unittest.mock import MagicMock, patch
+from app import create_app
+from app.lifecycle import reset_after_fork, shutdown
+from app.openai_client import get_openai_client
+
+
+def make_app():
+    return create_app({
+        "TESTING": True,
+        "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "test"),
+        "SQLALCHEMY_DATABASE_URI": "sqlite://",
+        "HISTORY_WRITE_BEHIND": False,
+        "REDIS_URL": None,
+    })
+
+
+def test_reset_after_fork_replaces_inherited_clients():
+    app = make_app()
+    spotify_client = app.extensions["spotify_client"]
+    openai_client = get_openai_client(app)
+    app.extensions["redis"] = redis_client = MagicMock()
+
+    with patch("app.lifecycle.db") as mock_db:
+        reset_after_fork(app)
+
+    mock_db.engine.dispose.assert_called_once_with(close=False)
+    redis_client.connection_pool.reset.assert_called_once()
+    assert app.extensions["spotify_client"] is not spotify_client
+    assert get_openai_client(app) is not openai_client
+
+
+def test_shutdown_flushes_worker_buffers():
+    app = make_app()
+    for name in ("history_writer", "metrics_snapshots", "log_handler"):
+        app.extensions[name] = MagicMock()
+
+    shutdown(app)
+
+    app.extensions["history_writer"].stop.assert_called_once()
+    app.extensions["metrics_snapshots"].write.assert_called_once()
+    app.extensions["log_handler"].stop.assert_called_once()
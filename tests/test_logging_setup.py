@@ -0,0 +1,81 @@
+import json
+import logging
+import queue
+from app.logging_setup import AsyncQueueHandler, JsonFormatter, SamplingFilter
+from app.metrics import counters
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_json_formatter_includes_request_id_and_extra_fields():
+    record = logging.makeLogRecord({
+        "name": "app.routes",
+        "levelno": logging.INFO,
+        "levelname": "INFO",
+        "msg": "Created playlist %s",
+        "args": ("abc",),
+        "request_id": "req-1",
+        "playlist_id": "abc",
+    })
+
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert entry["message"] == "Created playlist abc"
+    assert entry["level"] == "INFO"
+    assert entry["request_id"] == "req-1"
+    assert entry["playlist_id"] == "abc"
+
+
+def test_sampling_filter_always_keeps_warnings():
+    sampling_filter = SamplingFilter(0)
+    assert not sampling_filter.filter(logging.makeLogRecord({"levelno": logging.INFO}))
+    assert sampling_filter.filter(logging.makeLogRecord({"levelno": logging.WARNING}))
+    assert SamplingFilter(1).filter(logging.makeLogRecord({"levelno": logging.DEBUG}))
+
+
+def test_async_queue_handler_writes_on_listener_thread():
+    target = ListHandler()
+    handler = AsyncQueueHandler([target])
+    test_logger = logging.getLogger("test_async_queue_handler")
+    test_logger.propagate = False
+    test_logger.addHandler(handler)
+    try:
+        test_logger.warning("Spotify returned %d", 429)
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            test_logger.exception("Request failed")
+        handler.stop()
+    finally:
+        test_logger.removeHandler(handler)
+
+    assert [record.getMessage() for record in target.records] == ["Spotify returned 429", "Request failed"]
+    assert "ValueError: boom" in target.records[1].exc_text
+
+
+def test_async_queue_handler_drops_records_when_full():
+    handler = AsyncQueueHandler([ListHandler()], max_queue_size=1)
+    # Pretend the listener is running but stuck
+    handler._ensure_listener = lambda: None
+    dropped = counters.get("log_records_dropped")
+
+    handler.handle(logging.makeLogRecord({"msg": "first"}))
+    handler.handle(logging.makeLogRecord({"msg": "second"}))
+
+    assert counters.get("log_records_dropped") == dropped + 1
+    assert handler.queue.qsize() == 1
+
+
+def test_request_id_is_echoed(client):
+    response = client.get("/", headers={"X-Request-ID": "abc123"})
+    assert response.headers["X-Request-ID"] == "abc123"
+
+    response = client.get("/")
+    assert len(response.headers["X-Request-ID"]) == 32
@@ -0,0 +1,107 @@
+import json
+from unittest.mock import patch
+from app.metrics import Counters, Histograms, MetricsSnapshots, counters, gauges, histograms, render_prometheus
+from app.metrics import retire_worker_snapshots
+
+
+def test_histogram_buckets_are_cumulative():
+    histograms = Histograms(buckets=(0.1, 1.0))
+    histograms.observe("latency", 0.05, labels={"stage": "openai"})
+    histograms.observe("latency", 0.5, labels={"stage": "openai"})
+    histograms.observe("latency", 5, labels={"stage": "openai"})
+
+    assert histograms.get("latency", labels={"stage": "openai"}) == {"buckets": [1, 2], "sum": 5.55, "count": 3}
+    assert histograms.get("latency") is None
+
+
+def test_render_prometheus():
+    counters = Counters()
+    counters.increment("track_cache_misses", 2)
+    counters.increment("upstream_responses", labels={"upstream": "spotify", "status": 429})
+    histograms = Histograms(buckets=(0.1,))
+    histograms.observe("stage_duration_seconds", 0.05, labels={"stage": "openai"})
+
+    text = render_prometheus(counters.snapshot(), histograms.snapshot(), buckets=(0.1,))
+
+    assert "# TYPE moodmelody_track_cache_misses_total counter\nmoodmelody_track_cache_misses_total 2\n" in text
+    assert 'moodmelody_upstream_responses_total{status="429",upstream="spotify"} 1' in text
+    assert 'moodmelody_stage_duration_seconds_bucket{stage="openai",le="0.1"} 1' in text
+    assert 'moodmelody_stage_duration_seconds_bucket{stage="openai",le="+Inf"} 1' in text
+    assert 'moodmelody_stage_duration_seconds_count{stage="openai"} 1' in text
+
+
+def test_snapshots_add_up_all_workers(tmp_path):
+    other_worker = {
+        "counters": [["history_rows_written", {}, 5]],
+        "histograms": [["stage_duration_seconds", {"stage": "db_lookup"}, {"buckets": [1] * 12, "sum": 0.001, "count": 1}]],
+    }
+    (tmp_path / "1.json").write_text(json.dumps(other_worker))
+    counters.reset()
+    histograms.reset()
+    counters.increment("history_rows_written", 2)
+
+    snapshots = MetricsSnapshots(directory=str(tmp_path))
+    snapshots.write()
+    counter_values, _, histogram_values = snapshots.collect()
+
+    # The serving worker's own snapshot file is not counted twice
+    assert counter_values["history_rows_written"] == 7
+    assert histogram_values[("stage_duration_seconds", (("stage", "db_lookup"),))]["count"] == 1
+
+
+def test_exited_workers_are_retired(tmp_path):
+    def worker_snapshot(written):
+        return json.dumps({
+            "counters": [["history_rows_written", {}, written]],
+            "gauges": [["db_pool_checked_out", {}, 3]],
+            "histograms": [["stage_duration_seconds", {"stage": "db_lookup"}, {"buckets": [1] * 12, "sum": 0.001, "count": 1}]],
+        })
+
+    (tmp_path / "101-aaaa.json").write_text(worker_snapshot(5))
+    (tmp_path / "102-bbbb.json").write_text(worker_snapshot(4))
+    counters.reset()
+    gauges.reset()
+    histograms.reset()
+    snapshots = MetricsSnapshots(directory=str(tmp_path))
+
+    retire_worker_snapshots(str(tmp_path), 101)
+    retire_worker_snapshots(str(tmp_path), 102)
+    counter_values, gauge_values, histogram_values = snapshots.collect()
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["retired.json"]
+    assert counter_values["history_rows_written"] == 9
+    assert histogram_values[("stage_duration_seconds", (("stage", "db_lookup"),))]["count"] == 2
+    # The connections of exited workers are gone
+    assert "db_pool_checked_out" not in gauge_values
+
+def test_folded_snapshot_is_not_counted_twice(tmp_path):
+    snapshot = {"counters": [["history_rows_written", {}, 5]], "histograms": []}
+    (tmp_path / "101-aaaa.json").write_text(json.dumps(snapshot))
+    counters.reset()
+    histograms.reset()
+    retire_worker_snapshots(str(tmp_path), 101)
+    # As if collect ran between writing retired.json and removing the worker's file
+    (tmp_path / "101-aaaa.json").write_text(json.dumps(snapshot))
+
+    counter_values, _, _ = MetricsSnapshots(directory=str(tmp_path)).collect()
+
+    assert counter_values["history_rows_written"] == 5
+
+
+def test_server_timing_header_and_metrics_endpoint(client):
+    histograms.reset()
+
+    with patch("app.routes.User.query") as mock_query:
+        mock_query.filter_by.return_value.first.return_value = None
+        response = client.get("/get_access_token?session_id=unknown")
+
+    server_timing = response.headers["Server-Timing"]
+    assert server_timing.startswith("db_lookup;dur=")
+    assert ", total;dur=" in server_timing
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert 'moodmelody_stage_duration_seconds_count{stage="db_lookup"} 1' in text
+    assert 'moodmelody_request_duration_seconds_count{endpoint="main.get_access_token",status="401"} 1' in text
@@ -0,0 +1,54 @@
+from app.parsing import RecommendationStreamParser, split_batch_response
+
+
+def feed_in_chunks(parser, text, size):
+    events = []
+    for i in range(0, len(text), size):
+        events.extend(parser.feed(text[i:i + size]))
+    return events
+
+
+def test_parser_yields_fields_as_soon_as_complete():
+    parser = RecommendationStreamParser()
+
+    assert parser.feed("{'Playlist name': 'MMRain") == []
+    assert parser.feed("y Day', 'Songs': ['Riders on the Storm by The Doors', 'Set Fire") == [
+        ("playlist_name", "MMRainy Day"),
+        ("song", "Riders on the Storm by The Doors"),
+    ]
+    assert parser.feed(" to the Rain by Adele']}") == [("song", "Set Fire to the Rain by Adele")]
+    assert parser.complete
+    assert parser.result() == {
+        "Playlist name": "MMRainy Day",
+        "Songs": ["Riders on the Storm by The Doors", "Set Fire to the Rain by Adele"],
+    }
+
+
+def test_parser_handles_json_escapes_and_preamble():
+    text = '```json\n{"playlist name": "MM \\"Sunny\\"", "Songs": ["Don\'t Stop Me Now by Queen", "Caf\\u00e9 by Artist"]}\n```'
+    parser = RecommendationStreamParser()
+    events = feed_in_chunks(parser, text, 3)
+
+    assert events == [
+        ("playlist_name", 'MM "Sunny"'),
+        ("song", "Don't Stop Me Now by Queen"),
+        ("song", "Café by Artist"),
+    ]
+    assert parser.complete
+
+
+def test_parser_ignores_incomplete_song_in_truncated_output():
+    parser = RecommendationStreamParser()
+    events = feed_in_chunks(parser, "{'Playlist name': 'MMCats', 'Songs': ['Song1 by Artist1', 'Song2 by Art", 5)
+
+    assert events == [("playlist_name", "MMCats"), ("song", "Song1 by Artist1")]
+    assert not parser.complete
+
+
+def test_split_batch_response_keeps_complete_items_of_truncated_answer():
+    text = "{'1': {'Playlist name': 'MMa}', 'Songs': ['Don\\'t by A']}, \"2\": {\"Playlist name\": \"MMb\", \"Songs\": [\"B by B\", \"C b"
+
+    assert split_batch_response(text) == [
+        ("1", "{'Playlist name': 'MMa}', 'Songs': ['Don\\'t by A']}", True),
+        ("2", '{"Playlist name": "MMb", "Songs": ["B by B", "C b', False),
+    ]
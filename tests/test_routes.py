@@ -3,18 +3,29 @@ import pytest
 from app.routes import openai_recommendation
 from app.routes import store_tokens_in_db, spotify_playlist,format_openai_response, get_spotify_user_id
 from app.routes import get_session_id, save_search_history, refresh_spotify_token, retrieve_user_info_from_db
-from app.routes import openai_recommendation, MAX_RETRIES
-from app.routes import retrieve_user_info_from_db
+from app.routes import openai_recommendation, MAX_RETRIES, get_openai_client, get_valid_access_token
+from app.routes import retrieve_user_info_from_db, resolve_track_uris, recommendation_cache_key
+from app.routes import batch_openai_recommendations, history_page_query, search_spotify_track
 
 # from app.routes import store_tokens_in_db, retrieve_user_info_from_db, spotify_playlist
 from app.models import User, SearchHistory
+from app.metrics import counters
 from app import db
 from unittest.mock import patch, MagicMock
 from flask import jsonify
 import ast
+import os
+import subprocess
+import sys
+import threading
+import time
 
 from flask import json
 from datetime import datetime, timedelta
+from sqlalchemy import text
+
+# Far enough ahead that mocked sessions are never refreshed proactively
+FRESH_EXPIRES_AT = datetime.now() + timedelta(days=1)
 
 
 @pytest.fixture(autouse=True)
@@ -46,12 +57,82 @@ def test_check_openai_route(client, mock_openai):
     assert data["recommendation"]["Playlist name"].startswith("MM")
 
 
+def test_recommendation_cache_key_folds_case_whitespace_and_punctuation():
+    assert recommendation_cache_key("  Rainy   DAY!! ") == "rainy day"
+    assert recommendation_cache_key("happy") == recommendation_cache_key("Happy.")
+
+def test_openai_recommendation_uses_cache(client):
+    calls = []
+
+    def mock_request_openai_recommendation(user_text):
+        calls.append(user_text)
+        return {"Playlist name": f"MMVariant {len(calls)}", "Songs": ["Song1 by Artist1"]}
+
+    config = {"RECOMMENDATION_CACHE_ENABLED": True, "RECOMMENDATION_CACHE_VARIANTS": 2}
+    with patch.dict(client.application.config, config):
+        with patch("app.routes.request_openai_recommendation", mock_request_openai_recommendation):
+            results = [openai_recommendation(text) for text in ["Happy", "happy!", "HAPPY", " happy "]]
+    client.application.extensions["recommendation_cache"].local.clear()
+
+    # Two variants are collected from OpenAI, after that the cache answers
+    assert calls == ["Happy", "happy!"]
+    assert {result["Playlist name"] for result in results} <= {"MMVariant 1", "MMVariant 2"}
+
+def test_openai_recommendation_cache_disabled(client):
+    with patch("app.routes.request_openai_recommendation", return_value={"Songs": []}) as mock_request:
+        openai_recommendation("happy")
+        openai_recommendation("happy")
+    assert mock_request.call_count == 2
+
+def mock_openai_client_returning(*contents):
+    openai_client = MagicMock()
+    responses = []
+    for content in contents:
+        response = MagicMock()
+        response.choices[0].message.content = content
+        responses.append(response)
+    openai_client.chat.completions.create.side_effect = responses
+    return openai_client
+
+def test_openai_recommendation_salvages_truncated_response(client):
+    truncated = "{'Playlist name': 'MMCat Tunes', 'Songs': ['The Cat Came Back by Fred Penner', 'Stray Cat Strut by Stray Cats', 'Everybody Wants"
+    openai_client = mock_openai_client_returning(truncated)
+    salvaged = counters.get("openai_recommendation_salvaged")
+
+    with patch("app.routes.get_openai_client", return_value=openai_client), patch(
+        "app.routes.remember_recommendation"
+    ) as mock_remember:
+        result = openai_recommendation("cats")
+
+    assert result == {
+        "Playlist name": "MMCat Tunes",
+        "Songs": ["The Cat Came Back by Fred Penner", "Stray Cat Strut by Stray Cats"],
+    }
+    assert openai_client.chat.completions.create.call_count == 1
+    # Missing the songs it was cut off before, so it is not cached
+    mock_remember.assert_not_called()
+    assert counters.get("openai_recommendation_salvaged") == salvaged + 1
+
+def test_openai_recommendation_retries_when_too_few_songs_salvaged(client):
+    truncated = "{'Playlist name': 'MMCat Tunes', 'Songs': ['The Cat Came Back by Fred Penner', 'Stray"
+    complete = "{'Playlist name': 'MMCat Tunes', 'Songs': ['The Cat Came Back by Fred Penner', 'Stray Cat Strut by Stray Cats']}"
+    openai_client = mock_openai_client_returning(truncated, complete)
+    retries = counters.get("openai_recommendation_retries")
+
+    with patch("app.routes.get_openai_client", return_value=openai_client):
+        result = openai_recommendation("cats")
+
+    assert result["Songs"] == ["The Cat Came Back by Fred Penner", "Stray Cat Strut by Stray Cats"]
+    assert openai_client.chat.completions.create.call_count == 2
+    assert counters.get("openai_recommendation_retries") == retries + 1
+
 def test_spotify_playlist(client, mock_spotify, mock_spotify_user_id):
     # Store mock tokens and user ID in the database
     session_id = "mock_session_id"
     token_info = {
         "access_token": "mock_access_token",
         "refresh_token": "mock_refresh_token",
+        "expires_in": 3600,
     }
     store_tokens_in_db(session_id, token_info, mock_spotify_user_id)
 
@@ -68,20 +149,101 @@ def test_spotify_playlist(client, mock_spotify, mock_spotify_user_id):
     assert spotify_link == "https://open.spotify.com/playlist/mock_playlist_id"
     assert user_id == mock_spotify_user_id
 
-def test_spotify_playlist_no_tracks_found(client, mock_spotify, mock_spotify_user_id):
-    # Mock the requests.get to return no tracks
-    def mock_requests_get_no_tracks(url, headers):
+def test_resolve_track_uris_keeps_order(client):
+    # Later songs resolve first, the result must still follow the recommendation order
+    delays = {"Song1 by Artist1": 0.05, "Song2 by Artist2": 0.02, "Song3 by Artist3": 0}
+
+    def mock_search_spotify_track(spotify_client, recommendation, headers):
+        time.sleep(delays[recommendation])
+        return f"spotify:track:{recommendation.split()[0]}"
+
+    with patch("app.routes.search_spotify_track", mock_search_spotify_track):
+        track_uris = resolve_track_uris(list(delays), {})
+
+    assert track_uris == ["spotify:track:Song1", "spotify:track:Song2", "spotify:track:Song3"]
+
+def test_resolve_track_uris_respects_concurrency_limit(client):
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+
+    def mock_search_spotify_track(spotify_client, recommendation, headers):
+        with lock:
+            in_flight.append(recommendation)
+            peak.append(len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.remove(recommendation)
+        return None if recommendation == "missing" else "spotify:track:uri"
+
+    songs = [f"Song{i} by Artist{i}" for i in range(6)] + ["missing"]
+    with patch.dict(client.application.config, {"SPOTIFY_SEARCH_CONCURRENCY": 2}):
+        with patch("app.routes.search_spotify_track", mock_search_spotify_track):
+            track_uris = resolve_track_uris(songs, {})
+
+    assert max(peak) <= 2
+    assert track_uris == ["spotify:track:uri"] * 6
+
+def test_resolve_track_uris_uses_track_cache(client):
+    searched = []
+
+    def mock_search_spotify_track(spotify_client, recommendation, headers):
+        searched.append(recommendation)
+        return None if recommendation == "Unknown by Nobody" else "spotify:track:cached"
+
+    songs = ["Song1 by Artist1", "Unknown by Nobody", "song1  by artist1"]
+    with patch.dict(client.application.config, {"TRACK_CACHE_ENABLED": True}):
+        with patch("app.routes.search_spotify_track", mock_search_spotify_track):
+            first = resolve_track_uris(songs, {})
+            second = resolve_track_uris(songs, {})
+    client.application.extensions["track_cache"].local.clear()
+
+    # Each distinct song is searched once, hits and "not found" entries come from the cache
+    assert searched == ["Song1 by Artist1", "Unknown by Nobody"]
+    assert first == second == ["spotify:track:cached", "spotify:track:cached"]
+
+def test_resolve_track_uris_does_not_cache_failed_searches(client, spotify_client):
+    responses = [MagicMock(status_code=401), MagicMock(status_code=200)]
+    responses[1].json.return_value = {"tracks": {"items": [{"uri": "spotify:track:found"}]}}
+
+    with patch.dict(client.application.config, {"TRACK_CACHE_ENABLED": True}):
+        with patch.object(spotify_client, "get", side_effect=responses):
+            first = resolve_track_uris(["Song by A"], {})
+            second = resolve_track_uris(["Song by A"], {})
+    client.application.extensions["track_cache"].local.clear()
+
+    # The 401 says nothing about the song, so it is searched again
+    assert first == []
+    assert second == ["spotify:track:found"]
+
+def test_search_spotify_track_encodes_query(client, spotify_client):
+    response = MagicMock(status_code=200)
+    response.json.return_value = {"tracks": {"items": [{"uri": "spotify:track:found"}]}}
+
+    with patch.object(spotify_client.session, "get", return_value=response) as mock_get:
+        track_uri = search_spotify_track(spotify_client, "Rock & Roll #9 by AC/DC", {})
+
+    assert track_uri == "spotify:track:found"
+    assert mock_get.call_args.args == ("https://api.spotify.com/v1/search",)
+    assert mock_get.call_args.kwargs["params"] == {"q": "Rock & Roll #9 by AC/DC", "type": "track", "limit": 1}
+
+def test_spotify_playlist_no_tracks_found(client, mock_spotify, mock_spotify_user_id, spotify_client):
+    # Mock the Spotify client GET to return no tracks
+    def mock_requests_get_no_tracks(url, headers, params=None):
         class MockResponse:
+            status_code = 200
+
             def json(self):
                 return {"tracks": {"items": []}}
 
         return MockResponse()
 
-    with patch("requests.get", mock_requests_get_no_tracks):
+    with patch.object(spotify_client, "get", mock_requests_get_no_tracks):
         session_id = "mock_session_id"
         token_info = {
             "access_token": "mock_access_token",
             "refresh_token": "mock_refresh_token",
+            "expires_in": 3600,
         }
         store_tokens_in_db(session_id, token_info, mock_spotify_user_id)
 
@@ -94,9 +256,9 @@ def test_spotify_playlist_no_tracks_found(client, mock_spotify, mock_spotify_use
         result = spotify_playlist(recommendation_dict, session_id)
         assert result == {"error": "No tracks found."}
 
-def test_spotify_playlist_creation_failed(client, mock_spotify, mock_spotify_user_id):
+def test_spotify_playlist_creation_failed(client, mock_spotify, mock_spotify_user_id, spotify_client):
 
-    # Mock the requests.post to return failure for playlist creation
+    # Mock the Spotify client POST to return failure for playlist creation
     def mock_requests_post_fail_playlist(url, json, headers):
         class MockResponse:
             def json(self):
@@ -104,11 +266,12 @@ def test_spotify_playlist_creation_failed(client, mock_spotify, mock_spotify_use
 
         return MockResponse()
 
-    with patch("requests.post", mock_requests_post_fail_playlist):
+    with patch.object(spotify_client, "post", mock_requests_post_fail_playlist):
         session_id = "mock_session_id"
         token_info = {
             "access_token": "mock_access_token",
             "refresh_token": "mock_refresh_token",
+            "expires_in": 3600,
         }
         store_tokens_in_db(session_id, token_info, mock_spotify_user_id)
 
@@ -120,7 +283,7 @@ def test_spotify_playlist_creation_failed(client, mock_spotify, mock_spotify_use
         result = spotify_playlist(recommendation_dict, session_id)
         assert result == {"error": "Failed to create playlist."}
 
-def test_callback_success(client, mock_spotify_user_id, caplog):
+def test_callback_success(client, mock_spotify_user_id, spotify_client, caplog):
     def mock_requests_post(url, headers, data):
         class MockResponse:
             def __init__(self):
@@ -135,7 +298,7 @@ def test_callback_success(client, mock_spotify_user_id, caplog):
                 return "Mock response text"
         return MockResponse()
 
-    with patch("requests.post", mock_requests_post):
+    with patch.object(spotify_client, "post", mock_requests_post):
         with patch("app.routes.get_session_id", return_value="new_session_id"):
             with patch("app.routes.get_spotify_user_id", return_value=mock_spotify_user_id):
                 client.set_cookie(key="session_id", value="mock_session_id")
@@ -160,7 +323,7 @@ def test_callback_success(client, mock_spotify_user_id, caplog):
                 assert token_info.refresh_token == "mock_refresh_token"
                 assert token_info.spotify_user_id == mock_spotify_user_id
 
-def test_callback_no_session_id(client, mock_spotify_user_id, caplog):
+def test_callback_no_session_id(client, mock_spotify_user_id, spotify_client, caplog):
     def mock_requests_post(url, headers, data):
         class MockResponse:
             def __init__(self):
@@ -175,7 +338,7 @@ def test_callback_no_session_id(client, mock_spotify_user_id, caplog):
                 return "Mock response text"
         return MockResponse()
 
-    with patch("requests.post", mock_requests_post):
+    with patch.object(spotify_client, "post", mock_requests_post):
         with patch("app.routes.get_spotify_user_id", return_value=mock_spotify_user_id):
             with patch("app.routes.get_session_id", return_value="new_session_id"):
                 client.delete_cookie("session_id")
@@ -205,7 +368,7 @@ def test_callback_no_session_id(client, mock_spotify_user_id, caplog):
                 assert token_info.refresh_token == "mock_refresh_token"
                 assert token_info.spotify_user_id == mock_spotify_user_id
 
-def test_callback_spotify_error(client):
+def test_callback_spotify_error(client, spotify_client):
     def mock_requests_post(url, headers, data):
         class MockResponse:
             def __init__(self):
@@ -213,20 +376,20 @@ def test_callback_spotify_error(client):
                 self.text = "Error from Spotify"
         return MockResponse()
 
-    with patch("requests.post", mock_requests_post):
+    with patch.object(spotify_client, "post", mock_requests_post):
         response = client.get("/auth/callback?code=mock_code")
         
         assert response.status_code == 400
         assert "Failed to obtain access token from Spotify" in response.get_json()["error"]
 
-def test_callback_unexpected_error(client):
-    with patch("requests.post", side_effect=Exception("Unexpected error")):
+def test_callback_unexpected_error(client, spotify_client):
+    with patch.object(spotify_client, "post", side_effect=Exception("Unexpected error")):
         response = client.get("/auth/callback?code=mock_code")
         
         assert response.status_code == 500
         assert "An unexpected error occurred during authentication" in response.get_json()["error"]
 
-def test_get_spotify_user_id_success(mock_spotify_user_id):
+def test_get_spotify_user_id_success(mock_spotify_user_id, spotify_client):
     def mock_requests_get(url, headers):
         class MockResponse:
             def __init__(self):
@@ -236,11 +399,11 @@ def test_get_spotify_user_id_success(mock_spotify_user_id):
                 return {"id": mock_spotify_user_id}
         return MockResponse()
 
-    with patch("requests.get", mock_requests_get):
+    with patch.object(spotify_client, "get", mock_requests_get):
         user_id = get_spotify_user_id("mock_access_token")
         assert user_id == mock_spotify_user_id
 
-def test_get_spotify_user_id_error():
+def test_get_spotify_user_id_error(spotify_client):
     def mock_requests_get(url, headers):
         class MockResponse:
             def __init__(self):
@@ -248,11 +411,11 @@ def test_get_spotify_user_id_error():
                 self.text = "Error from Spotify"
         return MockResponse()
 
-    with patch("requests.get", mock_requests_get):
+    with patch.object(spotify_client, "get", mock_requests_get):
         with pytest.raises(ValueError, match="Could not retrieve user profile from Spotify"):
             get_spotify_user_id("mock_access_token")
 
-def test_get_spotify_user_id_error():
+def test_get_spotify_user_id_error(spotify_client):
     def mock_requests_get(url, headers):
         class MockResponse:
             def __init__(self):
@@ -260,7 +423,7 @@ def test_get_spotify_user_id_error():
                 self.text = "Error from Spotify"
         return MockResponse()
 
-    with patch("requests.get", mock_requests_get):
+    with patch.object(spotify_client, "get", mock_requests_get):
         with pytest.raises(ValueError, match="Could not retrieve user profile from Spotify"):
             get_spotify_user_id("mock_access_token")
 
@@ -283,6 +446,7 @@ def mock_retrieve_user_info_from_db(session_id):
         return {
             "access_token": "mock_access_token",
             "refresh_token": "mock_refresh_token",
+            "expires_at": FRESH_EXPIRES_AT,
         }
     return None
 
@@ -317,7 +481,8 @@ def test_recommend_success(client, mock_spotify, mock_spotify_user_id):
         return {
             "access_token": "mock_access_token",
             "refresh_token": "mock_refresh_token",
-            "spotify_user_id": mock_spotify_user_id
+            "spotify_user_id": mock_spotify_user_id,
+            "expires_at": FRESH_EXPIRES_AT,
         }
 
     def mock_openai_recommendation(user_text):
@@ -364,6 +529,279 @@ def test_recommend_success(client, mock_spotify, mock_spotify_user_id):
             assert data["spotify_link"] == f"https://open.spotify.com/playlist/mock_playlist_id"
             assert data["user_id"] == mock_spotify_user_id
 
+def test_recommend_loads_user_once(client, mock_spotify, mock_spotify_user_id):
+    store_tokens_in_db(
+        "mock_session_id",
+        {"access_token": "mock_access_token", "refresh_token": "mock_refresh_token", "expires_in": 3600},
+        mock_spotify_user_id,
+    )
+    recommendation = {"Playlist name": "Mock Playlist", "Songs": ["Song1 by Artist1"]}
+
+    with patch("app.routes.retrieve_user_info_from_db", side_effect=retrieve_user_info_from_db) as mock_retrieve, \
+            patch("app.routes.get_spotify_user_id") as mock_get_user_id, \
+            patch("app.routes.openai_recommendation", return_value=recommendation):
+        client.set_cookie(key="session_id", value="mock_session_id")
+        response = client.post("/recommend", json={"description": "happy songs"})
+
+    assert response.status_code == 200
+    assert response.get_json()["user_id"] == mock_spotify_user_id
+    # The route and spotify_playlist share one lookup, the stored user id replaces /v1/me
+    assert mock_retrieve.call_count == 1
+    mock_get_user_id.assert_not_called()
+
+def parse_sse_events(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+def test_recommend_stream_success(client, mock_openai, mock_spotify, mock_spotify_user_id):
+    with patch(
+        "app.routes.retrieve_user_info_from_db", side_effect=mock_retrieve_user_info_from_db
+    ):
+        response = client.post(
+            "/recommend/stream?session_id=mock_session_id",
+            json={"description": "cat songs"},
+        )
+        body = response.get_data(as_text=True)
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    events = parse_sse_events(body)
+    assert events[0] == ("playlist_name", {"playlist_name": "MMCat Tunes"})
+    songs = [data for event, data in events if event == "song"]
+    assert sorted(song["index"] for song in songs) == [0, 1, 2]
+    assert all(song["uri"] == "spotify:track:mock_uri" for song in songs)
+    event, data = events[-1]
+    assert event == "done"
+    assert data["recommendation"][0] == "The Cat Came Back by Fred Penner"
+    assert data["spotify_link"] == "https://open.spotify.com/playlist/mock_playlist_id"
+    assert data["user_id"] == mock_spotify_user_id
+    assert SearchHistory.query.filter_by(spotify_user_id=mock_spotify_user_id).count() == 1
+
+def test_recommend_stream_falls_back_when_stream_fails(client, mock_spotify):
+    def mock_stream_openai_recommendation(user_text, parser):
+        raise Exception("stream interrupted")
+        yield
+
+    with patch(
+        "app.routes.retrieve_user_info_from_db", side_effect=mock_retrieve_user_info_from_db
+    ), patch(
+        "app.routes.stream_openai_recommendation", mock_stream_openai_recommendation
+    ), patch(
+        "app.routes.openai_recommendation", side_effect=mock_openai_recommendation
+    ):
+        response = client.post(
+            "/recommend/stream?session_id=mock_session_id",
+            json={"description": "happy songs"},
+        )
+        events = parse_sse_events(response.get_data(as_text=True))
+
+    assert events[0] == ("playlist_name", {"playlist_name": "MMTest Playlist"})
+    assert events[-1][0] == "done"
+    assert events[-1][1]["recommendation"] == mock_openai_recommendation("happy songs")["Songs"]
+
+def mock_stream_ending_after(songs):
+    def mock_stream_openai_recommendation(user_text, parser):
+        yield from parser.feed("{'Playlist name': 'MMCut', 'Songs': [")
+        for song in songs:
+            yield from parser.feed(f"'{song}', ")
+        raise Exception("stream interrupted")
+
+    return mock_stream_openai_recommendation
+
+def test_recommend_stream_keeps_incomplete_stream_without_caching(client, mock_spotify):
+    songs = ["Song1 by Artist1", "Song2 by Artist2"]
+
+    with patch.dict(client.application.config, {"RECOMMENDATION_CACHE_ENABLED": True}), patch(
+        "app.routes.retrieve_user_info_from_db", side_effect=mock_retrieve_user_info_from_db
+    ), patch("app.routes.stream_openai_recommendation", mock_stream_ending_after(songs)), patch(
+        "app.routes.openai_recommendation"
+    ) as mock_fallback:
+        response = client.post("/recommend/stream?session_id=mock_session_id", json={"description": "cut songs"})
+        events = parse_sse_events(response.get_data(as_text=True))
+    found, _ = client.application.extensions["recommendation_cache"].get_list("cut songs", 1)
+    client.application.extensions["recommendation_cache"].local.clear()
+
+    assert events[-1][0] == "done"
+    assert events[-1][1]["recommendation"] == songs
+    mock_fallback.assert_not_called()
+    assert not found
+
+def test_recommend_stream_falls_back_below_salvage_threshold(client, mock_spotify):
+    with patch(
+        "app.routes.retrieve_user_info_from_db", side_effect=mock_retrieve_user_info_from_db
+    ), patch("app.routes.stream_openai_recommendation", mock_stream_ending_after(["Song1 by Artist1"])), patch(
+        "app.routes.openai_recommendation", side_effect=mock_openai_recommendation
+    ):
+        response = client.post("/recommend/stream?session_id=mock_session_id", json={"description": "happy songs"})
+        events = parse_sse_events(response.get_data(as_text=True))
+
+    # The streamed name is kept, the fallback's songs follow the one already sent
+    assert [data for event, data in events if event == "playlist_name"] == [{"playlist_name": "MMCut"}]
+    assert events[-1][0] == "done"
+    assert events[-1][1]["recommendation"] == ["Song1 by Artist1", "Song2 by Artist2", "Song3 by Artist3"]
+
+def test_recommend_stream_skips_failed_searches(client, mock_openai, mock_spotify, spotify_client):
+    responses = iter([MagicMock(status_code=429), MagicMock(status_code=200), MagicMock(status_code=200)])
+
+    def mock_requests_get(url, headers, params=None):
+        response = next(responses)
+        response.json.return_value = {"tracks": {"items": [{"uri": "spotify:track:found"}]}}
+        return response
+
+    with patch.dict(client.application.config, {"TRACK_CACHE_ENABLED": True}), patch(
+        "app.routes.retrieve_user_info_from_db", side_effect=mock_retrieve_user_info_from_db
+    ), patch.object(spotify_client, "get", mock_requests_get):
+        response = client.post("/recommend/stream?session_id=mock_session_id", json={"description": "happy songs"})
+        events = parse_sse_events(response.get_data(as_text=True))
+    track_cache = client.application.extensions["track_cache"]
+    cached = [track_cache.get(song.lower())[0] for song in events[-1][1]["recommendation"]]
+    track_cache.local.clear()
+
+    assert events[-1][0] == "done"
+    assert sorted(value["uri"] is None for event, value in events if event == "song") == [False, False, True]
+    # The failed search is not cached as "not found"
+    assert sorted(cached) == [False, True, True]
+
+def test_recommend_accept_event_stream_no_tracks(client, mock_openai, mock_spotify, spotify_client):
+    def mock_requests_get_no_tracks(url, headers, params=None):
+        class MockResponse:
+            status_code = 200
+
+            def json(self):
+                return {"tracks": {"items": []}}
+
+        return MockResponse()
+
+    with patch(
+        "app.routes.retrieve_user_info_from_db", side_effect=mock_retrieve_user_info_from_db
+    ), patch.object(spotify_client, "get", mock_requests_get_no_tracks):
+        response = client.post(
+            "/recommend?session_id=mock_session_id",
+            json={"description": "happy songs"},
+            headers={"Accept": "text/event-stream"},
+        )
+        events = parse_sse_events(response.get_data(as_text=True))
+
+    assert response.mimetype == "text/event-stream"
+    assert events[-1] == ("error", {"error": "No tracks found."})
+
+def test_recommend_batch_success(client, mock_spotify, mock_spotify_user_id, spotify_client):
+    batch_content = json.dumps({
+        "1": {"Playlist name": "MMHappy", "Songs": ["Song1 by Artist1", "Shared by Artist"]},
+        "2": {"Playlist name": "MMSad", "Songs": ["Shared by Artist", "Song2 by Artist2"]},
+    })
+    openai_client = mock_openai_client_returning(batch_content)
+    searches = []
+
+    def mock_requests_get(url, headers, params=None):
+        searches.append(params)
+        response = MagicMock(status_code=200)
+        response.json.return_value = {"tracks": {"items": [{"uri": "spotify:track:mock_uri"}]}}
+        return response
+
+    with patch(
+        "app.routes.retrieve_user_info_from_db", side_effect=mock_retrieve_user_info_from_db
+    ), patch("app.routes.get_openai_client", return_value=openai_client), patch.object(
+        spotify_client, "get", mock_requests_get
+    ):
+        response = client.post(
+            "/recommend/batch?session_id=mock_session_id",
+            json={"descriptions": ["happy songs", "sad songs"]},
+        )
+
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["authorized"] == True
+    assert data["user_id"] == mock_spotify_user_id
+    assert [result["description"] for result in data["results"]] == ["happy songs", "sad songs"]
+    assert data["results"][0]["recommendation"] == ["Song1 by Artist1", "Shared by Artist"]
+    assert data["results"][1]["spotify_link"] == "https://open.spotify.com/playlist/mock_playlist_id"
+    # One completion for both descriptions and one search per distinct song
+    assert openai_client.chat.completions.create.call_count == 1
+    assert len(searches) == 3
+    history = SearchHistory.query.filter_by(spotify_user_id=mock_spotify_user_id).all()
+    assert sorted(entry.search_query for entry in history) == ["happy songs", "sad songs"]
+
+def test_recommend_batch_falls_back_for_missing_descriptions(client, mock_spotify):
+    batch_content = json.dumps({"1": {"Playlist name": "MMHappy", "Songs": ["Song1 by Artist1"]}})
+    openai_client = mock_openai_client_returning(batch_content)
+
+    with patch(
+        "app.routes.retrieve_user_info_from_db", side_effect=mock_retrieve_user_info_from_db
+    ), patch("app.routes.get_openai_client", return_value=openai_client), patch(
+        "app.routes.openai_recommendation", return_value="Unable to generate a recommendation."
+    ) as mock_single:
+        response = client.post(
+            "/recommend/batch?session_id=mock_session_id",
+            json={"descriptions": ["happy songs", "sad songs"]},
+        )
+
+    data = response.get_json()
+    mock_single.assert_called_once_with("sad songs")
+    assert "spotify_link" in data["results"][0]
+    assert "error" in data["results"][1]
+
+def test_openai_batch_fallbacks_run_concurrently(client):
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+
+    def mock_openai_recommendation(description):
+        with lock:
+            in_flight.append(description)
+            peak.append(len(in_flight))
+        time.sleep(0.02)
+        with lock:
+            in_flight.remove(description)
+        return {"Playlist name": f"MM{description}", "Songs": ["Song1 by Artist1"]}
+
+    descriptions = ["happy", "sad", "calm", "loud"]
+    with patch.dict(client.application.config, {"OPENAI_FALLBACK_CONCURRENCY": 2}), patch(
+        "app.routes.request_openai_batch_recommendations", side_effect=ValueError("unparsable")
+    ), patch("app.routes.openai_recommendation", mock_openai_recommendation):
+        recommendations = batch_openai_recommendations(descriptions)
+
+    assert max(peak) == 2
+    assert [recommendation["Playlist name"] for recommendation in recommendations] == [
+        "MMhappy", "MMsad", "MMcalm", "MMloud"
+    ]
+
+def test_openai_batch_keeps_items_before_truncation(client):
+    truncated = (
+        "{'1': {'Playlist name': 'MMHappy', 'Songs': ['Song1 by Artist1', 'Song2 by Artist2']}, "
+        "'2': {'Playlist name': 'MMSad', 'Songs': ['Song3 by Artist3', 'Song4 by Artist4', 'Song5 by"
+    )
+    openai_client = mock_openai_client_returning(truncated)
+
+    with patch("app.routes.get_openai_client", return_value=openai_client), patch(
+        "app.routes.openai_recommendation"
+    ) as mock_single, patch("app.routes.remember_recommendation") as mock_remember:
+        recommendations = batch_openai_recommendations(["happy songs", "sad songs"])
+
+    assert recommendations == [
+        {"Playlist name": "MMHappy", "Songs": ["Song1 by Artist1", "Song2 by Artist2"]},
+        {"Playlist name": "MMSad", "Songs": ["Song3 by Artist3", "Song4 by Artist4"]},
+    ]
+    mock_single.assert_not_called()
+    # Only the complete item is cached
+    mock_remember.assert_called_once_with("happy songs", recommendations[0])
+    max_tokens = openai_client.chat.completions.create.call_args.kwargs["max_tokens"]
+    assert max_tokens == client.application.config["OPENAI_BATCH_ITEM_TOKENS"] * 2 + 20
+
+def test_recommend_batch_rejects_invalid_descriptions(client):
+    with patch(
+        "app.routes.retrieve_user_info_from_db", side_effect=mock_retrieve_user_info_from_db
+    ):
+        response = client.post("/recommend/batch?session_id=mock_session_id", json={"descriptions": []})
+        assert response.status_code == 400
+
+        too_many = ["song"] * (client.application.config["BATCH_MAX_DESCRIPTIONS"] + 1)
+        response = client.post("/recommend/batch?session_id=mock_session_id", json={"descriptions": too_many})
+        assert response.status_code == 400
+
 def test_format_openai_response_json():
     # Test a properly formatted JSON string
     json_string = '{"Playlist name": "MMSpring Vibes", "Songs": ["Here Comes the Sun by The Beatles", "Bloom by The Paper Kites", "Budapest by George Ezra"]}'
@@ -438,25 +876,23 @@ def test_save_search_history(client, clear_db):
     assert entry.search_query == search_query
     assert entry.spotify_link == spotify_link
 
-@patch('requests.post')
-def test_refresh_spotify_token_success(mock_post):
+def test_refresh_spotify_token_success(spotify_client):
     mock_response = MagicMock()
     mock_response.status_code = 200
     mock_response.json.return_value = {"access_token": "new_access_token"}
-    mock_post.return_value = mock_response
 
-    new_token = refresh_spotify_token("old_refresh_token")
+    with patch.object(spotify_client, "post", return_value=mock_response):
+        new_token = refresh_spotify_token("old_refresh_token")
     assert new_token == "new_access_token"
 
-@patch('requests.post')
-def test_refresh_spotify_token_failure(mock_post):
+def test_refresh_spotify_token_failure(spotify_client):
     mock_response = MagicMock()
     mock_response.status_code = 400
     mock_response.text = "Error refreshing token"
-    mock_post.return_value = mock_response
 
-    with pytest.raises(ValueError, match="Failed to refresh access token from Spotify."):
-        refresh_spotify_token("old_refresh_token")
+    with patch.object(spotify_client, "post", return_value=mock_response):
+        with pytest.raises(ValueError, match="Failed to refresh access token from Spotify."):
+            refresh_spotify_token("old_refresh_token")
 
 def test_store_tokens_in_db(client, clear_db):
     session_id = "test_session"
@@ -492,28 +928,29 @@ def test_retrieve_user_info_from_db(client, clear_db):
     # Test with non-existent session
     assert retrieve_user_info_from_db("non_existent_session") is None
 
-@patch('app.routes.requests.get')
-def test_get_playlist_tracks(mock_get, client):
+def test_get_playlist_tracks(client, spotify_client):
     mock_response = MagicMock()
     mock_response.status_code = 200
     mock_response.json.return_value = {
-        "items": [
-            {
-                "track": {
-                    "id": "track1",
-                    "name": "Song 1",
-                    "artists": [{"name": "Artist 1"}],
-                    "album": {"name": "Album 1"},
-                    "duration_ms": 200000,
-                    "preview_url": "http://example.com/preview1"
+        "tracks": {
+            "items": [
+                {
+                    "track": {
+                        "id": "track1",
+                        "name": "Song 1",
+                        "artists": [{"name": "Artist 1"}],
+                        "album": {"name": "Album 1"},
+                        "duration_ms": 200000,
+                        "preview_url": "http://example.com/preview1"
+                    }
                 }
-            }
-        ]
+            ]
+        }
     }
-    mock_get.return_value = mock_response
 
     # Mock the retrieve_user_info_from_db function
-    with patch('app.routes.retrieve_user_info_from_db', return_value={"access_token": "test_token"}):
+    with patch.object(spotify_client, "get", return_value=mock_response), \
+            patch('app.routes.retrieve_user_info_from_db', return_value={"access_token": "test_token", "expires_at": FRESH_EXPIRES_AT}):
         response = client.get('/playlist/test_playlist_id/tracks?session_id=test_session')
         
     assert response.status_code == 200
@@ -523,9 +960,122 @@ def test_get_playlist_tracks(mock_get, client):
     assert data["items"][0]["name"] == "Song 1"
     assert data["items"][0]["artist"] == "Artist 1"
 
+def mock_playlist_page_response(offset, total, status_code=200):
+    response = MagicMock()
+    response.status_code = status_code
+    response.json.return_value = {
+        "total": total,
+        "items": [
+            {
+                "track": {
+                    "id": f"track{i}",
+                    "name": f"Song {i}",
+                    "artists": [{"name": "Artist"}],
+                    "album": {"name": "Album"},
+                    "duration_ms": 200000,
+                    "preview_url": None
+                }
+            }
+            for i in range(offset, min(offset + 100, total))
+        ] + [{"track": None}]  # A removed track
+    }
+    return response
+
+def mock_playlist_get(total, snapshot_id=None, failing_offset=None, requested=None):
+    def mock_get(url, headers, params):
+        if requested is not None:
+            requested.append(params)
+        if "offset" not in params:
+            # The playlist itself, with the snapshot id and the first page
+            response = MagicMock()
+            response.status_code = 200
+            response.json.return_value = {"tracks": mock_playlist_page_response(0, total).json()}
+            if snapshot_id:
+                response.json.return_value["snapshot_id"] = snapshot_id
+            return response
+        status_code = 500 if params["offset"] == failing_offset else 200
+        return mock_playlist_page_response(params["offset"], total, status_code)
+
+    return mock_get
+
+def test_get_playlist_tracks_fetches_all_pages(client, spotify_client):
+    requested = []
+
+    with patch.object(spotify_client, "get", side_effect=mock_playlist_get(250, requested=requested)), \
+            patch('app.routes.retrieve_user_info_from_db', return_value={"access_token": "test_token", "expires_at": FRESH_EXPIRES_AT}):
+        response = client.get('/playlist/test_playlist_id/tracks?session_id=test_session')
+        # The body is streamed, read it while Spotify is still mocked
+        data = response.get_json()
+
+    assert response.status_code == 200
+    assert [track["id"] for track in data["items"]] == [f"track{i}" for i in range(250)]
+    # The snapshot id and the first page come in one request
+    assert requested[0]["fields"].startswith("snapshot_id,tracks(total,items(track(")
+    pages = requested[1:]
+    assert sorted(params["offset"] for params in pages) == [100, 200]
+    assert all(params["limit"] == 100 for params in pages)
+    assert all(params["fields"].startswith("total,items(track(") for params in pages)
+
+def test_get_playlist_tracks_reports_failed_page(client, spotify_client):
+    with patch.object(spotify_client, "get", side_effect=mock_playlist_get(150, failing_offset=100)), \
+            patch('app.routes.retrieve_user_info_from_db', return_value={"access_token": "test_token", "expires_at": FRESH_EXPIRES_AT}):
+        response = client.get('/playlist/test_playlist_id/tracks?session_id=test_session')
+        data = response.get_json()
+
+    assert len(data["items"]) == 100
+    assert data["error"] == "Failed to fetch all playlist tracks."
+
+def test_get_playlist_tracks_failed_page_has_no_etag(client, spotify_client):
+    mock_get = mock_playlist_get(150, snapshot_id="snap1", failing_offset=100)
+
+    with patch.dict(client.application.config, {"PLAYLIST_CACHE_ENABLED": True}), \
+            patch.object(spotify_client, "get", side_effect=mock_get), \
+            patch('app.routes.retrieve_user_info_from_db', return_value={"access_token": "test_token", "expires_at": FRESH_EXPIRES_AT}):
+        response = client.get('/playlist/test_playlist_id/tracks?session_id=test_session')
+        data = response.get_json()
+    client.application.extensions["playlist_cache"].local.clear()
+
+    # A partial list must not be revalidated into 304s later
+    assert data["error"] == "Failed to fetch all playlist tracks."
+    assert "ETag" not in response.headers
+    assert response.headers["Cache-Control"] == "no-store"
+
+def test_get_playlist_tracks_single_page_has_etag(client, spotify_client):
+    with patch.object(spotify_client, "get", side_effect=mock_playlist_get(80, snapshot_id="snap1")), \
+            patch('app.routes.retrieve_user_info_from_db', return_value={"access_token": "test_token", "expires_at": FRESH_EXPIRES_AT}):
+        response = client.get('/playlist/test_playlist_id/tracks?session_id=test_session')
+
+    assert len(response.get_json()["items"]) == 80
+    assert response.headers["ETag"] == '"test_playlist_id:snap1"'
+
+def test_get_playlist_tracks_snapshot_cache_and_etag(client, spotify_client):
+    requested = []
+    mock_get = mock_playlist_get(120, snapshot_id="snap1", requested=requested)
+
+    with patch.dict(client.application.config, {"PLAYLIST_CACHE_ENABLED": True}), \
+            patch.object(spotify_client, "get", side_effect=mock_get), \
+            patch('app.routes.retrieve_user_info_from_db', return_value={"access_token": "test_token", "expires_at": FRESH_EXPIRES_AT}):
+        first = client.get('/playlist/test_playlist_id/tracks?session_id=test_session')
+        first_data = first.get_json()
+        cached = client.get('/playlist/test_playlist_id/tracks?session_id=test_session')
+        not_modified = client.get(
+            '/playlist/test_playlist_id/tracks?session_id=test_session',
+            headers={"If-None-Match": cached.headers["ETag"]},
+        )
+    client.application.extensions["playlist_cache"].local.clear()
+
+    # The streamed first response could have been partial, the ETag comes with the complete cached list
+    assert "ETag" not in first.headers
+    assert len(first_data["items"]) == 120
+    # Only the first request fetched the remaining pages, the others just read the playlist
+    assert [params.get("offset") for params in requested] == [None, 100, None, None]
+    assert cached.get_json() == first_data
+    assert cached.headers["ETag"] == '"test_playlist_id:snap1"'
+    assert not_modified.status_code == 304
+
 @patch('app.routes.retrieve_user_info_from_db')
 def test_get_access_token(mock_retrieve, client):
-    mock_retrieve.return_value = {"access_token": "test_access_token"}
+    mock_retrieve.return_value = {"access_token": "test_access_token", "expires_at": FRESH_EXPIRES_AT}
     
     response = client.get('/get_access_token?session_id=test_session')
         
@@ -593,4 +1143,168 @@ def test_get_history_db_error(mock_retrieve, client):
     
     response = client.get('/history?session_id=test_session')
     assert response.status_code == 500
-    assert "error" in json.loads(response.data)
\ No newline at end of file
+    assert "error" in json.loads(response.data)
+def test_openai_client_is_app_scoped(client):
+    openai_client = get_openai_client()
+    assert openai_client is get_openai_client()
+    assert openai_client is client.application.extensions["openai_client"]
+    assert openai_client.max_retries == client.application.config["OPENAI_MAX_RETRIES"]
+
+def test_create_app_has_no_import_side_effects(tmp_path):
+    # Run in a fresh interpreter, this one imported openai long ago
+    script = (
+        "import sys, app; "
+        "app.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'OPENAI_API_KEY': 'test'}); "
+        "assert 'openai' not in sys.modules, 'openai was imported'"
+    )
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(
+        os.environ,
+        PYTHONPATH=repo_root,
+        FLASK_SECRET_KEY=os.getenv("FLASK_SECRET_KEY", "test"),
+        LOG_LEVEL="WARNING",
+    )
+    subprocess.run([sys.executable, "-c", script], cwd=tmp_path, env=env, check=True)
+    # No log directory or file is created in the working directory
+    assert list(tmp_path.iterdir()) == []
+
+def test_get_history_keyset_pagination(client, clear_db):
+    user = User(session_id="test_session", spotify_user_id="test_user", access_token="test_token", refresh_token="test_refresh")
+    db.session.add(user)
+    now = datetime.now()
+    for i in range(7):
+        history = SearchHistory(
+            spotify_user_id="test_user",
+            search_query=f"Test query {i}",
+            spotify_link=f"https://open.spotify.com/playlist/test{i}"
+        )
+        db.session.add(history)
+        db.session.flush()
+        # Entries 2 and 3 share a timestamp, the id breaks the tie
+        history.timestamp = now - timedelta(minutes=min(i, 2) if i < 4 else i)
+    db.session.commit()
+
+    descriptions = []
+    cursor = None
+    pages = 0
+    while True:
+        url = '/history?session_id=test_session&limit=2'
+        if cursor:
+            url += f'&cursor={cursor}'
+        data = json.loads(client.get(url).data)
+        descriptions += [entry["description"] for entry in data["items"]]
+        pages += 1
+        cursor = data["next_cursor"]
+        if cursor is None:
+            break
+
+    assert pages == 4
+    assert sorted(descriptions) == [f"Test query {i}" for i in range(7)]
+    assert len(set(descriptions)) == 7
+    assert descriptions[0] == "Test query 0"
+
+def test_history_page_query_uses_index_without_sort(client):
+    if db.engine.dialect.name != "sqlite":
+        pytest.skip("Checks the SQLite query plan")
+    query = history_page_query("test_user", (datetime.now(), 10), 11)
+    sql = str(query.statement.compile(db.engine, compile_kwargs={"literal_binds": True}))
+    plan = " ".join(str(row[-1]) for row in db.session.execute(text("EXPLAIN QUERY PLAN " + sql)))
+
+    assert "USING INDEX ix_search_history_spotify_user_id_timestamp_id" in plan
+    assert "TEMP B-TREE" not in plan
+
+def test_get_history_limit_is_capped(client, clear_db):
+    user = User(session_id="test_session", spotify_user_id="test_user", access_token="test_token", refresh_token="test_refresh")
+    db.session.add(user)
+    for i in range(4):
+        db.session.add(SearchHistory(spotify_user_id="test_user", search_query=f"q{i}", spotify_link="link"))
+    db.session.commit()
+
+    with patch.dict(client.application.config, {"HISTORY_MAX_PAGE_SIZE": 3}):
+        data = json.loads(client.get('/history?session_id=test_session&limit=1000').data)
+    assert len(data["items"]) == 3
+    assert data["next_cursor"] is not None
+
+    response = client.get('/history?session_id=test_session&cursor=not-a-cursor')
+    assert response.status_code == 400
+
+def test_get_valid_access_token_refreshes_before_expiry(client, clear_db, spotify_client):
+    user = User(
+        session_id="expiring_session",
+        access_token="old_access_token",
+        refresh_token="old_refresh_token",
+        spotify_user_id="test_user",
+        expires_at=datetime.now() + timedelta(seconds=60),
+    )
+    db.session.add(user)
+    db.session.commit()
+
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {
+        "access_token": "new_access_token",
+        "refresh_token": "rotated_refresh_token",
+        "expires_in": 3600,
+    }
+
+    token_info = retrieve_user_info_from_db("expiring_session")
+    with patch.object(spotify_client, "post", return_value=mock_response) as mock_post:
+        access_token = get_valid_access_token("expiring_session", token_info)
+
+    assert access_token == "new_access_token"
+    assert mock_post.call_count == 1
+    stored = retrieve_user_info_from_db("expiring_session")
+    assert stored["access_token"] == "new_access_token"
+    assert stored["refresh_token"] == "rotated_refresh_token"
+    assert stored["expires_at"] > datetime.now() + timedelta(minutes=50)
+
+def test_get_valid_access_token_keeps_fresh_token(client, spotify_client):
+    token_info = {
+        "access_token": "fresh_access_token",
+        "refresh_token": "refresh_token",
+        "expires_at": datetime.now() + timedelta(hours=1),
+    }
+    with patch.object(spotify_client, "post") as mock_post:
+        assert get_valid_access_token("fresh_session", token_info) == "fresh_access_token"
+    mock_post.assert_not_called()
+
+def test_get_valid_access_token_refreshes_session_without_expiry(client, clear_db, spotify_client):
+    # Stored before expiry times were recorded
+    store_tokens_in_db("legacy_session", {"access_token": "legacy_token", "refresh_token": "legacy_refresh"}, "legacy_user")
+    mock_response = MagicMock(status_code=200)
+    mock_response.json.return_value = {"access_token": "new_access_token", "expires_in": 3600}
+
+    token_info = retrieve_user_info_from_db("legacy_session")
+    with patch.object(spotify_client, "post", return_value=mock_response) as mock_post:
+        assert get_valid_access_token("legacy_session", token_info) == "new_access_token"
+        # The expiry is known now, the next request uses the token as it is
+        assert get_valid_access_token("legacy_session", retrieve_user_info_from_db("legacy_session")) == "new_access_token"
+
+    assert mock_post.call_count == 1
+    assert retrieve_user_info_from_db("legacy_session")["expires_at"] > datetime.now() + timedelta(minutes=50)
+
+def test_get_valid_access_token_keeps_stored_token_when_refresh_fails(client, clear_db, spotify_client):
+    store_tokens_in_db(
+        "failing_session",
+        {"access_token": "stored_token", "refresh_token": "revoked_refresh", "expires_in": 60},
+        "test_user",
+    )
+    mock_response = MagicMock(status_code=400, text="invalid_grant")
+
+    token_info = retrieve_user_info_from_db("failing_session")
+    with patch.object(spotify_client, "post", return_value=mock_response) as mock_post:
+        assert get_valid_access_token("failing_session", token_info) == "stored_token"
+
+    assert mock_post.call_count == 1
+    assert retrieve_user_info_from_db("failing_session")["access_token"] == "stored_token"
+
+def test_store_tokens_in_db_saves_expiry(client, clear_db):
+    token_info = {
+        "access_token": "test_access_token",
+        "refresh_token": "test_refresh_token",
+        "expires_in": 3600,
+    }
+    store_tokens_in_db("expiry_session", token_info, "test_user_id")
+
+    user = User.query.filter_by(session_id="expiry_session").first()
+    assert timedelta(minutes=59) < user.expires_at - datetime.now() <= timedelta(hours=1)
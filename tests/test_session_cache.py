@@ -0,0 +1,121 @@
+import time
+from unittest.mock import MagicMock, patch
+import pytest
+import redis
+from app import db
+from app.models import User
+from app.routes import refresh_session_tokens, retrieve_user_info_from_db, store_tokens_in_db
+from app.session_cache import INVALIDATION_CHANNEL, SessionCache
+
+USER_INFO = {"access_token": "token", "refresh_token": "refresh", "spotify_user_id": "user", "expires_at": None}
+
+
+def test_get_returns_copies():
+    cache = SessionCache(maxsize=10, ttl=60)
+    cache.set("session", USER_INFO, cache.generation)
+
+    found, user_info = cache.get("session")
+    user_info["access_token"] = "changed"
+
+    assert found
+    assert cache.get("session") == (True, USER_INFO)
+
+
+def test_entries_expire():
+    cache = SessionCache(maxsize=10, ttl=0.01)
+    cache.set("session", USER_INFO, cache.generation)
+    time.sleep(0.02)
+    assert cache.get("session") == (False, None)
+
+
+def test_invalidate_drops_entry_and_stale_set():
+    cache = SessionCache(maxsize=10, ttl=60)
+    cache.set("session", USER_INFO, cache.generation)
+
+    # A row read before the write must not be cached after it
+    generation = cache.generation
+    cache.invalidate("session")
+    cache.set("session", USER_INFO, generation)
+
+    assert cache.get("session") == (False, None)
+
+
+def test_invalidate_publishes_to_peers():
+    redis_client = MagicMock()
+    cache = SessionCache(maxsize=10, ttl=60, redis_client=redis_client)
+    cache.invalidate("session")
+    redis_client.publish.assert_called_once_with(INVALIDATION_CHANNEL, "session")
+
+
+def test_subscriber_drops_invalidated_entries():
+    redis_client = MagicMock()
+    pubsub = redis_client.pubsub.return_value
+    messages = [{"type": "message", "data": b"session"}]
+    pubsub.get_message.side_effect = lambda timeout: messages.pop() if messages else time.sleep(0.01)
+    cache = SessionCache(maxsize=10, ttl=60, redis_client=redis_client)
+    cache.local.set("session", USER_INFO)
+    cache.local.set("other", USER_INFO)
+
+    cache.get("other")
+    for _ in range(100):
+        if not cache.local.get("session")[0]:
+            break
+        time.sleep(0.01)
+    cache.stop()
+
+    pubsub.subscribe.assert_called_once_with(INVALIDATION_CHANNEL)
+    assert cache.local.get("session") == (False, None)
+    assert cache.local.get("other")[0]
+
+
+def test_subscriber_clears_cache_when_disconnected():
+    redis_client = MagicMock()
+    redis_client.pubsub.return_value.subscribe.side_effect = redis.ConnectionError("down")
+    cache = SessionCache(maxsize=10, ttl=60, redis_client=redis_client)
+    cache.local.set("session", USER_INFO)
+
+    cache.get("other")
+    for _ in range(100):
+        if len(cache.local) == 0:
+            break
+        time.sleep(0.01)
+    cache.stop()
+
+    assert len(cache.local) == 0
+
+
+@pytest.fixture
+def session_cache(client):
+    session_cache = client.application.extensions["session_cache"]
+    with patch.dict(client.application.config, {"SESSION_CACHE_ENABLED": True}):
+        yield session_cache
+    session_cache.local.clear()
+    db.session.query(User).delete()
+    db.session.commit()
+
+
+def test_history_reuses_cached_session(client, session_cache):
+    # Already expired, so refresh_session_tokens writes new tokens
+    store_tokens_in_db(
+        "cached_session", {"access_token": "token", "refresh_token": "refresh", "expires_in": -60}, "cached_user"
+    )
+
+    with patch("app.routes.retrieve_user_info_from_db", side_effect=retrieve_user_info_from_db) as mock_retrieve:
+        for _ in range(3):
+            assert client.get("/history?session_id=cached_session").status_code == 200
+        assert mock_retrieve.call_count == 1
+
+        # Refreshed tokens are read from the database again
+        new_tokens = {"access_token": "new_token", "expires_in": 3600}
+        with patch("app.routes.request_token_refresh", return_value=new_tokens):
+            refresh_session_tokens("cached_session")
+        assert client.get("/history?session_id=cached_session").status_code == 200
+        assert mock_retrieve.call_count == 2
+    assert session_cache.get("cached_session")[1]["access_token"] == "new_token"
+
+
+def test_unknown_sessions_are_not_cached(client, session_cache):
+    assert client.get("/history?session_id=late_session").status_code == 401
+
+    store_tokens_in_db("late_session", {"access_token": "token", "refresh_token": "refresh"}, "late_user")
+    assert client.get("/history?session_id=late_session").status_code == 200
@@ -0,0 +1,120 @@
+import json
+import threading
+import time
+from unittest.mock import MagicMock, patch
+from app.routes import iter_resolved_tracks, openai_recommendation
+from app.singleflight import SingleFlight
+
+
+def run_concurrently(target, count):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight("test")
+    calls = []
+    results = []
+
+    def work():
+        calls.append(1)
+        time.sleep(0.05)
+        return {"value": 42}
+
+    run_concurrently(lambda: results.append(flight.do("key", work)), 5)
+
+    assert len(calls) == 1
+    assert results == [{"value": 42}] * 5
+    # Nothing is remembered once the call is done
+    assert flight._calls == {}
+    flight.do("key", work)
+    assert len(calls) == 2
+
+
+def test_errors_are_shared_and_not_remembered():
+    flight = SingleFlight("test")
+    errors = []
+
+    def work():
+        time.sleep(0.05)
+        raise RuntimeError("boom")
+
+    def call():
+        try:
+            flight.do("key", work)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    run_concurrently(call, 3)
+
+    assert errors == ["boom"] * 3
+    assert flight.do("key", lambda: "ok") == "ok"
+
+
+def test_waiting_worker_reuses_result_published_through_redis():
+    redis_client = MagicMock()
+    redis_lock = redis_client.lock.return_value
+    # The lock is held by another worker, acquired once it is done
+    redis_lock.acquire.side_effect = [False, True]
+    redis_client.get.return_value = json.dumps({"value": "spotify:track:shared"})
+    flight = SingleFlight("test", redis_client=redis_client)
+    work = MagicMock()
+
+    assert flight.do("song", work) == "spotify:track:shared"
+    work.assert_not_called()
+    redis_client.get.assert_called_once_with("moodmelody:singleflight:test:song")
+    redis_lock.release.assert_called_once()
+
+
+def test_lock_holder_publishes_its_result():
+    redis_client = MagicMock()
+    redis_client.lock.return_value.acquire.return_value = True
+    flight = SingleFlight("test", redis_client=redis_client, lock_timeout=10)
+
+    assert flight.do("song", lambda: None) is None
+    redis_client.set.assert_called_once_with("moodmelody:singleflight:test:song", '{"value": null}', ex=10)
+
+
+def test_identical_recommendations_share_one_openai_call(client):
+    app = client.application
+    results = []
+
+    def mock_request_openai_recommendation(user_text):
+        time.sleep(0.05)
+        return {"Playlist name": "MMRain", "Songs": ["Song1 by Artist1"]}
+
+    def recommend():
+        with app.app_context():
+            results.append(openai_recommendation("Rainy day"))
+
+    with patch(
+        "app.routes.request_openai_recommendation", side_effect=mock_request_openai_recommendation
+    ) as mock_request:
+        run_concurrently(recommend, 4)
+
+    assert mock_request.call_count == 1
+    assert len(results) == 4
+    # Every caller gets its own copy of the shared recommendation
+    assert len({id(result) for result in results}) == 4
+
+
+def test_identical_track_searches_share_one_spotify_call(client):
+    app = client.application
+    resolved = []
+
+    def mock_search_spotify_track(spotify_client, recommendation, headers):
+        time.sleep(0.05)
+        return "spotify:track:mock_uri"
+
+    def resolve():
+        with app.app_context():
+            resolved.extend(track_uri for _, _, track_uri in iter_resolved_tracks(["Song by Artist"], {}))
+
+    with patch("app.routes.search_spotify_track", side_effect=mock_search_spotify_track) as mock_search:
+        run_concurrently(resolve, 3)
+
+    assert mock_search.call_count == 1
+    assert resolved == ["spotify:track:mock_uri"] * 3
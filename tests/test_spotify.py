@@ -0,0 +1,29 @@
+from unittest.mock import patch
+from app.spotify import SpotifyClient
+
+
+def test_spotify_client_applies_default_timeout():
+    spotify_client = SpotifyClient(connect_timeout=1, read_timeout=5)
+
+    with patch.object(spotify_client.session, "get") as mock_get:
+        spotify_client.get("https://api.spotify.com/v1/me", headers={})
+    assert mock_get.call_args.kwargs["timeout"] == (1, 5)
+
+    with patch.object(spotify_client.session, "post") as mock_post:
+        spotify_client.post("https://accounts.spotify.com/api/token", data={}, timeout=2)
+    assert mock_post.call_args.kwargs["timeout"] == 2
+
+
+def test_spotify_client_pools_connections_per_host():
+    spotify_client = SpotifyClient(pool_maxsize=7, max_retries=3)
+    adapter = spotify_client.session.get_adapter("https://api.spotify.com/v1/search")
+
+    assert adapter._pool_maxsize == 7
+    assert adapter._pool_block is True
+    assert adapter.max_retries.total == 3
+    # Creating a playlist must never be retried on an error status
+    assert "POST" not in adapter.max_retries.allowed_methods
+
+
+def test_app_owns_spotify_client(client):
+    assert isinstance(client.application.extensions["spotify_client"], SpotifyClient)
@@ -0,0 +1,73 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+from app import db
+from app.models import User
+from app.routes import get_valid_access_token, retrieve_user_info_from_db
+from app.token_refresh import RefreshCoordinator
+
+
+def test_concurrent_refreshes_share_one_spotify_call(client, spotify_client):
+    app = client.application
+    db.session.add(User(
+        session_id="stampede_session",
+        access_token="old_access_token",
+        refresh_token="old_refresh_token",
+        spotify_user_id="test_user",
+        expires_at=datetime.now() - timedelta(seconds=1),
+    ))
+    db.session.commit()
+
+    def mock_post(url, headers, data):
+        time.sleep(0.05)
+        response = MagicMock()
+        response.status_code = 200
+        response.json.return_value = {"access_token": "new_access_token", "expires_in": 3600}
+        return response
+
+    stale_token_info = retrieve_user_info_from_db("stampede_session")
+    results = []
+
+    def request_token():
+        with app.app_context():
+            results.append(get_valid_access_token("stampede_session", dict(stale_token_info)))
+
+    with patch.object(spotify_client, "post", side_effect=mock_post) as mock_refresh:
+        threads = [threading.Thread(target=request_token) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert results == ["new_access_token"] * 4
+    assert mock_refresh.call_count == 1
+
+    db.session.query(User).delete()
+    db.session.commit()
+
+
+def test_refresh_coordinator_uses_redis_lock():
+    redis_client = MagicMock()
+    redis_client.lock.return_value.acquire.return_value = True
+    coordinator = RefreshCoordinator(redis_client=redis_client, lock_timeout=7, wait_timeout=3)
+
+    with coordinator.lock("session") as distributed:
+        assert distributed
+
+    redis_client.lock.assert_called_once_with(
+        "moodmelody:token-refresh:session", timeout=7, blocking_timeout=3
+    )
+    redis_client.lock.return_value.release.assert_called_once()
+
+
+def test_refresh_coordinator_without_redis_lock():
+    redis_client = MagicMock()
+    redis_client.lock.return_value.acquire.return_value = False
+    coordinator = RefreshCoordinator(redis_client=redis_client)
+
+    with coordinator.lock("session") as distributed:
+        assert not distributed
+    with RefreshCoordinator().lock("session") as distributed:
+        assert not distributed
+    assert coordinator._locks == {}